@@ -1,21 +1,271 @@
 #!/usr/bin/env python
 from __future__ import absolute_import, unicode_literals, print_function
 import argparse
+import contextlib
 import os
+import sys
 from .parse import LibraryData
-from .db import create_db
+from .db import create_db, get_connection
+from .splash import backfill_splash
+from .summary import backfill_summary
+from .synonyms import backfill_synonyms
+from .build import run_manifest
+from .index import FragmentIndex, NeutralLossIndex
+from .search import SpectralLibrary, read_msp_spectra, search_batch, write_hits
+from .snapshot import Snapshot, create_snapshot
+from .export import MSP_STYLES, ARROW_FORMATS, PEAK_LAYOUTS, export_msp, export_arrow
 
 
-def main():
+def main(argv=None):
+    """ Command line interface
+
+    "msp2db [options]" converts MSP files to a database, the other commands are run with "msp2db <command> [options]"
+    (see "msp2db <command> --help")
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] in COMMANDS:
+        return COMMANDS[argv[0]](argv[1:])
+    return import_msp(argv)
+
+
+def _add_db_args(p):
+    """ Add the arguments for the database connection to a parser
+    """
+    p.add_argument('-o', '--out_pth', dest='out_pth', help='File path for SQLite database (or connection string for '
+                                                           'PostgreSQL)', required=False)
+    p.add_argument('-t', '--db_type', dest='type', help='Database type [mysql, sqlite, postgres]', required=False,
+                   default='sqlite')
+    p.add_argument('-u', '--user', dest='user', help='Username for the MySQL or PostgreSQL database', required=False)
+    p.add_argument('--password', dest='password', help='Password for the MySQL or PostgreSQL database',
+                   required=False)
+    p.add_argument('--db_name', dest='db_name', help='Name of the MySQL or PostgreSQL database', required=False)
+    p.add_argument('--host', dest='host', help='Host of the MySQL or PostgreSQL server', required=False)
+    p.add_argument('--port', dest='port', type=int, help='Port of the MySQL or PostgreSQL server', required=False)
+
+
+def _db_connection(args):
+    """ Get the database connection from the parsed database arguments (to be closed by the caller, e.g. with
+    contextlib.closing)
+    """
+    # for PostgreSQL the out_pth can be used for the connection string
+    db_pth = args.out_pth if args.type in ('sqlite', 'postgres') else None
+    return get_connection(args.type, db_pth, args.user, args.password, args.db_name, host=args.host, port=args.port)
+
+
+def splash(argv):
+    """ msp2db splash: calculate the SPLASH of the spectra in an existing database
+    """
+    p = argparse.ArgumentParser(prog='msp2db splash',
+                                description='Calculate the SPLASH of the spectra (without a SPLASH) in a database')
+    _add_db_args(p)
+    p.add_argument('--overwrite', dest='overwrite', action='store_true',
+                   help='Replace the SPLASH of spectra that already have one')
+    p.add_argument('--processes', dest='processes', help='Number of worker processes', default=1)
+    p.add_argument('--page_size', dest='page_size', help='Number of spectra processed at a time', default=1000)
+    args = p.parse_args(argv)
+
+    with contextlib.closing(_db_connection(args)) as conn:
+        backfill_splash(conn, db_type=args.type, overwrite=args.overwrite, page_size=int(args.page_size),
+                        processes=int(args.processes))
+
+
+def summary(argv):
+    """ msp2db summary: calculate the summary of the spectra in an existing database
+    """
+    p = argparse.ArgumentParser(prog='msp2db summary',
+                                description='Calculate the summary (number of peaks, base peak, TIC and m/z range) '
+                                            'of the spectra (without a summary) in a database')
+    _add_db_args(p)
+    p.add_argument('--overwrite', dest='overwrite', action='store_true',
+                   help='Recalculate the summary of spectra that already have one')
+    p.add_argument('--page_size', dest='page_size', help='Number of spectra processed at a time', default=1000)
+    args = p.parse_args(argv)
+
+    with contextlib.closing(_db_connection(args)) as conn:
+        backfill_summary(conn, db_type=args.type, overwrite=args.overwrite, page_size=int(args.page_size))
+
+
+def synonyms(argv):
+    """ msp2db synonyms: rebuild the compound name and synonym index of an existing database
+    """
+    p = argparse.ArgumentParser(prog='msp2db synonyms',
+                                description='Rebuild the table (and full-text index) of the compound names and '
+                                            'synonyms from the compounds in a database')
+    _add_db_args(p)
+    p.add_argument('--page_size', dest='page_size', help='Number of compounds processed at a time', default=10000)
+    args = p.parse_args(argv)
+
+    with contextlib.closing(_db_connection(args)) as conn:
+        backfill_synonyms(conn, db_type=args.type, page_size=int(args.page_size))
+
+
+def build(argv):
+    """ msp2db build: build a library from the sources listed in a manifest
+    """
+    p = argparse.ArgumentParser(prog='msp2db build',
+                                description='Build a library from the sources listed in a manifest (JSON or YAML), '
+                                            'the sources are parsed concurrently and merged into the database')
+    p.add_argument('manifest', help='Path to the manifest file')
+    p.add_argument('-w', '--workers', dest='workers', help='Number of concurrent parsers (overrides the manifest)',
+                   required=False)
+    p.add_argument('-r', '--report', dest='report', help='Path of the report csv (overrides the manifest)',
+                   required=False)
+    args = p.parse_args(argv)
+
+    report = run_manifest(args.manifest, processes=int(args.workers) if args.workers else None,
+                          report_pth=args.report)
+    for row in report:
+        print('{source}: {spectra} spectra in {import_seconds:.1f}s (merged in {merge_seconds:.1f}s)'.format(**row))
+
+
+def index(argv):
+    """ msp2db index: build the fragment and/or neutral loss index of the spectra in an existing database
+    """
+    p = argparse.ArgumentParser(prog='msp2db index',
+                                description='Build the fragment m/z and/or neutral loss indexes (sidecar files) of '
+                                            'the spectra in a database')
+    _add_db_args(p)
+    p.add_argument('--fragments', dest='fragments', help='Path of the fragment index file', required=False)
+    p.add_argument('--neutral_losses', dest='neutral_losses', help='Path of the neutral loss index file',
+                   required=False)
+    p.add_argument('--bin_width', dest='bin_width', help='Width of the bins', default=0.01)
+    args = p.parse_args(argv)
+
+    if not args.fragments and not args.neutral_losses:
+        p.error('at least one of --fragments or --neutral_losses is required')
+
+    with contextlib.closing(_db_connection(args)) as conn:
+        for index_cls, pth in ((FragmentIndex, args.fragments), (NeutralLossIndex, args.neutral_losses)):
+            if pth:
+                peak_index = index_cls.from_db(conn, db_type=args.type, bin_width=float(args.bin_width))
+                peak_index.save(pth)
+                print('{} {} postings indexed'.format(len(peak_index), index_cls.kind))
+
+
+def snapshot(argv):
+    """ msp2db snapshot: write a read-optimised snapshot of the spectra in an existing database
+    """
+    p = argparse.ArgumentParser(prog='msp2db snapshot',
+                                description='Write the spectra of a database to a read-optimised binary snapshot '
+                                            '(memory mapped by msp2db search --snapshot)')
+    p.add_argument('snapshot', help='Path of the snapshot file')
+    _add_db_args(p)
+    p.add_argument('--mz_power', dest='mz_power', help='m/z weighting of the cosine similarity', default=0)
+    p.add_argument('--intensity_power', dest='intensity_power', default=1,
+                   help='Intensity weighting of the cosine similarity')
+    args = p.parse_args(argv)
+
+    with contextlib.closing(_db_connection(args)) as conn:
+        n = create_snapshot(conn, args.snapshot, db_type=args.type, mz_power=float(args.mz_power),
+                            intensity_power=float(args.intensity_power))
+    print('{} spectra written to {}'.format(n, args.snapshot))
+
+
+def export(argv):
+    """ msp2db export: write the spectra (or a filtered subset) of an existing database to a MSP file or to Parquet or
+    Arrow files
+    """
+    p = argparse.ArgumentParser(prog='msp2db export',
+                                description='Write the spectra of a database (optionally filtered) to a MSP file in '
+                                            'the MoNA or MassBank style (gzip compressed if the path ends with .gz) '
+                                            'or to a directory of Parquet or Arrow IPC files (requires pyarrow)')
+    p.add_argument('out', help='Path of the MSP file (or the directory of the Parquet or Arrow files)')
+    _add_db_args(p)
+    p.add_argument('-f', '--format', dest='format', choices=('msp',) + ARROW_FORMATS, default='msp',
+                   help='Format of the export')
+    p.add_argument('-x', '--style', dest='style', choices=MSP_STYLES, default='mona',
+                   help='Style of the MSP records ("mona" or "massbank")')
+    p.add_argument('--polarity', dest='polarity', help='Only export spectra of this polarity (e.g. positive)',
+                   required=False)
+    p.add_argument('--ms_level', dest='ms_level', help='Only export spectra of this ms level', required=False)
+    p.add_argument('--where', dest='where', required=False,
+                   help='Additional SQL condition of the spectra (library_spectra_meta columns as m.<column> and '
+                        'metab_compound columns as c.<column>), e.g. "m.instrument_type LIKE \'LC-ESI-%%\'"')
+    p.add_argument('--gzip', dest='gzip', action='store_true', help='Compress the MSP file with gzip')
+    p.add_argument('--page_size', dest='page_size', help='Number of spectra read at a time (MSP)', default=1000)
+    p.add_argument('--peaks', dest='peaks', choices=PEAK_LAYOUTS, default='list',
+                   help='Layout of the peaks (Parquet or Arrow), a row per spectrum with list columns or a row per '
+                        'peak')
+    p.add_argument('--partition_by', dest='partition_by', required=False,
+                   help='Column of library_spectra_meta to partition the spectra by (Parquet or Arrow)')
+    p.add_argument('--row_group_size', dest='row_group_size', default=100000,
+                   help='Number of rows read for each row group (Parquet or Arrow)')
+    p.add_argument('--compression', dest='compression', required=False,
+                   help='Compression codec of the Parquet or Arrow files (e.g. zstd)')
+    args = p.parse_args(argv)
+
+    filters = {}
+    if args.ms_level:
+        filters['ms_level'] = float(args.ms_level)
+    with contextlib.closing(_db_connection(args)) as conn:
+        if args.format == 'msp':
+            n = export_msp(conn, args.out, db_type=args.type, style=args.style,
+                           compress=True if args.gzip else None, page_size=int(args.page_size), where=args.where,
+                           polarity=args.polarity, **filters)
+            print('{} spectra exported to {}'.format(n, args.out))
+        else:
+            export_arrow(conn, args.out, db_type=args.type, file_format=args.format, peaks=args.peaks,
+                         partition_by=args.partition_by, row_group_size=int(args.row_group_size),
+                         compression=args.compression, where=args.where, polarity=args.polarity, **filters)
+
+
+def search(argv):
+    """ msp2db search: search a library database for the spectra of MSP files
+    """
+    p = argparse.ArgumentParser(prog='msp2db search',
+                                description='Search a library for the most similar spectra to each spectrum of MSP '
+                                            'files (the top hits are written to a CSV file or SQLite database)')
+    p.add_argument('queries', help='Path to the MSP file (or directory of MSP files) of the query spectra')
+    p.add_argument('--db', dest='db', help='File path of the SQLite library (or connection string for PostgreSQL)',
+                   required=False)
+    p.add_argument('--snapshot', dest='snapshot', help='Path of a snapshot of the library (see msp2db snapshot), '
+                                                       'used instead of --db', required=False)
+    p.add_argument('-t', '--db_type', dest='type', help='Database type [sqlite, postgres]', default='sqlite')
+    p.add_argument('-r', '--results', dest='results', help='Path of the results (.db or .sqlite for a SQLite '
+                                                           'database otherwise CSV)', default='search_hits.csv')
+    p.add_argument('-w', '--workers', dest='workers', help='Number of worker processes', default=1)
+    p.add_argument('-k', '--top_k', dest='top_k', help='Number of hits for each query', default=10)
+    p.add_argument('--method', dest='method', choices=['cosine', 'entropy'], default='cosine',
+                   help='Spectral similarity')
+    p.add_argument('--tolerance', dest='tolerance', help='Fragment m/z tolerance (Da)', default=0.01)
+    p.add_argument('--precursor_ppm', dest='precursor_ppm', default=10,
+                   help='Precursor m/z tolerance (ppm) of the candidates')
+    p.add_argument('--mz_power', dest='mz_power', default=0,
+                   help='m/z weighting of the cosine similarity (a snapshot uses the weighting it was written with)')
+    p.add_argument('--intensity_power', dest='intensity_power', default=1,
+                   help='Intensity weighting of the cosine similarity')
+    p.add_argument('-x', '--schema', dest='schema', help='Schema of the query MSP files ("mona" or "massbank")',
+                   default='mona')
+    args = p.parse_args(argv)
+
+    if args.snapshot:
+        library = Snapshot(args.snapshot).library()
+    elif args.db:
+        conn = get_connection(args.type, args.db)
+        library = SpectralLibrary.from_db(conn, db_type=args.type, mz_power=float(args.mz_power),
+                                          intensity_power=float(args.intensity_power))
+        conn.close()
+    else:
+        p.error('either --db or --snapshot is required')
+
+    results = search_batch(library, read_msp_spectra(args.queries, schema=args.schema), workers=int(args.workers),
+                           top_k=int(args.top_k), method=args.method, tolerance=float(args.tolerance),
+                           precursor_ppm=float(args.precursor_ppm))
+    n = write_hits(results, args.results)
+    print('{} query spectra searched against {} library spectra'.format(n, len(library)))
+
+
+def import_msp(argv):
+    """ msp2db: convert MSP files to a database
+    """
     p = argparse.ArgumentParser(prog='PROG',
                                 formatter_class=argparse.RawDescriptionHelpFormatter,
-                                description='''Convert msp to SQLite or MySQL database''',
+                                description='''Convert msp to SQLite, MySQL or PostgreSQL database''',
                                 epilog='''--------------''')
 
-    p.add_argument('-m', '--msp_pth', dest='msp_pth', help='Path to the MSP file (or directory of msp files)', required=True)
+    p.add_argument('-m', '--msp_pth', dest='msp_pth', help='Path to the MSP file, MoNA JSON file (.json) or directory of msp files', required=True)
     p.add_argument('-s', '--source', dest='source', help='Name of data source (e.g. MassBank, LipidBlast)', required=True)
-    p.add_argument('-o', '--out_pth', dest='out_pth', help='File path for SQLite database', required=False)
-    p.add_argument('-t', '--db_type', dest='type', help='Database type [mysql, sqlite]', required=False, default='sqlite')
+    _add_db_args(p)
     p.add_argument('-d', '--delete_tables',  dest='dt', help='Delete tables', action='store_true')
     p.add_argument('-l', '--mslevel', dest='mslevel', help='MS level of fragmentation if not detailed in msp file', required=False)
     p.add_argument('-p', '--polarity', dest='polarity', help='Polarity of fragmentation if not detailed in msp file', required=False)
@@ -24,18 +274,48 @@ def main():
     p.add_argument('-y', '--ignore_compound_lookup', dest='ignore_compound_lookup',
                    help='ignore searching of compounds for each spectra '
                         'based on meta information in the MSP file', action='store_true')
+    p.add_argument('-z', '--ignore_structure_lookup', dest='ignore_structure_lookup',
+                   help='ignore the local (RDKit) derivation of the inchikey from the SMILES or InChI of each '
+                        'spectra', action='store_true')
+    p.add_argument('--structure_processes', dest='structure_processes',
+                   help='Number of processes used to evaluate the SMILES and InChIs of each file (requires RDKit)',
+                   default=1)
+    p.add_argument('--mysql_bulk', dest='mysql_bulk', choices=['load_data', 'multirow'],
+                   help='Bulk insert method for MySQL databases (LOAD DATA LOCAL INFILE or multi-row INSERT)',
+                   required=False)
+    p.add_argument('--resume', dest='resume', action='store_true',
+                   help='Resume the last incomplete import of the MSP file (or directory) from its last committed chunk')
+    p.add_argument('--no_checkpoint', dest='no_checkpoint', action='store_true',
+                   help='Do not record the progress of the import (an import without checkpoints can not be resumed)')
+    p.add_argument('--incremental', dest='incremental', action='store_true',
+                   help='Only import the records that are new or changed since the last incremental import of the '
+                        'source (and remove the records that are no longer present)')
+    p.add_argument('--compute_splash', dest='compute_splash', action='store_true',
+                   help='Calculate the SPLASH of each spectrum (without a SPLASH in the MSP file) from the peaks')
+    p.add_argument('--splash_processes', dest='splash_processes', default=1,
+                   help='Number of worker processes used to calculate the SPLASHs')
+    p.add_argument('--fragment_index', dest='fragment_index', required=False,
+                   help='Path of the fragment index file to update with the imported spectra')
+    p.add_argument('--neutral_loss_index', dest='neutral_loss_index', required=False,
+                   help='Path of the neutral loss index file to update with the imported spectra')
+    p.add_argument('--no_summary', dest='no_summary', action='store_true',
+                   help='Do not store the summary (number of peaks, base peak, TIC and m/z range) of each spectrum')
+    p.add_argument('--no_synonyms', dest='no_synonyms', action='store_true',
+                   help='Do not store the names and synonyms of each compound in the (full-text indexed) synonym table')
 
-    args = p.parse_args()
+    args = p.parse_args(argv)
 
     if args.type == 'sqlite':
         db_pth = args.out_pth
         if not os.path.exists(db_pth) or args.dt:
             create_db(db_pth)
     else:
-        if args.dt:
-            create_db(file_pth=None)
+        # for PostgreSQL the out_pth can be used for the connection string
+        db_pth = args.out_pth if args.type == 'postgres' else None
 
-        db_pth = None
+        if args.dt:
+            with contextlib.closing(_db_connection(args)) as conn:
+                create_db(db_type=args.type, conn=conn)
 
     if not args.mslevel:
         args.mslevel = 0
@@ -56,15 +336,40 @@ def main():
     libdata = LibraryData(msp_pth=args.msp_pth,
                           db_pth=db_pth if db_pth else None,
                           db_type=args.type,
+                          user=args.user,
+                          password=args.password,
+                          mysql_db_name=args.db_name,
+                          mysql_bulk=args.mysql_bulk,
+                          host=args.host,
+                          port=args.port,
                           source=args.source,
                           mslevel=args.mslevel,
                           polarity=args.polarity,
                           schema=args.schema,
                           compound_lookup=compound_lookup,
-                          chunk=chunk)
+                          chunk=chunk,
+                          structure_lookup=not args.ignore_structure_lookup,
+                          structure_processes=int(args.structure_processes),
+                          checkpoint=not args.no_checkpoint,
+                          resume=args.resume,
+                          incremental=args.incremental,
+                          compute_splash=args.compute_splash,
+                          splash_processes=int(args.splash_processes),
+                          fragment_index_pth=args.fragment_index,
+                          neutral_loss_index_pth=args.neutral_loss_index,
+                          spectra_summary=not args.no_summary,
+                          compound_synonyms=not args.no_synonyms)
+
+    try:
+        if not chunk:
+            libdata.insert_data()
+    finally:
+        libdata.close()
+
+
+COMMANDS = {'splash': splash, 'summary': summary, 'synonyms': synonyms, 'build': build, 'index': index,
+            'snapshot': snapshot, 'search': search, 'export': export}
 
-    if not chunk:
-        libdata.insert_data()
 
 if __name__ == '__main__':
     main()
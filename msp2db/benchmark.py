@@ -0,0 +1,435 @@
+#!/usr/bin/env python
+from __future__ import absolute_import, unicode_literals, print_function
+import bisect
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import pubchempy as pcp
+import six
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import parse_qs, unquote
+from .db import create_db
+from .parse import LibraryData, clear_pubchem_cache, pubchem_cache_stats
+
+
+def load_fixtures(fixtures_pth):
+    """ Load compound fixtures (for the PubChem stand-in) from a JSON file
+
+    The JSON file should contain a list of compounds, each compound a dictionary with any of the following keys
+    'cid', 'inchikey', 'inchi', 'smiles', 'names' (list), 'molecular_formula', 'molecular_weight' and 'exact_mass'
+
+    Args:
+        fixtures_pth (str): Path to the JSON fixtures file
+
+    Returns:
+       list of compound dictionaries
+
+    """
+    with open(fixtures_pth, 'r') as f:
+        return json.load(f)
+
+
+def fixtures_from_db(conn):
+    """ Create compound fixtures (for the PubChem stand-in) from the metab_compound table of an existing database
+
+    Example:
+        >>> from msp2db.db import get_connection
+        >>> from msp2db.benchmark import fixtures_from_db
+        >>> fixtures = fixtures_from_db(get_connection('sqlite', 'library.db'))
+
+    Args:
+        conn (connection object): database connection object
+
+    Returns:
+       list of compound dictionaries
+
+    """
+    c = conn.cursor()
+    c.execute("SELECT inchikey_id, name, pubchem_id, other_names, exact_mass, molecular_formula, "
+              "molecular_weight, smiles FROM metab_compound WHERE inchikey_id NOT LIKE 'UNKNOWN%'")
+    fixtures = []
+    for row in c:
+        names = [row[1]] + (row[3].split(' <#> ') if row[3] else [])
+        fixtures.append({'inchikey': row[0],
+                         'names': [n for n in names if n],
+                         'cid': int(row[2]) if row[2] else None,
+                         'exact_mass': row[4],
+                         'molecular_formula': row[5],
+                         'molecular_weight': row[6],
+                         'smiles': row[7]})
+    return fixtures
+
+
+class PubChemStandIn(object):
+    """Local HTTP stand-in for the PubChem PUG REST compound endpoints used by msp2db
+
+    Serves compound records from fixture data so that the compound lookups can be tested and benchmarked offline.
+    The response latency, error rate and rate limiting of the real service can be simulated. When used as a
+    context manager the pubchempy API_BASE is redirected to the stand-in (and restored afterwards).
+
+    Example:
+        >>> from msp2db.benchmark import PubChemStandIn, load_fixtures
+        >>> with PubChemStandIn(load_fixtures('fixtures.json'), latency=0.05, rate_limit=5) as server:
+        >>>     libdata = LibraryData(msp_pth='MoNA-export-FAHFA.msp', db_pth='library.db')
+        >>> print(server.stats)
+
+    Args:
+        fixtures (list): List of compound dictionaries (see load_fixtures) [required]
+        latency (float): Seconds of latency added to each response [default 0.0]
+        latency_jitter (float): Maximum seconds of random latency added on top of the latency [default 0.0]
+        error_rate (float): Fraction of requests that fail with a 500 (ServerError) response [default 0.0]
+        rate_limit (float): Maximum requests per second, requests above the limit get a 503 (ServerBusy)
+                            response [default None]
+        host (str): Host to bind the server to [default '127.0.0.1']
+        port (int): Port to bind the server to, by default any free port is used [default 0]
+        seed (int): Seed for the random latency and errors [default None]
+
+    Returns:
+        PubChemStandIn object
+    """
+    def __init__(self, fixtures, latency=0.0, latency_jitter=0.0, error_rate=0.0, rate_limit=None,
+                 host='127.0.0.1', port=0, seed=None):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.host = host
+        self.port = port
+        self.random = random.Random(seed)
+        self.stats = {'requests': 0, 'found': 0, 'not_found': 0, 'errors': 0, 'throttled': 0}
+        self.server = None
+        self._thread = None
+        self._old_api_base = None
+        self._lock = threading.Lock()
+        self._tokens = rate_limit
+        self._last_token_time = time.time()
+
+        self.index = {'cid': {}, 'inchikey': {}, 'inchi': {}, 'smiles': {}, 'name': {}}
+        for compound in fixtures:
+            record = _pc_compound(compound)
+            if compound.get('cid'):
+                self.index['cid'][six.text_type(compound['cid'])] = record
+            if compound.get('inchikey'):
+                self.index['inchikey'][compound['inchikey'].upper()] = record
+            if compound.get('inchi'):
+                self.index['inchi'][compound['inchi']] = record
+            if compound.get('smiles'):
+                self.index['smiles'][compound['smiles']] = record
+            for name in compound.get('names', []):
+                self.index['name'].setdefault(name.lower(), record)
+
+    @property
+    def api_base(self):
+        """ The PUG REST base url of the stand-in (equivalent of pubchempy.API_BASE)
+        """
+        return 'http://{}:{}/rest/pug'.format(self.host, self.server.server_address[1])
+
+    def start(self):
+        """ Start the server in a background thread
+        """
+        standin = self
+
+        class Handler(_PubChemRequestHandler):
+            server_standin = standin
+
+        self.server = _ThreadedHTTPServer((self.host, self.port), Handler)
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ Stop the server
+        """
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        self.start()
+        self._old_api_base = pcp.API_BASE
+        pcp.API_BASE = self.api_base
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pcp.API_BASE = self._old_api_base
+        self.stop()
+
+    def lookup(self, namespace, identifier):
+        """ Get the PubChem record for an identifier of the namespace (e.g. 'inchikey') from the fixtures
+
+        Returns:
+            PUG REST compound record (dict) or None
+        """
+        if namespace == 'inchikey':
+            identifier = identifier.upper()
+        elif namespace == 'name':
+            identifier = identifier.lower()
+        return self.index.get(namespace, {}).get(identifier)
+
+    def _respond(self):
+        """ Simulate the latency, rate limit and errors for a request
+
+        Returns:
+            HTTP status code (200 if the request should be served)
+        """
+        delay = self.latency + (self.random.uniform(0, self.latency_jitter) if self.latency_jitter else 0)
+
+        with self._lock:
+            self.stats['requests'] += 1
+
+            if self.rate_limit:
+                # simple token bucket, refilled at rate_limit tokens per second
+                now = time.time()
+                self._tokens = min(self.rate_limit, self._tokens + (now - self._last_token_time) * self.rate_limit)
+                self._last_token_time = now
+                if self._tokens < 1:
+                    self.stats['throttled'] += 1
+                    return 503
+                self._tokens -= 1
+
+            error = self.error_rate and self.random.random() < self.error_rate
+
+        if delay:
+            time.sleep(delay)
+
+        if error:
+            with self._lock:
+                self.stats['errors'] += 1
+            return 500
+
+        return 200
+
+
+class _ThreadedHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _PubChemRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    server_standin = None
+
+    faults = {404: ('PUGREST.NotFound', 'No CID found'),
+              500: ('PUGREST.ServerError', 'Simulated server error'),
+              503: ('PUGREST.ServerBusy', 'Too many requests or server too busy')}
+
+    def do_GET(self):
+        self._handle({})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode('utf8') if length else ''
+        self._handle(parse_qs(body))
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self, data):
+        standin = self.server_standin
+        status = standin._respond()
+
+        if status == 200:
+            # e.g. /rest/pug/compound/inchikey/JSON (with post data) or /rest/pug/compound/cid/28516/JSON
+            parts = self.path.split('?')[0].strip('/').split('/')
+            try:
+                namespace = parts[parts.index('compound') + 1]
+            except (ValueError, IndexError):
+                namespace = None
+
+            if namespace in data:
+                identifier = data[namespace][0]
+            elif namespace and len(parts) > parts.index('compound') + 3:
+                identifier = unquote(parts[parts.index('compound') + 2])
+            else:
+                identifier = None
+
+            record = standin.lookup(namespace, identifier) if identifier else None
+            with standin._lock:
+                standin.stats['found' if record else 'not_found'] += 1
+
+            if record:
+                return self._send(200, {'PC_Compounds': [record]})
+            status = 404
+
+        code, message = self.faults[status]
+        self._send(status, {'Fault': {'Code': code, 'Message': message}})
+
+    def _send(self, status, d):
+        out = json.dumps(d).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+
+def _pc_compound(compound):
+    """ Convert a compound fixture into a (minimal) PUG REST compound record
+    """
+    props = []
+    for label, name, key in (('InChIKey', 'Standard', 'inchikey'),
+                             ('InChI', 'Standard', 'inchi'),
+                             ('Molecular Formula', None, 'molecular_formula'),
+                             ('Molecular Weight', None, 'molecular_weight'),
+                             ('Mass', 'Exact', 'exact_mass'),
+                             ('SMILES', 'Connectivity', 'smiles'),
+                             ('SMILES', 'Absolute', 'smiles')):
+        if compound.get(key) is None:
+            continue
+        urn = {'label': label}
+        if name:
+            urn['name'] = name
+        props.append({'urn': urn, 'value': {'sval': six.text_type(compound[key])}})
+
+    record = {'atoms': {'aid': [], 'element': []}, 'props': props}
+    if compound.get('cid'):
+        record['id'] = {'id': {'cid': int(compound['cid'])}}
+    return record
+
+
+class _TimedLibraryData(LibraryData):
+    """LibraryData that records the time taken to resolve the compound of each record
+    """
+    def __init__(self, *args, **kwargs):
+        self.compound_latencies = []
+        self.resolved = 0
+        super(_TimedLibraryData, self).__init__(*args, **kwargs)
+
+    def _store_compound_info(self):
+        start = time.time()
+        super(_TimedLibraryData, self)._store_compound_info()
+        self.compound_latencies.append(time.time() - start)
+        if not self.compound_info['inchikey_id'].startswith('UNKNOWN_'):
+            self.resolved += 1
+
+
+def resample_msp(msp_pth, out_pth, n_records, skew=1.1, seed=None):
+    """ Write an MSP file of n_records sampled (with replacement) from the records of another MSP file
+
+    Records are sampled with a Zipf-like distribution (weight of the record of rank r is 1/r**skew) so that a few
+    compounds are repeated many times and most compounds are rare, as seen across the MoNA exports.
+
+    Args:
+        msp_pth (str): Path to the msp file to sample from [required]
+        out_pth (str): Path of the msp file to write [required]
+        n_records (int): Number of records to write [required]
+        skew (float): Skew of the distribution, 0 would be uniform sampling [default 1.1]
+        seed (int): Seed for the sampling [default None]
+
+    Returns:
+       path of the written msp file
+
+    """
+    records = []
+    record = []
+    with open(msp_pth, 'r') as f:
+        for line in f:
+            record.append(line.rstrip('\r\n') + '\n')
+            if line.strip() in ('', '//'):
+                if any(l.strip() not in ('', '//') for l in record):
+                    records.append(record)
+                record = []
+    if any(l.strip() not in ('', '//') for l in record):
+        records.append(record + ['\n'])
+
+    rand = random.Random(seed)
+    weights = [1.0 / (r ** skew) for r in range(1, len(records) + 1)]
+    order = list(range(len(records)))
+    rand.shuffle(order)
+
+    with open(out_pth, 'w') as f:
+        for i in _weighted_sample(rand, order, weights, n_records):
+            f.writelines(records[i])
+
+    return out_pth
+
+
+def _weighted_sample(rand, population, weights, k):
+    """ Sample k items with replacement (random.choices is not available in python 2)
+    """
+    total = float(sum(weights))
+    cum = []
+    running = 0
+    for w in weights:
+        running += w
+        cum.append(running / total)
+
+    return [population[min(bisect.bisect_left(cum, rand.random()), len(population) - 1)] for _ in range(k)]
+
+
+def run_compound_benchmark(msp_pth, fixtures, schema='mona', latency=0.0, latency_jitter=0.0, error_rate=0.0,
+                           rate_limit=None, structure_lookup=False, warm_cache=False, seed=None):
+    """ Benchmark the compound resolution of an msp file against a local PubChem stand-in
+
+    The msp file is parsed into a temporary SQLite database with LibraryData (the compound lookups are sent to a
+    PubChemStandIn serving the fixtures). Use resample_msp to create files with realistic duplicate distributions.
+
+    Example:
+        >>> from msp2db.benchmark import run_compound_benchmark, load_fixtures
+        >>> results = run_compound_benchmark('MoNA-export-FAHFA.msp', load_fixtures('fixtures.json'), latency=0.05)
+
+    Args:
+        msp_pth (str): Path to the msp file [required]
+        fixtures (list): List of compound dictionaries (see load_fixtures) [required]
+        schema (str): Type of msp file either 'mona' or 'massbank' [default 'mona']
+        latency (float): Seconds of latency for each PubChem response [default 0.0]
+        latency_jitter (float): Maximum seconds of random latency added on top of the latency [default 0.0]
+        error_rate (float): Fraction of PubChem requests that fail [default 0.0]
+        rate_limit (float): Maximum PubChem requests per second [default None]
+        structure_lookup (boolean): Use the local (RDKit) derivation of the inchikey as well [default False]
+        warm_cache (boolean): Keep the PubChem cache from any previous runs [default False]
+        seed (int): Seed for the simulated latency and errors [default None]
+
+    Returns:
+       dictionary of the benchmark results
+
+    """
+    if not warm_cache:
+        clear_pubchem_cache()
+    hits, misses = pubchem_cache_stats['hits'], pubchem_cache_stats['misses']
+
+    dirpath = tempfile.mkdtemp()
+    try:
+        db_pth = os.path.join(dirpath, 'benchmark.db')
+        create_db(file_pth=db_pth)
+
+        with PubChemStandIn(fixtures, latency=latency, latency_jitter=latency_jitter, error_rate=error_rate,
+                            rate_limit=rate_limit, seed=seed) as server:
+            libdata = _TimedLibraryData(msp_pth=msp_pth, db_pth=db_pth, db_type='sqlite', schema=schema,
+                                        source='benchmark', chunk=200, structure_lookup=structure_lookup)
+        libdata.close()
+    finally:
+        shutil.rmtree(dirpath)
+
+    latencies = sorted(libdata.compound_latencies)
+    total = sum(latencies)
+    hits = pubchem_cache_stats['hits'] - hits
+    misses = pubchem_cache_stats['misses'] - misses
+
+    return {'records': len(latencies),
+            'resolved': libdata.resolved,
+            'seconds': total,
+            'compounds_per_second': len(latencies) / total if total else float('inf'),
+            'latency_p50': _percentile(latencies, 50),
+            'latency_p95': _percentile(latencies, 95),
+            'latency_p99': _percentile(latencies, 99),
+            'latency_max': latencies[-1] if latencies else 0.0,
+            'cache_hits': hits,
+            'cache_misses': misses,
+            'cache_hit_ratio': hits / float(hits + misses) if hits + misses else 0.0,
+            'requests': server.stats['requests'],
+            'errors': server.stats['errors'],
+            'throttled': server.stats['throttled']}
+
+
+def _percentile(sorted_values, percent):
+    """ Nearest-rank percentile of an already sorted list
+    """
+    if not sorted_values:
+        return 0.0
+    k = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[k]
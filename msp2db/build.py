@@ -0,0 +1,507 @@
+#!/usr/bin/env python
+from __future__ import absolute_import, unicode_literals, print_function
+import csv
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from .db import create_db, create_table, get_connection, insert_query_m, iter_table, SYNONYM_FTS_TABLE
+from .parse import LibraryData
+from .synonyms import insert_synonyms, SYNONYM_COLUMNS
+
+# tables merged from each shard and the id columns that need to be re-based (by the offset of the referenced table)
+_MERGE_TABLES = [('library_spectra_source', {'id': 'library_spectra_source'}),
+                 ('library_spectra_meta', {'id': 'library_spectra_meta',
+                                           'library_spectra_source_id': 'library_spectra_source'}),
+                 ('library_spectra', {'id': 'library_spectra',
+                                      'library_spectra_meta_id': 'library_spectra_meta'}),
+                 ('library_spectra_annotation', {'id': 'library_spectra_annotation',
+                                                 'library_spectra_meta_id': 'library_spectra_meta'}),
+                 ('library_spectra_hash', {'library_spectra_meta_id': 'library_spectra_meta'}),
+                 ('library_spectra_summary', {'library_spectra_meta_id': 'library_spectra_meta'})]
+
+
+def build_sqlite(db_pth, sources, processes=None, shards=1, tmp_dir=None):
+    """ Build a SQLite library from multiple sources in parallel
+
+    Each source (or each shard of a source) is imported into its own temporary SQLite database by a pool of worker
+    processes. The temporary databases are merged into db_pth (in the order of the sources) as they complete, see
+    merge_sqlite. The ids are the same as if the sources were imported one after another.
+
+    Example:
+        >>> from msp2db.build import build_sqlite
+        >>> build_sqlite('library.db', [{'msp_pth': 'MoNA-export-FAHFA.msp', 'source': 'fahfa'},
+        >>>                             {'msp_pth': 'MoNA-export-GNPS.msp', 'source': 'gnps'}], processes=4)
+
+    Args:
+        db_pth (str): Path to the SQLite database (created if it does not exist)
+        sources (list): List of dictionaries of the LibraryData arguments for each source (e.g. msp_pth, source,
+                        schema, mslevel, polarity, compound_lookup)
+        processes (int): Number of worker processes (by default uses the number of cpus) [default None]
+        shards (int): Split each MSP file into this number of shards (at record boundaries) so a large source can be
+                      imported in parallel. Directories are not split [default 1]
+        tmp_dir (str): Directory for the temporary databases [default None]
+
+    Returns:
+       list of dictionaries of the source, msp_pth, shard, number of spectra, the seconds to import and merge each
+       shard and the size of the database after the merge
+
+    """
+    if not os.path.exists(db_pth):
+        create_db(db_pth)
+
+    def merge(shard_pth, merged_sources):
+        spectra = merge_sqlite(db_pth, [shard_pth], merged_sources)
+        return spectra, os.path.getsize(db_pth)
+
+    return _build(sources, merge, processes, shards, tmp_dir)
+
+
+def build_database(conn, sources, db_type='sqlite', processes=None, shards=1, tmp_dir=None):
+    """ Build a library in any database from multiple sources in parallel
+
+    The same as build_sqlite but the temporary SQLite databases are merged through a single (shared) database
+    connection, see merge_into.
+
+    Example:
+        >>> from msp2db.db import get_connection
+        >>> from msp2db.build import build_database
+        >>> conn = get_connection('postgres', 'postgresql://localhost/library')
+        >>> build_database(conn, [{'msp_pth': 'MoNA-export-FAHFA.msp', 'source': 'fahfa'}], db_type='postgres')
+
+    Args:
+        conn (connection object): Database connection object
+        sources (list): List of dictionaries of the LibraryData arguments for each source
+        db_type (str): Type of database either "sqlite", "mysql", "postgres" or "django_mysql" [default "sqlite"]
+        processes (int): Number of worker processes (by default uses the number of cpus) [default None]
+        shards (int): Split each MSP file into this number of shards [default 1]
+        tmp_dir (str): Directory for the temporary databases [default None]
+
+    Returns:
+       list of dictionaries of the source, msp_pth, shard, number of spectra and the seconds to import and merge each
+       shard
+
+    """
+    def merge(shard_pth, merged_sources):
+        return merge_into(conn, shard_pth, db_type, merged_sources), None
+
+    return _build(sources, merge, processes, shards, tmp_dir)
+
+
+def _build(sources, merge, processes=None, shards=1, tmp_dir=None):
+    """ Import the sources (or shards) into temporary SQLite databases in a pool of worker processes and merge each
+    one (in order) with the merge function
+    """
+    work_dir = tempfile.mkdtemp(dir=tmp_dir)
+    tasks = []
+    shard_sources = []
+    try:
+        for i, kwargs in enumerate(sources):
+            msp_pths = [kwargs['msp_pth']]
+            if shards > 1 and not os.path.isdir(kwargs['msp_pth']):
+                msp_pths = split_msp(kwargs['msp_pth'], shards, os.path.join(work_dir, 'msp_{}'.format(i)))
+
+            for j, msp_pth in enumerate(msp_pths):
+                tasks.append((os.path.join(work_dir, 'shard_{}_{}.db'.format(i, j)), dict(kwargs, msp_pth=msp_pth)))
+                shard_sources.append((kwargs, j))
+
+        pool = multiprocessing.Pool(processes=processes)
+        report = []
+        merged_sources = {}
+        try:
+            # imap returns the shards in order (while the later shards are still being imported)
+            for (kwargs, shard), (shard_pth, seconds) in zip(shard_sources, pool.imap(_import_shard, tasks)):
+                start = time.time()
+                spectra, size = merge(shard_pth, merged_sources)
+                os.remove(shard_pth)
+                report.append({'source': kwargs.get('source', 'unknown'), 'msp_pth': kwargs['msp_pth'],
+                               'shard': shard, 'spectra': spectra, 'import_seconds': seconds,
+                               'merge_seconds': time.time() - start, 'size': size})
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return report
+
+
+def run_manifest(manifest, processes=None, report_pth=None):
+    """ Build a library from the sources listed in a manifest
+
+    The manifest is a dictionary (or the path to a JSON or YAML file) with the database details, the default
+    LibraryData arguments and the list of sources. Relative paths in a manifest file are relative to the file.
+
+    Example manifest (JSON)::
+
+        {"database": {"out_pth": "library.db", "db_type": "sqlite", "delete_tables": true},
+         "workers": 4,
+         "defaults": {"schema": "mona", "chunk": 200},
+         "sources": [{"msp_pth": "MoNA-export-FAHFA.msp", "source": "fahfa"},
+                     {"msp_pth": "MoNA-export-GNPS.msp", "source": "gnps", "mslevel": 2}]}
+
+    The database can also have the user, password, db_name, host and port (for MySQL or PostgreSQL). The manifest
+    can also have "shards" (see build_sqlite) and "report" (path of the report).
+
+    Example:
+        >>> from msp2db.build import run_manifest
+        >>> run_manifest('manifest.json', processes=4, report_pth='build_report.csv')
+
+    Args:
+        manifest (dict): The manifest (or path to the manifest file)
+        processes (int): Number of concurrent parsers (overrides "workers" of the manifest) [default None]
+        report_pth (str): Path to write the report csv (overrides "report" of the manifest) [default None]
+
+    Returns:
+       list of dictionaries of the report for each source (source, msp_pth, msp_size, shards, spectra,
+       import_seconds, merge_seconds, size and diff)
+
+    """
+    base_dir = ''
+    if not isinstance(manifest, dict):
+        base_dir = os.path.dirname(os.path.abspath(manifest))
+        manifest = load_manifest(manifest)
+
+    sources = plan_sources(manifest, base_dir)
+    db = manifest.get('database', {})
+    db_type = db.get('db_type', 'sqlite')
+    processes = processes or manifest.get('workers')
+    shards = int(manifest.get('shards', 1))
+    report_pth = report_pth or manifest.get('report')
+
+    print('Building {} sources ({} workers)'.format(len(sources), processes or 'cpu count'))
+    for kwargs in sources:
+        print('  {}: {}'.format(kwargs['source'], kwargs['msp_pth']))
+
+    if db_type == 'sqlite':
+        out_pth = os.path.join(base_dir, db['out_pth'])
+        if db.get('delete_tables') or not os.path.exists(out_pth):
+            create_db(out_pth)
+        shard_report = build_sqlite(out_pth, sources, processes, shards)
+    else:
+        out_pth = db.get('out_pth')
+        conn = get_connection(db_type, out_pth, db.get('user'), db.get('password'), db.get('db_name'),
+                              host=db.get('host'), port=db.get('port'))
+        if db.get('delete_tables'):
+            create_db(db_type=db_type, conn=conn)
+        shard_report = build_database(conn, sources, db_type, processes, shards)
+        conn.close()
+
+    report = _source_report(sources, shard_report)
+    if report_pth:
+        with open(os.path.join(base_dir, report_pth), 'w') as f:
+            dw = csv.DictWriter(f, fieldnames=['source', 'msp_pth', 'msp_size', 'shards', 'spectra', 'import_seconds',
+                                               'merge_seconds', 'size', 'diff'])
+            dw.writeheader()
+            dw.writerows(report)
+
+    return report
+
+
+def load_manifest(pth):
+    """ Load a manifest file (YAML if the file extension is .yaml or .yml which requires PyYAML, otherwise JSON)
+
+    Args:
+        pth (str): Path to the manifest
+
+    Returns:
+       manifest dictionary
+
+    """
+    with open(pth) as f:
+        if pth.lower().endswith(('.yaml', '.yml')):
+            import yaml
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def plan_sources(manifest, base_dir=''):
+    """ Get the LibraryData arguments of each source in a manifest (with the defaults of the manifest)
+
+    Args:
+        manifest (dict): The manifest
+        base_dir (str): Directory the paths of the sources are relative to [default '']
+
+    Returns:
+       list of dictionaries of the LibraryData arguments for each source
+
+    """
+    sources = []
+    for source in manifest['sources']:
+        kwargs = dict(manifest.get('defaults', {}))
+        kwargs.update(source)
+        if 'msp_pth' not in kwargs or 'source' not in kwargs:
+            raise ValueError('each source of the manifest needs a msp_pth and source {}'.format(source))
+        kwargs['msp_pth'] = os.path.join(base_dir, kwargs['msp_pth'])
+        sources.append(kwargs)
+    return sources
+
+
+def _source_report(sources, shard_report):
+    """ Combine the report of each shard into the report of each source
+    """
+    report = []
+    old_size = 0
+    for kwargs in sources:
+        shards = [r for r in shard_report if r['msp_pth'] == kwargs['msp_pth']]
+        size = shards[-1]['size'] if shards else None
+        msp_pth = kwargs['msp_pth']
+        report.append({'source': kwargs['source'],
+                       'msp_pth': msp_pth,
+                       'msp_size': os.path.getsize(msp_pth) if os.path.isfile(msp_pth) else None,
+                       'shards': len(shards),
+                       'spectra': sum(r['spectra'] for r in shards),
+                       'import_seconds': sum(r['import_seconds'] for r in shards),
+                       'merge_seconds': sum(r['merge_seconds'] for r in shards),
+                       'size': size,
+                       'diff': size - old_size if size is not None else None})
+        old_size = size or 0
+    return report
+
+
+def merge_sqlite(db_pth, shard_pths, merged_sources=None):
+    """ Merge SQLite library databases into another SQLite library database
+
+    Each database is attached and its rows are inserted with INSERT ... SELECT with the ids offset by the current
+    maximum ids of db_pth. Compounds (and their names and synonyms) already in db_pth are not duplicated. Spectra sources with the same name
+    (e.g. the shards of a single source) are merged into one library_spectra_source row when merged_sources is
+    provided.
+
+    Example:
+        >>> from msp2db.build import merge_sqlite
+        >>> merge_sqlite('library.db', ['fahfa.db', 'gnps.db'])
+
+    Args:
+        db_pth (str): Path to the SQLite database to merge into
+        shard_pths (list): Paths of the SQLite databases to merge
+        merged_sources (dict): Dictionary of source name to library_spectra_source id (updated with the merged
+                               sources) [default None]
+
+    Returns:
+       Number of spectra merged
+
+    """
+    conn = sqlite3.connect(db_pth)
+    create_table(conn, 'metab_compound_synonym')
+    c = conn.cursor()
+    spectra = 0
+
+    for shard_pth in shard_pths:
+        c.execute('ATTACH DATABASE ? AS shard', (shard_pth,))
+        try:
+            offsets = {}
+            for table in ('library_spectra_source', 'library_spectra_meta', 'library_spectra',
+                          'library_spectra_annotation'):
+                c.execute('SELECT max(id) FROM {}'.format(table))
+                offsets[table] = c.fetchone()[0] or 0
+
+            # sources already merged are reused
+            source_map = {}
+            if merged_sources is not None:
+                c.execute('SELECT id, name FROM shard.library_spectra_source')
+                for source_id, name in c.fetchall():
+                    if name in merged_sources:
+                        source_map[source_id] = merged_sources[name]
+                    else:
+                        merged_sources[name] = source_id + offsets['library_spectra_source']
+
+            # the names of the compounds that are new to db_pth (before the compounds are merged)
+            if _table_exists(c, 'shard', 'metab_compound_synonym'):
+                new = ('FROM shard.metab_compound_synonym WHERE inchikey_id NOT IN '
+                       '(SELECT inchikey_id FROM main.metab_compound)')
+                if _table_exists(c, 'main', SYNONYM_FTS_TABLE):
+                    c.execute('INSERT INTO main.{} (synonym, inchikey_id) SELECT synonym, inchikey_id {}'.format(
+                        SYNONYM_FTS_TABLE, new))
+                c.execute('INSERT INTO main.metab_compound_synonym ({cn}) SELECT {cn} {new}'.format(
+                    cn=SYNONYM_COLUMNS, new=new))
+
+            c.execute('INSERT OR IGNORE INTO metab_compound SELECT * FROM shard.metab_compound')
+
+            for table, rebase in _MERGE_TABLES:
+                if not _table_exists(c, 'shard', table):
+                    continue
+                columns = [row[1] for row in c.execute('PRAGMA shard.table_info({})'.format(table)).fetchall()]
+                select = []
+                for col in columns:
+                    if col == 'library_spectra_source_id' and source_map:
+                        cases = ' '.join('WHEN {} THEN {}'.format(k, v) for k, v in source_map.items())
+                        select.append('CASE {c} {w} ELSE {c} + {o} END'.format(
+                            c=col, w=cases, o=offsets['library_spectra_source']))
+                    elif col in rebase:
+                        select.append('{} + {}'.format(col, offsets[rebase[col]]))
+                    else:
+                        select.append('"{}"'.format(col))
+
+                where = ''
+                if table == 'library_spectra_source' and source_map:
+                    where = ' WHERE id NOT IN ({})'.format(', '.join(str(k) for k in source_map))
+
+                cn = ', '.join('"{}"'.format(col) for col in columns)
+                c.execute('INSERT INTO main.{t} ({cn}) SELECT {s} FROM shard.{t}{w}'.format(
+                    t=table, cn=cn, s=', '.join(select), w=where))
+                if table == 'library_spectra_meta':
+                    spectra += c.rowcount
+
+            conn.commit()
+        finally:
+            c.execute('DETACH DATABASE shard')
+
+    conn.close()
+    return spectra
+
+
+def merge_into(conn, shard_pth, db_type='sqlite', merged_sources=None, page_size=10000):
+    """ Merge a SQLite library database into another database (e.g. MySQL or PostgreSQL)
+
+    The same as merge_sqlite, but the rows of each table are read a page at a time and inserted through the
+    connection (see insert_query_m) with the ids offset by the current maximum ids of the database.
+
+    Args:
+        conn (connection object): Database connection object to merge into
+        shard_pth (str): Path of the SQLite database to merge
+        db_type (str): Type of database either "sqlite", "mysql", "postgres" or "django_mysql" [default "sqlite"]
+        merged_sources (dict): Dictionary of source name to library_spectra_source id (updated with the merged
+                               sources) [default None]
+        page_size (int): Number of rows inserted at a time [default 10000]
+
+    Returns:
+       Number of spectra merged
+
+    """
+    shard = sqlite3.connect(shard_pth)
+    c = conn.cursor()
+    offsets = {}
+    for table in ('library_spectra_source', 'library_spectra_meta', 'library_spectra', 'library_spectra_annotation'):
+        c.execute('SELECT max(id) FROM {}'.format(table))
+        offsets[table] = c.fetchall()[0][0] or 0
+
+    source_map = {}
+    if merged_sources is not None:
+        for source_id, name in shard.execute('SELECT id, name FROM library_spectra_source').fetchall():
+            if name in merged_sources:
+                source_map[source_id] = merged_sources[name]
+            else:
+                merged_sources[name] = source_id + offsets['library_spectra_source']
+
+    if _table_exists(shard.cursor(), 'main', 'metab_compound_synonym'):
+        create_table(conn, 'metab_compound_synonym', db_type)
+        _merge_synonyms(conn, shard, db_type, page_size)
+
+    spectra = 0
+    for table, rebase in [('metab_compound', {})] + _MERGE_TABLES:
+        if not _table_exists(shard.cursor(), 'main', table):
+            continue
+        columns = [row[1] for row in shard.execute('PRAGMA table_info({})'.format(table)).fetchall()]
+        cn = ', '.join(_quote(col, db_type) for col in columns)
+        shifts = [(i, offsets[rebase[col]]) for i, col in enumerate(columns) if col in rebase]
+        source_col = columns.index('library_spectra_source_id') if 'library_spectra_source_id' in columns else None
+
+        for page in iter_table(shard, table, page_size):
+            if table == 'library_spectra_source':
+                page = [row for row in page if row[0] not in source_map]
+            for row in page:
+                mapped_source = source_map.get(row[source_col]) if source_col is not None else None
+                for i, offset in shifts:
+                    row[i] += offset
+                if mapped_source:
+                    row[source_col] = mapped_source
+            if page:
+                insert_query_m([tuple(row) for row in page], table, conn, columns=cn, db_type=db_type,
+                               ignore_conflicts=table == 'metab_compound')
+            if table == 'library_spectra_meta':
+                spectra += len(page)
+
+    shard.close()
+    conn.commit()
+    return spectra
+
+
+def split_msp(msp_pth, n, out_dir):
+    """ Split a MSP file into (roughly) equal sized files at record boundaries
+
+    Args:
+        msp_pth (str): Path to the MSP file
+        n (int): Number of files
+        out_dir (str): Directory for the split files (created if it does not exist)
+
+    Returns:
+       list of the paths of the split files
+
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    size = os.path.getsize(msp_pth)
+    with io.open(msp_pth, 'rb') as f:
+        # find the start of the first record after each approximate boundary
+        starts = [0]
+        for k in range(1, n):
+            f.seek(max(size * k // n, starts[-1]))
+            f.readline()
+            for line in iter(f.readline, b''):
+                if line.strip() in (b'', b'//'):
+                    break
+            # skip any further blank lines between the records
+            start = f.tell()
+            while f.readline().strip() == b'' and f.tell() < size:
+                start = f.tell()
+            f.seek(start)
+            if f.tell() < size:
+                starts.append(f.tell())
+        ends = starts[1:] + [size]
+
+        pths = []
+        for i, (start, end) in enumerate(zip(starts, ends)):
+            if end <= start:
+                continue
+            pth = os.path.join(out_dir, '{}_{}{}'.format(i, *os.path.splitext(os.path.basename(msp_pth))))
+            f.seek(start)
+            with io.open(pth, 'wb') as out:
+                remaining = end - start
+                while remaining:
+                    block = f.read(min(remaining, 1 << 20))
+                    out.write(block)
+                    remaining -= len(block)
+            pths.append(pth)
+
+    return pths
+
+
+def _import_shard(task):
+    """ Import a source (or shard of a source) into its own SQLite database (used by the worker processes)
+    """
+    shard_pth, kwargs = task
+    start = time.time()
+    create_db(shard_pth)
+    libdata = LibraryData(db_pth=shard_pth, db_type='sqlite', checkpoint=False, **kwargs)
+    libdata.close()
+    return shard_pth, time.time() - start
+
+
+def _quote(column, db_type):
+    if db_type in ('mysql', 'django_mysql'):
+        return '`{}`'.format(column)
+    return '"{}"'.format(column)
+
+
+def _merge_synonyms(conn, shard, db_type, page_size):
+    """ Insert the names and synonyms of the compounds of a shard that are not already in the database (called before
+    the compounds are merged)
+    """
+    type_sign = '?' if db_type == 'sqlite' else '%s'
+    c = conn.cursor()
+    for page in iter_table(shard, 'metab_compound_synonym', page_size, columns=SYNONYM_COLUMNS.split(', ')):
+        inchikey_ids = list(set(row[0] for row in page))
+        c.execute('SELECT inchikey_id FROM metab_compound WHERE inchikey_id IN ({})'.format(
+            ', '.join([type_sign] * len(inchikey_ids))), inchikey_ids)
+        existing = set(row[0] for row in c.fetchall())
+        insert_synonyms(conn, [tuple(row) for row in page if row[0] not in existing], db_type)
+
+
+def _table_exists(c, schema, table):
+    c.execute("SELECT count(*) FROM {}.sqlite_master WHERE type = 'table' AND name = ?".format(schema), (table,))
+    return c.fetchone()[0] > 0
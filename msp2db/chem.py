@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+from __future__ import absolute_import, unicode_literals, print_function
+import multiprocessing
+
+try:
+    from rdkit import Chem, RDLogger
+    from rdkit.Chem.rdMolDescriptors import CalcMolFormula, CalcExactMolWt
+    # RDKit is very verbose about structures it can't parse, the parser will just fall back to the other lookups
+    RDLogger.DisableLog('rdApp.*')
+    RDKIT_AVAILABLE = True
+except ImportError:
+    RDKIT_AVAILABLE = False
+
+_structure_cache = {}
+
+
+def structure_info(smiles=None, inchi=None):
+    """ Derive the InChIKey, molecular formula and exact mass of a compound from its structure (SMILES or InChI)
+
+    Requires RDKit to be installed. The InChI is used in preference to the SMILES (as the InChIKey is derived directly
+    from the InChI). Results are stored in a memo cache so a structure is only ever evaluated once per process.
+
+    Example:
+        >>> from msp2db.chem import structure_info
+        >>> structure_info(smiles='CC1CC2=C(C(=CC=C2)O)C(=O)O1')
+        {'inchikey_id': 'KWILGNNWGSNMPA-UHFFFAOYSA-N', 'molecular_formula': 'C10H10O3', 'exact_mass': 178.062994}
+
+    Args:
+        smiles (str): SMILES string [default None]
+        inchi (str): InChI string (e.g. InChI=1S/C10H10O3/...) [default None]
+
+    Returns:
+       dictionary with the keys 'inchikey_id', 'molecular_formula' and 'exact_mass' or None if the structure could not
+       be evaluated (or RDKit is not available)
+
+    """
+    if not RDKIT_AVAILABLE:
+        return None
+
+    for structure_type, structure in (('inchi', inchi), ('smiles', smiles)):
+        if not structure:
+            continue
+
+        key = (structure_type, structure)
+        if key not in _structure_cache:
+            _structure_cache[key] = _derive_structure_info(key)
+
+        if _structure_cache[key]:
+            return _structure_cache[key]
+
+    return None
+
+
+def structure_info_batch(structures, processes=None):
+    """ Evaluate a batch of structures in a pool of worker processes and store the results in the memo cache
+
+    Structures already in the cache (or repeated in the batch) are only evaluated once. Subsequent calls of
+    structure_info for any of the structures will then be a cache lookup.
+
+    Example:
+        >>> from msp2db.chem import structure_info_batch
+        >>> structure_info_batch([('smiles', 'CC1CC2=C(C(=CC=C2)O)C(=O)O1'), ('inchi', 'InChI=1S/CH4/h1H4')])
+
+    Args:
+        structures (list): List of tuples of the structure type (either 'smiles' or 'inchi') and the structure
+        processes (int): Number of worker processes to use (by default uses the number of cpus) [default None]
+
+    Returns:
+       list of the derived dictionaries (or None) in the same order as the structures
+
+    """
+    if not RDKIT_AVAILABLE:
+        return [None] * len(structures)
+
+    todo = []
+    seen = set()
+    for key in structures:
+        if key[1] and key not in _structure_cache and key not in seen:
+            seen.add(key)
+            todo.append(key)
+
+    if len(todo) > 1 and processes != 1:
+        pool = multiprocessing.Pool(processes=processes)
+        try:
+            results = pool.map(_derive_structure_info, todo)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_derive_structure_info(key) for key in todo]
+
+    _structure_cache.update(zip(todo, results))
+
+    return [_structure_cache.get(key) for key in structures]
+
+
+def clear_structure_cache():
+    """ Remove all previously derived structures from the memo cache
+    """
+    _structure_cache.clear()
+
+
+def _derive_structure_info(key):
+    """ Derive the compound details for a single (structure type, structure) tuple (used by the worker processes)
+    """
+    structure_type, structure = key
+    try:
+        if structure_type == 'inchi':
+            mol = Chem.MolFromInchi(structure)
+        else:
+            mol = Chem.MolFromSmiles(structure)
+
+        if mol is None:
+            return None
+
+        inchikey = Chem.MolToInchiKey(mol)
+    except Exception as e:
+        print(e)
+        return None
+
+    if not inchikey:
+        return None
+
+    return {'inchikey_id': inchikey,
+            'molecular_formula': CalcMolFormula(mol),
+            'exact_mass': round(CalcExactMolWt(mol), 6)}
@@ -1,9 +1,73 @@
 #!/usr/bin/env python
 from __future__ import absolute_import, unicode_literals, print_function
+import contextlib
+import io
+import itertools
+import os
+import re
 import sqlite3
 import sys
+import tempfile
+import time
+import six
 
-def create_db(file_pth):
+# tables used to keep track of imports and the per spectrum summaries (created by create_db, or by create_table for
+# older databases)
+_IMPORT_TABLES = [('library_import_progress', '''CREATE TABLE library_import_progress (
+                          id integer PRIMARY KEY,
+                          library_spectra_source_id integer NOT NULL,
+                          msp_pth text,
+                          source_file text,
+                          byte_offset bigint,
+                          record_ordinal integer,
+                          next_meta_id integer,
+                          next_spectra_id integer,
+                          next_spectra_annotation_id integer,
+                          status text,
+                          updated_at text
+                          )'''),
+                  ('library_spectra_hash', '''CREATE TABLE library_spectra_hash (
+                          library_spectra_meta_id integer PRIMARY KEY,
+                          source text NOT NULL,
+                          accession text,
+                          content_hash text NOT NULL,
+                          FOREIGN KEY (library_spectra_meta_id) REFERENCES library_spectra_meta(id)
+                          )'''),
+                  ('library_spectra_summary', '''CREATE TABLE library_spectra_summary (
+                          library_spectra_meta_id integer PRIMARY KEY,
+                          num_peaks integer NOT NULL,
+                          base_peak_mz real,
+                          base_peak_intensity real,
+                          tic real,
+                          min_mz real,
+                          max_mz real,
+                          norm_factor real,
+                          FOREIGN KEY (library_spectra_meta_id) REFERENCES library_spectra_meta(id)
+                          )'''),
+                  ('metab_compound_synonym', '''CREATE TABLE metab_compound_synonym (
+                          inchikey_id text NOT NULL,
+                          synonym text NOT NULL,
+                          synonym_key text NOT NULL,
+                          is_name integer NOT NULL,
+                          FOREIGN KEY (inchikey_id) REFERENCES metab_compound(inchikey_id)
+                          )''')]
+
+# indexes of the tables created by create_table (spectra are filtered by their summary, see msp2db.summary, and
+# compounds are found by the prefix of a name, see msp2db.synonyms)
+_TABLE_INDEXES = {
+    'library_spectra_summary': [
+        ('library_spectra_summary_peaks_idx', 'library_spectra_summary (num_peaks, base_peak_intensity)'),
+        ('library_spectra_summary_base_peak_idx', 'library_spectra_summary (base_peak_mz)'),
+        ('library_spectra_summary_tic_idx', 'library_spectra_summary (tic)')],
+    'metab_compound_synonym': [
+        ('metab_compound_synonym_inchikey_idx', 'metab_compound_synonym (inchikey_id)'),
+        ('metab_compound_synonym_key_idx', 'metab_compound_synonym (synonym_key)')]}
+
+# full-text index of the compound names and synonyms (an FTS5 table for SQLite, see msp2db.synonyms)
+SYNONYM_FTS_TABLE = 'metab_compound_synonym_fts'
+
+
+def create_db(file_pth=None, db_type='sqlite', conn=None):
     """ Create an empty SQLite database for library spectra.
 
     Example:
@@ -11,24 +75,27 @@ def create_db(file_pth):
         >>> db_pth = 'library.db'
         >>> create_db(file_pth=db_pth)
 
+    The tables can also be created in a MySQL or PostgreSQL database by providing the connection (see get_connection)
+
     Args:
         file_pth (str): File path for SQLite database
+        db_type (str): Type of database either "sqlite", "mysql", "postgres" or "django_mysql" (for Django the
+                       statements are converted for the database vendor of the connection) [default "sqlite"]
+        conn (connection object): Database connection object (required if not using SQLite) [default None]
 
     """
-    conn = sqlite3.connect(file_pth)
+    if conn is None:
+        conn = sqlite3.connect(file_pth)
+    db_type = _ddl_db_type(conn, db_type)
     c = conn.cursor()
 
-    c.execute('DROP TABLE IF EXISTS library_spectra_source')
-    c.execute('''CREATE TABLE library_spectra_source (
+    tables = [('library_spectra_source', '''CREATE TABLE library_spectra_source (
                           id integer PRIMARY KEY,
                           name text NOT NULL,
                           created_at date,
                           parsing_software text
-                          )'''
-              )
-
-    c.execute('DROP TABLE IF EXISTS metab_compound')
-    c.execute('''CREATE TABLE metab_compound (
+                          )'''),
+              ('metab_compound', '''CREATE TABLE metab_compound (
                   inchikey_id text PRIMARY KEY,
                   name text,
                   pubchem_id text,
@@ -42,10 +109,8 @@ def create_db(file_pth):
                   created_at date,
                   updated_at date
 
-                                           )''')
-
-    c.execute('DROP TABLE IF EXISTS library_spectra_meta')
-    c.execute('''CREATE TABLE library_spectra_meta (
+                                           )'''),
+              ('library_spectra_meta', '''CREATE TABLE library_spectra_meta (
                                    id integer PRIMARY KEY,
                                    name text,
                                    collision_energy text,
@@ -70,34 +135,195 @@ def create_db(file_pth):
                                    inchikey_id text NOT NULL,
                                    FOREIGN KEY(library_spectra_source_id) REFERENCES library_spectra_source(id),
                                    FOREIGN KEY(inchikey_id) REFERENCES metab_compound(inchikey_id)
-                                   )'''
-              )
-
-    c.execute('DROP TABLE IF EXISTS library_spectra')
-    c.execute('''CREATE TABLE library_spectra (
+                                   )'''),
+              ('library_spectra', '''CREATE TABLE library_spectra (
                                           id integer PRIMARY KEY,
                                           mz real NOT NULL,
                                           i real NOT NULL,
                                           other text,
                                           library_spectra_meta_id integer NOT NULL,
                                           FOREIGN KEY (library_spectra_meta_id) REFERENCES library_spectra_meta(id)
-                                          )'''
-              )
-
-    c.execute('DROP TABLE IF EXISTS library_spectra_annotation')
-    c.execute('''CREATE TABLE library_spectra_annotation (
+                                          )'''),
+              ('library_spectra_annotation', '''CREATE TABLE library_spectra_annotation (
                                           id integer PRIMARY KEY,
                                           mz real,
                                           tentative_formula text,
                                           mass_error real,
                                           library_spectra_meta_id integer NOT NULL,
                                           FOREIGN KEY (library_spectra_meta_id) REFERENCES library_spectra_meta(id)
-                                          )'''
-              )
+                                          )''')] + _IMPORT_TABLES
+
+    # drop in reverse order so that the foreign keys are not violated (if enforced by the database)
+    if db_type == 'sqlite':
+        c.execute('DROP TABLE IF EXISTS {}'.format(SYNONYM_FTS_TABLE))
+    for table, _ in reversed(tables):
+        c.execute('DROP TABLE IF EXISTS {}'.format(table))
+
+    for table, stmt in tables:
+        c.execute(_convert_ddl(stmt, db_type))
+
+    # the peaks are read per spectrum (e.g. see iter_spectra)
+    c.execute('CREATE INDEX library_spectra_meta_id_idx ON library_spectra (library_spectra_meta_id)')
+    # spectra are searched by precursor m/z (e.g. see msp2db.query.query_precursor_sql)
+    c.execute('CREATE INDEX library_spectra_meta_precursor_idx ON library_spectra_meta (precursor_mz, retention_time)')
+    for indexes in _TABLE_INDEXES.values():
+        for name, on in indexes:
+            c.execute('CREATE INDEX {} ON {}'.format(name, _convert_index(on, db_type)))
+    _create_synonym_fulltext(c, db_type)
+
+    conn.commit()
+
+
+def create_table(conn, table, db_type='sqlite'):
+    """ Create one of the tables added since the original schema (library_import_progress, library_spectra_hash,
+    library_spectra_summary or metab_compound_synonym) if it does not already exist (and its indexes)
+
+    Databases created with older versions of msp2db will not have the tables.
+
+    Example:
+        >>> from msp2db.db import get_connection, create_table
+        >>> conn = get_connection('sqlite', 'library.db')
+        >>> create_table(conn, 'library_import_progress')
+
+    Args:
+        conn (connection object): Database connection object
+        table (str): Name of the table
+        db_type (str): Type of database either "sqlite", "mysql", "postgres" or "django_mysql" [default "sqlite"]
+
+    """
+    db_type = _ddl_db_type(conn, db_type)
+    stmt = dict(_IMPORT_TABLES)[table]
+    c = conn.cursor()
+    c.execute(_convert_ddl(stmt, db_type).replace('CREATE TABLE', 'CREATE TABLE IF NOT EXISTS', 1))
+    for name, on in _TABLE_INDEXES.get(table, []):
+        if db_type in ('mysql', 'django_mysql'):
+            # MySQL does not have CREATE INDEX IF NOT EXISTS
+            if not _mysql_index_exists(c, name):
+                c.execute('CREATE INDEX {} ON {}'.format(name, _convert_index(on, db_type)))
+        else:
+            c.execute('CREATE INDEX IF NOT EXISTS {} ON {}'.format(name, on))
+    if table == 'metab_compound_synonym':
+        _create_synonym_fulltext(c, db_type)
+    conn.commit()
+
+
+def _create_synonym_fulltext(c, db_type):
+    """ Create the full-text index of the compound names and synonyms (if it does not already exist)
+
+    For SQLite an FTS5 table (filled with the metab_compound_synonym rows, see msp2db.synonyms.insert_synonyms), for
+    MySQL a FULLTEXT index and for PostgreSQL a GIN index of the synonym tsvector.
+    """
+    if db_type == 'sqlite':
+        try:
+            c.execute('CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5(synonym, inchikey_id UNINDEXED)'.format(
+                SYNONYM_FTS_TABLE))
+        except sqlite3.OperationalError:
+            print('SQLite FTS5 is not available, compound names will be searched without a full-text index')
+    elif db_type in ('mysql', 'django_mysql'):
+        if not _mysql_index_exists(c, 'metab_compound_synonym_fulltext_idx'):
+            c.execute('CREATE FULLTEXT INDEX metab_compound_synonym_fulltext_idx ON metab_compound_synonym (synonym)')
+    elif db_type == 'postgres':
+        c.execute("CREATE INDEX IF NOT EXISTS metab_compound_synonym_fulltext_idx ON metab_compound_synonym "
+                  "USING gin (to_tsvector('simple', synonym))")
+
+
+def _mysql_index_exists(c, name):
+    c.execute('SELECT count(*) FROM information_schema.statistics WHERE table_schema = DATABASE() '
+              'AND index_name = %s', (name,))
+    return bool(c.fetchall()[0][0])
+
+
+def _convert_index(on, db_type):
+    """ Convert the (SQLite) columns of an index to the SQL dialect of another database
+    """
+    if db_type in ('mysql', 'django_mysql'):
+        # text columns can only be indexed by a prefix in MySQL
+        on = on.replace('(synonym_key)', '(synonym_key(191))')
+    return on
+
+
+def delete_spectra(conn, meta_ids, db_type='sqlite', batch_size=500):
+    """ Delete spectra (the library_spectra_meta rows and their peaks, annotations, hashes and summaries) from the
+    database
+
+    The compounds are not deleted (they may be used by other spectra)
+
+    Example:
+        >>> from msp2db.db import get_connection, delete_spectra
+        >>> conn = get_connection('sqlite', 'library.db')
+        >>> delete_spectra(conn, [1, 2, 3])
+
+    Args:
+        conn (connection object): Database connection object
+        meta_ids (list): The ids of the library_spectra_meta rows
+        db_type (str): Type of database either "sqlite", "mysql", "postgres" or "django_mysql" [default "sqlite"]
+        batch_size (int): Number of ids deleted in each statement [default 500]
+
+    """
+    create_table(conn, 'library_spectra_hash', db_type)
+    create_table(conn, 'library_spectra_summary', db_type)
+    type_sign = '?' if db_type == 'sqlite' else '%s'
+    c = conn.cursor()
+
+    # the rows referencing the meta rows are deleted first
+    tables = [('library_spectra_hash', 'library_spectra_meta_id'),
+              ('library_spectra_summary', 'library_spectra_meta_id'),
+              ('library_spectra', 'library_spectra_meta_id'),
+              ('library_spectra_annotation', 'library_spectra_meta_id'),
+              ('library_spectra_meta', 'id')]
+
+    for i in range(0, len(meta_ids), batch_size):
+        batch = list(meta_ids[i:i + batch_size])
+        for table, column in tables:
+            c.execute('DELETE FROM {} WHERE {} IN ({})'.format(table, column, ', '.join([type_sign] * len(batch))),
+                      batch)
+    conn.commit()
+
+
+def _ddl_db_type(conn, db_type):
+    """ The SQL dialect of the create table statements, for Django the dialect of the database vendor (the
+    SQLite statements are used as they are for other vendors)
+    """
+    if db_type not in ('django_mysql', 'django'):
+        return db_type
+    vendor = getattr(conn, 'vendor', None)
+    if vendor == 'mysql' or (vendor is None and db_type == 'django_mysql'):
+        return 'mysql'
+    elif vendor == 'postgresql':
+        return 'postgres'
+    return 'django'
 
 
-def get_connection(db_type, db_pth, user=None, password=None, name=None):
-    """ Get a connection to a SQL database. Can be used for SQLite, MySQL or Django MySQL database
+def _convert_ddl(stmt, db_type):
+    """ Convert the (SQLite) create table statements to the SQL dialect of another database
+
+    Args:
+        stmt (str): SQLite CREATE TABLE statement
+        db_type (str): Type of database
+
+    Returns:
+       CREATE TABLE statement for db_type
+    """
+    if db_type in ('mysql', 'django_mysql'):
+        # text columns can't be used as keys in MySQL and "column" is a reserved word
+        stmt = stmt.replace('inchikey_id text', 'inchikey_id varchar(255)')
+        stmt = stmt.replace(' column text', ' `column` text')
+        stmt = stmt.replace('real', 'double')
+        # polarity is stored as text (e.g. "positive") which SQLite allows in an integer column
+        stmt = stmt.replace('polarity integer', 'polarity text')
+    elif db_type == 'postgres':
+        stmt = stmt.replace(' column text', ' "column" text')
+        stmt = stmt.replace('real', 'double precision')
+        stmt = stmt.replace('polarity integer', 'polarity text')
+        # ids are still provided by msp2db but identity columns allow other clients to insert without them
+        # (only the id columns, not the primary keys that reference another table e.g. library_spectra_meta_id)
+        stmt = re.sub(r'(^|[\s(,])id integer PRIMARY KEY', r'\1id integer GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY',
+                      stmt)
+    return stmt
+
+
+def get_connection(db_type, db_pth, user=None, password=None, name=None, local_infile=False, host=None, port=None):
+    """ Get a connection to a SQL database. Can be used for SQLite, MySQL, PostgreSQL or Django MySQL database
 
     Example:
         >>> from msp2db.db import get_connection
@@ -105,10 +331,22 @@ def get_connection(db_type, db_pth, user=None, password=None, name=None):
 
     If using "mysql" mysql.connector needs to be installed.
 
-    If using "django_mysql" Django needs to be installed.
+    If using "postgres" psycopg2 needs to be installed. The db_pth can be used for a libpq connection string
+    (e.g. 'postgresql://user@localhost/library') instead of the user, password, name, host and port.
+
+    If using "django_mysql" (or "django") Django needs to be installed, the default Django database connection is
+    used (whatever the database vendor).
 
     Args:
-        db_type (str): Type of database can either be "sqlite", "mysql" or "django_mysql"
+        db_type (str): Type of database can either be "sqlite", "mysql", "postgres", "django_mysql" or "django"
+        db_pth (str): File path for SQLite database (or connection string for PostgreSQL)
+        user (str): Username for database (only required for non Django mysql databases) [default None]
+        password (str): Password for database (only required for non Django mysql databases) [default None]
+        name (str): Name of the mysql database (only required for non Django mysql databases) [default None]
+        local_infile (boolean): Allow LOAD DATA LOCAL INFILE for the MySQL connection (required for the
+                                'load_data' bulk insert method) [default False]
+        host (str): Host of the MySQL or PostgreSQL server [default None]
+        port (int): Port of the MySQL or PostgreSQL server [default None]
 
 
     Returns:
@@ -120,16 +358,25 @@ def get_connection(db_type, db_pth, user=None, password=None, name=None):
         conn = sqlite3.connect(db_pth)
     elif db_type == 'mysql':
         import mysql.connector
-        conn = mysql.connector.connect(user=user, password=password, database=name)
-    elif db_type == 'django_mysql':
+        kwargs = {k: v for k, v in (('host', host), ('port', port)) if v}
+        conn = mysql.connector.connect(user=user, password=password, database=name,
+                                       allow_local_infile=local_infile, **kwargs)
+    elif db_type == 'postgres':
+        import psycopg2
+        if db_pth:
+            conn = psycopg2.connect(db_pth)
+        else:
+            conn = psycopg2.connect(user=user, password=password, dbname=name, host=host, port=port)
+    elif db_type in ('django_mysql', 'django'):
         from django.db import connection as conn
     else:
-        print('unsupported database type: {}, choices are "sqlite", "mysql" or "django_mysql"'.format(db_type))
+        print('unsupported database type: {}, choices are "sqlite", "mysql", "postgres" or "django_mysql"'.format(
+            db_type))
 
     return conn
 
 
-def db_dict(c):
+def db_dict(c, page_size=10000):
     """ Get a dictionary of the library spectra from a database
 
     Example:
@@ -137,10 +384,12 @@ def db_dict(c):
         >>> conn = get_connection('sqlite', 'library.db')
         >>> test_db_d = db_dict(conn.cursor())
 
-    If using a large database the resulting dictionary will be very large!
+    If using a large database the resulting dictionary will be very large! Use iter_table or iter_spectra to
+    stream the rows in pages instead.
 
     Args:
         c (cursor): SQL database connection cursor
+        page_size (int): Number of rows fetched from the cursor at a time [default 10000]
 
     Returns:
        A dictionary with the following keys 'library_spectra', 'library_spectra_meta', 'library_spectra_annotations',
@@ -149,62 +398,229 @@ def db_dict(c):
 
     """
     db_d = {}
-    c.execute('SELECT * FROM library_spectra')
-    db_d['library_spectra'] = [list(row) for row in c]
+    for key, table in [('library_spectra', 'library_spectra'),
+                       ('library_spectra_meta', 'library_spectra_meta'),
+                       ('library_spectra_annotations', 'library_spectra_annotation'),
+                       ('library_spectra_source', 'library_spectra_source'),
+                       ('metab_compound', 'metab_compound')]:
+        c.execute('SELECT * FROM {}'.format(table))
+        db_d[key] = [list(row) for page in _fetch_pages(c, page_size) for row in page]
 
-    c.execute('SELECT * FROM library_spectra_meta')
-    db_d['library_spectra_meta'] = [list(row) for row in c]
+    return db_d
 
-    c.execute('SELECT * FROM library_spectra_annotation')
-    db_d['library_spectra_annotations'] = [list(row) for row in c]
 
-    c.execute('SELECT * FROM library_spectra_source')
-    db_d['library_spectra_source'] = [list(row) for row in c]
+def iter_table(conn, table, page_size=10000, db_type='sqlite', output='list', columns=None, order_by=None):
+    """ Iterate through the rows of a table in fixed size pages
 
-    c.execute('SELECT * FROM metab_compound')
-    db_d['metab_compound'] = [list(row) for row in c]
+    Only a single page is held in memory at a time. For MySQL and PostgreSQL a server side cursor is used so the
+    rows are not all transferred to the client when the query is executed.
 
-    return db_d
+    Example:
+        >>> from msp2db.db import get_connection, iter_table
+        >>> conn = get_connection('sqlite', 'library.db')
+        >>> for page in iter_table(conn, 'library_spectra', page_size=50000, output='numpy'):
+        >>>     print(page['mz'].max())
+
+    Args:
+        conn (connection object): Database connection object
+        table (str): Name of the table
+        page_size (int): Maximum number of rows in each page [default 10000]
+        db_type (str): Type of database (sqlite, mysql, postgres or django_mysql) [default "sqlite"]
+        output (str): Type of each page either "list" (list of lists), "numpy" (numpy record array) or "pandas"
+                      (pandas DataFrame) [default "list"]
+        columns (list): Columns to select (all columns if None) [default None]
+        order_by (str): Column(s) to order the rows by [default None]
+
+    Returns:
+       generator of pages of rows
+
+    """
+    sql = 'SELECT {} FROM {}'.format(', '.join(columns) if columns else '*', table)
+    if order_by:
+        sql += ' ORDER BY {}'.format(order_by)
 
+    c = _stream_cursor(conn, db_type, page_size)
+    try:
+        c.execute(sql)
+        names = None
+        for page in _fetch_pages(c, page_size):
+            if names is None:
+                names = [d[0] for d in c.description]
+            yield _format_page(page, names, output)
+    finally:
+        c.close()
 
-def insert_query_m(data, table, conn, columns=None, db_type='mysql'):
+
+def iter_spectra(conn, page_size=1000, db_type='sqlite', peaks_output='list'):
+    """ Iterate through the spectra (the library_spectra_meta rows joined with their peaks) in fixed size pages
+
+    Example:
+        >>> from msp2db.db import get_connection, iter_spectra
+        >>> conn = get_connection('sqlite', 'library.db')
+        >>> for page in iter_spectra(conn, page_size=500):
+        >>>     for spectrum in page:
+        >>>         print(spectrum['accession'], len(spectrum['peaks']))
+
+    Args:
+        conn (connection object): Database connection object
+        page_size (int): Maximum number of spectra in each page [default 1000]
+        db_type (str): Type of database (sqlite, mysql, postgres or django_mysql) [default "sqlite"]
+        peaks_output (str): Type of the peaks either "list" (list of (mz, i) tuples) or "numpy" (n x 2 array)
+                            [default "list"]
+
+    Returns:
+       generator of pages, each page is a list of dictionaries of the library_spectra_meta columns with an
+       additional 'peaks' key
+
+    """
+    sql = 'SELECT m.*, s.mz AS peak_mz, s.i AS peak_i FROM library_spectra_meta m ' \
+          'LEFT JOIN library_spectra s ON s.library_spectra_meta_id = m.id ORDER BY m.id, s.id'
+
+    c = _stream_cursor(conn, db_type, page_size)
+    try:
+        c.execute(sql)
+        names = None
+        spectra = []
+        current = None
+        for rows in _fetch_pages(c, page_size * 10):
+            if names is None:
+                names = [d[0] for d in c.description][:-2]
+            for row in rows:
+                if current is None or current['id'] != row[0]:
+                    if current is not None:
+                        spectra.append(current)
+                        if len(spectra) == page_size:
+                            yield _format_spectra(spectra, peaks_output)
+                            spectra = []
+                    current = dict(zip(names, row[:-2]))
+                    current['peaks'] = []
+                if row[-2] is not None:
+                    current['peaks'].append((row[-2], row[-1]))
+
+        if current is not None:
+            spectra.append(current)
+        if spectra:
+            yield _format_spectra(spectra, peaks_output)
+    finally:
+        c.close()
+
+
+def _format_spectra(spectra, peaks_output):
+    if peaks_output == 'numpy':
+        import numpy as np
+        for spectrum in spectra:
+            spectrum['peaks'] = np.array(spectrum['peaks'], dtype=float).reshape(-1, 2)
+    return spectra
+
+
+def _stream_cursor(conn, db_type, page_size):
+    """ Get a cursor that does not transfer the full result set to the client when a query is executed
+    """
+    if db_type == 'postgres':
+        # named cursors are server side cursors in psycopg2
+        c = conn.cursor(name='msp2db_stream_{}'.format(id(object())))
+        c.itersize = page_size
+        return c
+    elif db_type == 'mysql':
+        # unbuffered (the rows are read from the server as they are fetched). Note no other query can be run on the
+        # connection until all the rows have been fetched
+        return conn.cursor(buffered=False)
+    return conn.cursor()
+
+
+def _fetch_pages(c, page_size):
+    """ Fetch the results of an executed cursor in pages using fetchmany
+    """
+    while True:
+        rows = c.fetchmany(page_size)
+        if not rows:
+            break
+        yield rows
+
+
+def _format_page(rows, names, output):
+    if output == 'numpy':
+        import numpy as np
+        return np.rec.fromrecords([tuple(r) for r in rows], names=names)
+    elif output == 'pandas':
+        import pandas as pd
+        return pd.DataFrame.from_records(rows, columns=names)
+    return [list(r) for r in rows]
+
+
+def insert_query_m(data, table, conn, columns=None, db_type='mysql', bulk=None, chunk_size=10000,
+                   ignore_conflicts=False):
     """ Insert python list of tuples into SQL table
 
+    For MySQL databases a faster bulk insert method can be used, either "load_data" (the data is streamed from a
+    temporary file with LOAD DATA LOCAL INFILE, the connection needs local_infile, see get_connection) or "multirow"
+    (multi-row INSERT statements sized to the max_allowed_packet of the server).
+
+    For PostgreSQL databases the rows are always streamed with COPY ... FROM STDIN.
+
+    For Django databases the rows are inserted with multi-row INSERT statements (batch sized by the Django database
+    backend) inside a single transaction.atomic block.
+
     Args:
         data (list): List of tuples
         table (str): Name of database table
         conn (connection object): database connection object
         columns (str): String of column names to use if not assigned then all columns are presumed to be used [Optional]
         db_type (str): If "sqlite" or "mysql"
+        bulk (str): MySQL bulk insert method either "load_data" or "multirow" [default None]
+        chunk_size (int): Number of rows to insert (and commit) at a time when not using a bulk method
+                          [default 10000]
+        ignore_conflicts (boolean): Skip rows that conflict with a unique key already in the table (e.g. compounds
+                                    already in the database) [default False]
+
+    Returns:
+       rows inserted per second
 
     """
-    # if length of data is very large we need to break into chunks the insert_query_m is then used recursively untill
-    # all data has been inserted
-    if len(data) > 10000:
-        _chunk_query(data, 10000, columns, conn, table, db_type)
+    start = time.time()
+
+    if db_type == 'postgres':
+        _copy_insert_postgres(data, table, conn, columns, ignore_conflicts)
+    elif db_type in ('django_mysql', 'django'):
+        _insert_django(data, table, conn, columns, ignore_conflicts)
+    elif db_type == 'mysql' and bulk == 'load_data':
+        _load_data_mysql(data, table, conn, columns, ignore_conflicts)
+    elif db_type == 'mysql' and bulk == 'multirow':
+        _multirow_insert_mysql(data, table, conn, columns, ignore_conflicts)
+    elif bulk:
+        raise ValueError('unsupported bulk insert method {} for database type {}'.format(bulk, db_type))
     else:
-        # sqlite and mysql have type string (? or %s) reference to use
-        if db_type == 'sqlite':
-            type_sign = '?'
-        else:
-            type_sign = '%s'
-        # create a string of types for the insertion string (e.g. ?,?,? if inserting 3 columns of data)
-        type_com = type_sign + ", "
-        type = type_com * (len(data[0]) - 1)
-        type = type + type_sign
+        # if length of data is very large we need to break into chunks
+        _chunk_query(data, chunk_size, columns, conn, table, db_type, ignore_conflicts)
 
-        # if using specific columns to insert data
-        if columns:
-            stmt = "INSERT INTO " + table + "( " + columns + ") VALUES (" + type + ")"
-        else:
-            stmt = "INSERT INTO " + table + " VALUES (" + type + ")"
+    seconds = time.time() - start
+    return len(data) / seconds if seconds else float('inf')
+
+
+def _insert_stmt(table, columns, ncol, type_sign, insert='INSERT'):
+    """ Create the INSERT statement for a table
+
+    Args:
+        table (str): Table name
+        columns (str): Column names (if None all columns are presumed to be used)
+        ncol (int): Number of columns
+        type_sign (str): parameter reference for the database (? or %s)
+        insert (str): The insert command e.g. "INSERT" or "INSERT OR IGNORE" [default "INSERT"]
+
+    Returns:
+       INSERT statement
+    """
+    # create a string of types for the insertion string (e.g. ?,?,? if inserting 3 columns of data)
+    type = ", ".join([type_sign] * ncol)
+
+    # if using specific columns to insert data
+    if columns:
+        return insert + " INTO " + table + "( " + columns + ") VALUES (" + type + ")"
+    else:
+        return insert + " INTO " + table + " VALUES (" + type + ")"
 
-        # execute query
-        cursor = conn.cursor()
-        cursor.executemany(stmt, data)
-        conn.commit()
 
-def _chunk_query(l, n, cn, conn, table, db_type):
+def _chunk_query(l, n, cn, conn, table, db_type, ignore_conflicts=False):
     """ Call for inserting SQL query in chunks based on n rows
 
     Args:
@@ -214,10 +630,296 @@ def _chunk_query(l, n, cn, conn, table, db_type):
         conn (connection object): Database connection object
         table (str): Table name
         db_type (str): If "sqlite" or "mysql"
+        ignore_conflicts (boolean): Skip rows that conflict with a unique key already in the table
+
+    """
+    if not l:
+        return
+
+    # sqlite and mysql have type string (? or %s) reference to use
+    if db_type == 'sqlite':
+        type_sign = '?'
+        insert = 'INSERT OR IGNORE' if ignore_conflicts else 'INSERT'
+    else:
+        type_sign = '%s'
+        insert = 'INSERT IGNORE' if ignore_conflicts else 'INSERT'
+
+    stmt = _insert_stmt(table, cn, len(l[0]), type_sign, insert)
+    cursor = conn.cursor()
+
+    # take each chunk from a single iterator over the list (rather than copying slices of the list), sqlite can
+    # consume the iterator directly
+    rows = iter(l)
+    for i in range(0, len(l), n):
+        chunk = itertools.islice(rows, n)
+        cursor.executemany(stmt, chunk if db_type == 'sqlite' else list(chunk))
+        conn.commit()
+
+
+def _multirow_insert_mysql(data, table, conn, columns, ignore_conflicts=False):
+    """ Insert rows into a MySQL table with multi-row INSERT statements, each sized to fit the max_allowed_packet
+
+    Args:
+        data (list): List of tuples
+        table (str): Table name
+        conn (connection object): Database connection object
+        columns (str): Column names
+        ignore_conflicts (boolean): Skip rows that conflict with a unique key already in the table
+    """
+    if not data:
+        return
+
+    cursor = conn.cursor()
+    cursor.execute('SELECT @@max_allowed_packet')
+    # leave plenty of room for the statement and the escaping of values
+    max_bytes = int(cursor.fetchone()[0] * 0.5)
+
+    base_stmt = _insert_stmt(table, columns, len(data[0]), '%s', 'INSERT IGNORE' if ignore_conflicts else 'INSERT')
+    head, values = base_stmt.split(' VALUES ')
+
+    for batch in _multirow_batches(data, max_bytes):
+        stmt = head + ' VALUES ' + ', '.join([values] * len(batch))
+        cursor.execute(stmt, [v for row in batch for v in row])
+    conn.commit()
+
+
+def _multirow_batches(data, max_bytes):
+    """ Split rows into batches whose (approximate) size in bytes is below max_bytes
+
+    Args:
+        data (list): List of tuples
+        max_bytes (int): Maximum size of each batch
+
+    Returns:
+       generator of lists of tuples
+    """
+    batch = []
+    size = 0
+    for row in data:
+        row_size = sum(len(str(v)) + 4 for v in row) + 4
+        if batch and size + row_size > max_bytes:
+            yield batch
+            batch = []
+            size = 0
+        batch.append(row)
+        size += row_size
+    if batch:
+        yield batch
+
+
+def _load_data_mysql(data, table, conn, columns, ignore_conflicts=False):
+    """ Insert rows into a MySQL table by streaming them through a temporary file with LOAD DATA LOCAL INFILE
+
+    Args:
+        data (list): List of tuples
+        table (str): Table name
+        conn (connection object): Database connection object (requires local_infile)
+        columns (str): Column names
+        ignore_conflicts (boolean): Skip rows that conflict with a unique key already in the table
+    """
+    if not data:
+        return
+
+    fd, tmp_pth = tempfile.mkstemp(suffix='.tsv')
+    try:
+        with io.open(fd, 'w', encoding='utf8', newline='') as f:
+            f.writelines(_tsv_line(row) for row in data)
+
+        stmt = "LOAD DATA LOCAL INFILE '{}' {}INTO TABLE {} CHARACTER SET utf8 FIELDS TERMINATED BY '\\t' " \
+               "ESCAPED BY '\\\\' LINES TERMINATED BY '\\n'".format(tmp_pth.replace('\\', '/'),
+                                                              'IGNORE ' if ignore_conflicts else '', table)
+        if columns:
+            stmt += ' ({})'.format(columns)
+
+        cursor = conn.cursor()
+        cursor.execute(stmt)
+        conn.commit()
+    finally:
+        os.remove(tmp_pth)
 
+
+def _copy_insert_postgres(data, table, conn, columns, ignore_conflicts=False):
+    """ Insert rows into a PostgreSQL table by streaming them with COPY ... FROM STDIN (text format)
+
+    When ignoring conflicts the rows are copied into a temporary staging table first and then inserted with
+    ON CONFLICT DO NOTHING. The identity sequence of the id column is updated to the inserted ids.
+
+    Args:
+        data (list): List of tuples
+        table (str): Table name
+        conn (connection object): Database connection object (psycopg2)
+        columns (str): Column names
+        ignore_conflicts (boolean): Skip rows that conflict with a unique key already in the table
+    """
+    if not data:
+        return
+
+    cursor = conn.cursor()
+    cn = ' ({})'.format(columns) if columns else ''
+    stream = _RowStream(data)
+
+    if ignore_conflicts:
+        stage = '_stage_{}'.format(table)
+        cursor.execute('CREATE TEMP TABLE IF NOT EXISTS {} (LIKE {} INCLUDING DEFAULTS)'.format(stage, table))
+        cursor.copy_expert('COPY {}{} FROM STDIN'.format(stage, cn), stream, size=262144)
+        cursor.execute('INSERT INTO {t}{cn} SELECT {sc} FROM {s} ON CONFLICT DO NOTHING'.format(
+            t=table, cn=cn, sc=columns if columns else '*', s=stage))
+        cursor.execute('TRUNCATE {}'.format(stage))
+    else:
+        cursor.copy_expert('COPY {}{} FROM STDIN'.format(table, cn), stream, size=262144)
+
+    if not columns or columns.split(',')[0].strip().strip('"') == 'id':
+        cursor.execute("SELECT setval(pg_get_serial_sequence('{t}', 'id'), (SELECT max(id) FROM {t}))".format(
+            t=table))
+    conn.commit()
+
+
+def _insert_django(data, table, conn, columns, ignore_conflicts=False):
+    """ Insert rows into a table of a Django database inside a transaction.atomic block
+
+    The rows are inserted with multi-row INSERT statements, each of the number of rows Django would use for a
+    bulk_create on the database (e.g. SQLite is limited in the number of query parameters).
+
+    Args:
+        data (list): List of tuples
+        table (str): Table name
+        conn (connection object): Django database connection (django.db.connection)
+        columns (str): Column names
+        ignore_conflicts (boolean): Skip rows that conflict with a unique key already in the table
     """
-    # For item i in a range that is a length of l,
-    [insert_query_m(l[i:i + n], table, conn, cn, db_type) for i in range(0, len(l), n)]
+    if not data:
+        return
+
+    from django.db import transaction
+
+    ncol = len(data[0])
+    insert = 'INSERT'
+    conflict = ''
+    if ignore_conflicts:
+        if conn.vendor == 'mysql':
+            insert = 'INSERT IGNORE'
+        elif conn.vendor == 'sqlite':
+            insert = 'INSERT OR IGNORE'
+        else:
+            conflict = ' ON CONFLICT DO NOTHING'
+
+    fields = columns.split(',') if columns else [None] * ncol
+    batch_size = max(conn.ops.bulk_batch_size(fields, data), 1)
+
+    head, values = _insert_stmt(table, columns, ncol, '%s', insert).split(' VALUES ')
+
+    with transaction.atomic(using=conn.alias):
+        cursor = conn.cursor()
+        rows = iter(data)
+        for i in range(0, len(data), batch_size):
+            batch = list(itertools.islice(rows, batch_size))
+            stmt = head + ' VALUES ' + ', '.join([values] * len(batch)) + conflict
+            cursor.execute(stmt, [v for row in batch for v in row])
+
+
+@contextlib.contextmanager
+def chunk_transaction(conn, db_type):
+    """ Context manager to insert a chunk of data (to all tables) in a single transaction
+
+    Only used for Django databases (transaction.atomic), so that a chunk is either inserted completely or not at all
+    and each transaction (and any locks held) only lasts for one chunk. For other databases this does nothing.
+
+    Args:
+        conn (connection object): Database connection object
+        db_type (str): Type of database
+    """
+    if db_type not in ('django_mysql', 'django'):
+        yield
+        return
+
+    from django.db import transaction
+    with transaction.atomic(using=conn.alias):
+        yield
+
+
+class _RowStream(object):
+    """File like object that streams rows in the tab separated text format used by COPY (and LOAD DATA INFILE)
+    """
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            lines = [_tsv_line(row) for row in itertools.islice(self.rows, 1000)]
+            if not lines:
+                break
+            self.buffer += ''.join(lines)
+        if size < 0:
+            out, self.buffer = self.buffer, ''
+        else:
+            out, self.buffer = self.buffer[:size], self.buffer[size:]
+        return out
+
+
+def _tsv_line(row):
+    """ Convert a row to a line of the tab separated format used by LOAD DATA INFILE and COPY (NULL is \\N)
+
+    Args:
+        row (tuple): Row of values
+
+    Returns:
+       tab separated line
+    """
+    fields = []
+    for v in row:
+        if v is None:
+            fields.append('\\N')
+            continue
+        if isinstance(v, bytes):
+            v = v.decode('utf8')
+        elif not isinstance(v, six.string_types):
+            v = repr(v) if isinstance(v, float) else str(v)
+        fields.append(v.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r'))
+    return '\t'.join(fields) + '\n'
+
+
+@contextlib.contextmanager
+def bulk_load(conn, tables, db_type='mysql'):
+    """ Context manager to disable the unique and foreign key checks (and the secondary keys of MyISAM tables) of
+    MySQL tables during a load
+
+    The checks are restored (and the keys rebuilt) when the context exits. ALTER TABLE ... DISABLE KEYS is only
+    supported by MyISAM, InnoDB (the default engine) still updates the secondary indexes during the load, so for
+    InnoDB tables only the unique and foreign key checks are disabled. For other databases this does nothing.
+
+    Example:
+        >>> from msp2db.db import get_connection, bulk_load, insert_query_m
+        >>> conn = get_connection('mysql', None, 'user', 'password', 'library', local_infile=True)
+        >>> with bulk_load(conn, ['library_spectra']):
+        >>>     insert_query_m(rows, 'library_spectra', conn, bulk='load_data')
+
+    Args:
+        conn (connection object): Database connection object
+        tables (list): Names of the tables to be loaded
+        db_type (str): Type of database
+    """
+    if db_type != 'mysql':
+        yield
+        return
+
+    cursor = conn.cursor()
+    cursor.execute('SELECT table_name, engine FROM information_schema.tables WHERE table_schema = DATABASE()')
+    engines = {row[0].lower(): (row[1] or '').lower() for row in cursor.fetchall()}
+    myisam_tables = [table for table in tables if engines.get(table.lower()) == 'myisam']
+
+    cursor.execute('SET unique_checks = 0')
+    cursor.execute('SET foreign_key_checks = 0')
+    for table in myisam_tables:
+        cursor.execute('ALTER TABLE {} DISABLE KEYS'.format(table))
+    try:
+        yield
+    finally:
+        for table in myisam_tables:
+            cursor.execute('ALTER TABLE {} ENABLE KEYS'.format(table))
+        cursor.execute('SET unique_checks = 1')
+        cursor.execute('SET foreign_key_checks = 1')
+        conn.commit()
 
 
 def _make_sql_compatible(ll):
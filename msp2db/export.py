@@ -0,0 +1,551 @@
+#!/usr/bin/env python
+from __future__ import absolute_import, unicode_literals, print_function
+import gzip
+import io
+import os
+import numpy as np
+import six
+from six.moves.urllib.parse import quote
+from .db import _stream_cursor, _fetch_pages
+from .query import POLARITY_NAMES, polarity_code
+
+MSP_STYLES = ('mona', 'massbank')
+ARROW_FORMATS = ('parquet', 'arrow')
+PEAK_LAYOUTS = ('list', 'long')
+
+# the columns of the metab_compound table in the Parquet and Arrow exports
+COMPOUND_TABLE_COLUMNS = ['inchikey_id', 'name', 'pubchem_id', 'chemspider_id', 'other_names', 'exact_mass',
+                          'molecular_formula', 'molecular_weight', 'compound_class', 'smiles', 'created_at',
+                          'updated_at']
+
+# repetitive text columns that are dictionary encoded in the Parquet and Arrow exports
+DICTIONARY_COLUMNS = ['collision_energy', 'resolution', 'polarity', 'fragmentation_type', 'precursor_type',
+                      'instrument_type', 'instrument', 'copyright', 'origin', 'compound_class']
+
+_FLOAT_COLUMNS = {'ms_level', 'precursor_mz', 'mass_accuracy', 'mass_error', 'retention_index', 'retention_time',
+                  'exact_mass', 'molecular_weight'}
+_INT_COLUMNS = {'id', 'library_spectra_source_id'}
+
+# directory name of the partition of the spectra without a value (as used by Hive, Spark and pyarrow)
+_NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+
+# the library_spectra_meta and metab_compound columns of the exported records (the name of the compound is
+# compound_name)
+META_COLUMNS = ['id', 'name', 'collision_energy', 'ms_level', 'accession', 'resolution', 'polarity',
+                'fragmentation_type', 'precursor_mz', 'precursor_type', 'instrument_type', 'instrument', 'copyright',
+                'mass_accuracy', 'mass_error', 'origin', 'splash', 'retention_index', 'retention_time',
+                'library_spectra_source_id', 'inchikey_id']
+COMPOUND_COLUMNS = ['compound_name', 'pubchem_id', 'chemspider_id', 'other_names', 'exact_mass',
+                    'molecular_formula', 'molecular_weight', 'compound_class', 'smiles']
+
+# the records are written to the file in blocks of this many records
+_WRITE_BLOCK = 1000
+
+
+def export_where(db_type='sqlite', where=None, polarity=None, **filters):
+    """ Get the WHERE clause (and parameters) of the library_spectra_meta filters of an export
+
+    Example:
+        >>> from msp2db.export import export_where
+        >>> export_where(polarity='positive', ms_level=2, min_precursor_mz=100)
+        ('lower(m.polarity) IN (?, ?, ?, ?) AND m.ms_level = ? AND m.precursor_mz >= ?',
+         ['positive', 'pos', 'p', '+', 2, 100])
+
+    Args:
+        db_type (str): Type of database either "sqlite", "mysql", "postgres" or "django_mysql" [default "sqlite"]
+        where (str): Additional SQL condition of the library_spectra_meta (alias m) and metab_compound (alias c)
+                     columns, e.g. "m.instrument_type LIKE 'LC-ESI-%'" (only use with trusted input) [default None]
+        polarity (str): Only spectra of this polarity (e.g. 'positive', see polarity_code) [default None]
+        **filters: The META_COLUMNS as <column>=value (a list or tuple for any of several values) or the inclusive
+                   bounds min_<column> and max_<column>
+
+    Returns:
+       tuple of the WHERE clause (an empty string if there are no filters) and the list of parameters
+    """
+    type_sign = '?' if db_type == 'sqlite' else '%s'
+    conditions, params = [], []
+
+    if polarity is not None:
+        code = polarity_code(polarity)
+        if not code:
+            raise ValueError('unknown polarity {}'.format(polarity))
+        names = POLARITY_NAMES[code]
+        conditions.append('lower(m.polarity) IN ({})'.format(', '.join([type_sign] * len(names))))
+        params.extend(names)
+
+    for key, value in sorted(filters.items()):
+        bound, _, column = key.partition('_')
+        if bound in ('min', 'max') and column in META_COLUMNS:
+            conditions.append('m.{} {} {}'.format(column, '>=' if bound == 'min' else '<=', type_sign))
+            params.append(value)
+        elif key in META_COLUMNS:
+            values = list(value) if isinstance(value, (list, tuple)) else [value]
+            conditions.append('m.{} IN ({})'.format(key, ', '.join([type_sign] * len(values))))
+            params.extend(values)
+        else:
+            raise ValueError('unknown filter {} (use <column>, min_<column> or max_<column> of {})'.format(
+                key, ', '.join(META_COLUMNS)))
+
+    if where:
+        if db_type in ('postgres', 'django', 'django_mysql'):
+            # the query is %-formatted by these drivers even without parameters (e.g. for LIKE 'C12%')
+            where = where.replace('%', '%%')
+        conditions.append('({})'.format(where))
+
+    return ' AND '.join(conditions), params
+
+
+def iter_records(conn, db_type='sqlite', page_size=1000, where=None, **filters):
+    """ Iterate through the spectra (with the details of their compound and their peaks) in the order of their ids
+
+    The spectra are read a page at a time (keyset pagination on the id, so each page is a range of the primary key
+    whatever the size of the export) with one query of the library_spectra_meta and metab_compound columns and one
+    query of the peaks of the page. Only a page is held in memory at a time.
+
+    Args:
+        conn (connection object): Database connection object
+        db_type (str): Type of database either "sqlite", "mysql", "postgres" or "django_mysql" [default "sqlite"]
+        page_size (int): Number of spectra in each page [default 1000]
+        where (str): Additional SQL condition (see export_where) [default None]
+        **filters: Filters of the spectra (see export_where)
+
+    Returns:
+       generator of dictionaries of the META_COLUMNS, the COMPOUND_COLUMNS and the 'peaks' (list of (mz, i, other)
+       tuples)
+    """
+    clause, params = export_where(db_type, where=where, **filters)
+    type_sign = '?' if db_type == 'sqlite' else '%s'
+    columns = ['m.' + col for col in META_COLUMNS] + ['c.name'] + ['c.' + col for col in COMPOUND_COLUMNS[1:]]
+    sql = 'SELECT {} FROM library_spectra_meta m LEFT JOIN metab_compound c ON c.inchikey_id = m.inchikey_id ' \
+          'WHERE m.id > {}{} ORDER BY m.id LIMIT {}'.format(', '.join(columns), type_sign,
+                                                            ' AND ' + clause if clause else '', int(page_size))
+    names = META_COLUMNS + COMPOUND_COLUMNS
+
+    c = conn.cursor()
+    last_id = -1
+    while True:
+        c.execute(sql, [last_id] + params)
+        page = c.fetchall()
+        if not page:
+            break
+        meta_ids = [row[0] for row in page]
+        last_id = meta_ids[-1]
+
+        c.execute('SELECT library_spectra_meta_id, mz, i, other FROM library_spectra '
+                  'WHERE library_spectra_meta_id IN ({}) ORDER BY library_spectra_meta_id, id'.format(
+                      ', '.join([type_sign] * len(meta_ids))), meta_ids)
+        peaks = {}
+        for row in c.fetchall():
+            peaks.setdefault(row[0], []).append(row[1:])
+
+        for row in page:
+            record = dict(zip(names, row))
+            record['peaks'] = peaks.get(row[0], [])
+            yield record
+    c.close()
+
+
+def export_msp(conn, pth, db_type='sqlite', style='mona', compress=None, page_size=1000, where=None, **filters):
+    """ Export the spectra of a database (or a filtered subset) to a MSP file
+
+    The records are streamed from the database (see iter_records) and written in blocks, so the memory used does not
+    depend on the number of spectra. The files can be imported again with msp2db (with the same schema as the style).
+
+    Example:
+        >>> from msp2db.db import get_connection
+        >>> from msp2db.export import export_msp
+        >>> conn = get_connection('sqlite', 'library.db')
+        >>> export_msp(conn, 'positive_ms2.msp.gz', polarity='positive', ms_level=2)
+        1043
+
+    Args:
+        conn (connection object): Database connection object
+        pth (str): Path of the MSP file
+        db_type (str): Type of database either "sqlite", "mysql", "postgres" or "django_mysql" [default "sqlite"]
+        style (str): Either "mona" (MoNA MSP records) or "massbank" (MassBank records) [default "mona"]
+        compress (boolean): Write a gzip compressed file (by default if pth ends with .gz) [default None]
+        page_size (int): Number of spectra read from the database at a time [default 1000]
+        where (str): Additional SQL condition (see export_where) [default None]
+        **filters: Filters of the spectra (see export_where)
+
+    Returns:
+       Number of spectra exported
+    """
+    if style not in MSP_STYLES:
+        raise ValueError('style must be one of {}'.format(', '.join(MSP_STYLES)))
+    format_record = _mona_record if style == 'mona' else _massbank_record
+    if compress is None:
+        compress = pth.endswith('.gz')
+
+    if compress:
+        f = io.TextIOWrapper(gzip.open(pth, 'wb'), encoding='utf-8')
+    else:
+        f = io.open(pth, 'w', encoding='utf-8', buffering=1024 ** 2)
+
+    n = 0
+    block = []
+    with f:
+        for record in iter_records(conn, db_type, page_size, where=where, **filters):
+            block.append(format_record(record))
+            n += 1
+            if len(block) == _WRITE_BLOCK:
+                f.write(''.join(block))
+                block = []
+                print('{} spectra exported'.format(n))
+        f.write(''.join(block))
+
+    return n
+
+
+def export_arrow(conn, out_pth, db_type='sqlite', file_format='parquet', peaks='list', partition_by=None,
+                 row_group_size=100000, compression=None, where=None, **filters):
+    """ Export the spectra of a database (or a filtered subset) to Parquet or Arrow IPC files (requires pyarrow)
+
+    The library_spectra_meta, metab_compound and library_spectra tables are written to files in the out_pth
+    directory (e.g. library_spectra_meta.parquet), for pandas, DuckDB or any other columnar reader. The rows are
+    streamed from the database and written in row groups, so the memory used does not depend on the size of the
+    library. The DICTIONARY_COLUMNS are dictionary encoded.
+
+    The peaks are either a row per spectrum with list columns of the m/z and intensities ("list") or a row per peak
+    sorted by library_spectra_meta_id ("long"). With partition_by the spectra (and their peaks) are split into a
+    directory per value of a library_spectra_meta column, e.g. library_spectra/polarity=POSITIVE/part-0.parquet
+    (Hive partitioning, the column is not stored in the files).
+
+    Example:
+        >>> from msp2db.db import get_connection
+        >>> from msp2db.export import export_arrow
+        >>> conn = get_connection('sqlite', 'library.db')
+        >>> export_arrow(conn, 'library_parquet', partition_by='polarity', ms_level=2)
+        {'library_spectra_meta': 1043, 'library_spectra': 1043, 'metab_compound': 512}
+        >>> import pandas as pd
+        >>> meta = pd.read_parquet('library_parquet/library_spectra_meta')
+
+    Args:
+        conn (connection object): Database connection object
+        out_pth (str): Path of the directory of the files (created if it does not exist)
+        db_type (str): Type of database either "sqlite", "mysql", "postgres" or "django_mysql" [default "sqlite"]
+        file_format (str): Either "parquet" or "arrow" (Arrow IPC files) [default "parquet"]
+        peaks (str): Layout of the peaks either "list" or "long" [default "list"]
+        partition_by (str): Column of library_spectra_meta to partition the spectra by [default None]
+        row_group_size (int): Number of rows read from the database for each row group (for the "list" layout the
+                              number of peaks) [default 100000]
+        compression (str): Compression codec (e.g. "zstd"), by default snappy for Parquet and none for Arrow
+                           [default None]
+        where (str): Additional SQL condition (see export_where) [default None]
+        **filters: Filters of the spectra (see export_where)
+
+    Returns:
+       dictionary of the number of rows written to each table
+    """
+    import pyarrow as pa
+
+    if file_format not in ARROW_FORMATS:
+        raise ValueError('file_format must be one of {}'.format(', '.join(ARROW_FORMATS)))
+    if peaks not in PEAK_LAYOUTS:
+        raise ValueError('peaks must be one of {}'.format(', '.join(PEAK_LAYOUTS)))
+    if partition_by and partition_by not in META_COLUMNS:
+        raise ValueError('partition_by must be one of {}'.format(', '.join(META_COLUMNS)))
+    if not os.path.exists(out_pth):
+        os.makedirs(out_pth)
+
+    type_sign = '?' if db_type == 'sqlite' else '%s'
+    clause, params = export_where(db_type, where=where, **filters)
+    meta_from = 'FROM library_spectra_meta m LEFT JOIN metab_compound c ON c.inchikey_id = m.inchikey_id'
+
+    partitions = [(None, clause, params)]
+    if partition_by:
+        c = conn.cursor()
+        c.execute('SELECT DISTINCT m.{} {}{}'.format(partition_by, meta_from, ' WHERE ' + clause if clause else ''),
+                  params)
+        values = sorted([row[0] for row in c.fetchall()], key=lambda v: (v is None, _text(v)))
+        c.close()
+        partitions = []
+        for value in values:
+            if value is None:
+                condition = 'm.{} IS NULL'.format(partition_by)
+            else:
+                condition = 'm.{} = {}'.format(partition_by, type_sign)
+            partitions.append((value, ' AND '.join(x for x in (clause, condition) if x),
+                               params + ([] if value is None else [value])))
+
+    meta_columns = [col for col in META_COLUMNS if col != partition_by]
+    meta_schema = _arrow_schema(meta_columns)
+    if peaks == 'list':
+        peak_schema = pa.schema([('library_spectra_meta_id', pa.int64()), ('mz', pa.list_(pa.float64())),
+                                 ('i', pa.list_(pa.float64()))])
+    else:
+        peak_schema = pa.schema([('library_spectra_meta_id', pa.int64()), ('mz', pa.float64()),
+                                 ('i', pa.float64())])
+
+    counts = {'library_spectra_meta': 0, 'library_spectra': 0, 'metab_compound': 0}
+    for value, part_clause, part_params in partitions:
+        part = None if not partition_by else '{}={}'.format(
+            partition_by, _NULL_PARTITION if value is None else quote(_text(value), safe=''))
+        part_where = ' WHERE ' + part_clause if part_clause else ''
+
+        sql = 'SELECT {} {}{} ORDER BY m.id'.format(', '.join('m.' + col for col in meta_columns), meta_from,
+                                                    part_where)
+        counts['library_spectra_meta'] += _write_rows(
+            conn, db_type, sql, part_params, _arrow_pth(out_pth, 'library_spectra_meta', part, file_format),
+            meta_schema, file_format, row_group_size, compression)
+
+        sql = 'SELECT s.library_spectra_meta_id, s.mz, s.i {} JOIN library_spectra s ' \
+              'ON s.library_spectra_meta_id = m.id{} ORDER BY m.id, s.id'.format(meta_from, part_where)
+        counts['library_spectra'] += _write_peaks(
+            conn, db_type, sql, part_params, _arrow_pth(out_pth, 'library_spectra', part, file_format),
+            peak_schema, file_format, row_group_size, compression)
+
+    # the compounds of the exported spectra
+    sql = 'SELECT {} FROM metab_compound c'.format(', '.join('c.' + col for col in COMPOUND_TABLE_COLUMNS))
+    if clause:
+        sql += ' WHERE EXISTS (SELECT 1 FROM library_spectra_meta m WHERE m.inchikey_id = c.inchikey_id AND {})'.format(
+            clause)
+    counts['metab_compound'] = _write_rows(
+        conn, db_type, sql + ' ORDER BY c.inchikey_id', params,
+        _arrow_pth(out_pth, 'metab_compound', None, file_format), _arrow_schema(COMPOUND_TABLE_COLUMNS), file_format,
+        row_group_size, compression)
+
+    print('{library_spectra_meta} spectra, {library_spectra} library_spectra rows and {metab_compound} compounds '
+          'exported'.format(**counts))
+    return counts
+
+
+def _mona_record(r):
+    """ A record in the style of the MoNA MSP exports (the details without a MSP field are in the Comments line)
+    """
+    lines = ['Name: {}'.format(_text(r['name']))]
+    # a MoNA record has a single name (the compound name is a synonym if it is not the name of the spectrum)
+    names = _other_names(r)
+    if _present(r['compound_name']) and r['compound_name'] != r['name']:
+        names.insert(0, _text(r['compound_name']))
+    lines.extend('Synonym: {}'.format(name) for name in names)
+    lines.append('DB#: {}'.format(_text(r['accession'])))
+    fields = [('InChIKey', _inchikey(r)), ('Precursor_type', r['precursor_type']),
+              ('Spectrum_type', 'MS{}'.format(_number(r['ms_level'])) if r['ms_level'] else None),
+              ('PrecursorMZ', r['precursor_mz']), ('Instrument_type', r['instrument_type']),
+              ('Instrument', r['instrument']), ('Ion_mode', r['polarity']), ('Formula', r['molecular_formula']),
+              ('Splash', r['splash'])]
+    lines.extend('{}: {}'.format(key, _text(value)) for key, value in fields if _present(value))
+
+    comments = [('collision energy', r['collision_energy']), ('resolution', r['resolution']),
+                ('fragmentation mode', r['fragmentation_type']), ('copyright', r['copyright']),
+                ('mass accuracy', r['mass_accuracy']), ('mass error', r['mass_error']), ('origin', r['origin']),
+                ('retention time', r['retention_time']), ('retention index', r['retention_index']),
+                ('exact mass', r['exact_mass']), ('MW', r['molecular_weight']), ('compound class', r['compound_class']),
+                ('SMILES', r['smiles']), ('pubchem cid', r['pubchem_id']), ('chemspider', r['chemspider_id'])]
+    comments = ['"{}={}"'.format(key, _text(value).replace('"', "'")) for key, value in comments if _present(value)]
+    if comments:
+        lines.append('Comments: {}'.format(' '.join(comments)))
+
+    lines.append('Num Peaks: {}'.format(len(r['peaks'])))
+    lines.extend('%r %r %s' % peak if peak[2] else '%r %r' % peak[:2] for peak in r['peaks'])
+    return '\n'.join(lines) + '\n\n'
+
+
+def _massbank_record(r):
+    """ A record in the style of the MassBank record format
+    """
+    lines = ['ACCESSION: {}'.format(_text(r['accession'])), 'RECORD_TITLE: {}'.format(_text(r['name']))]
+    lines.extend('CH$NAME: {}'.format(name) for name in [_text(r['compound_name'] or r['name'])] + _other_names(r))
+    fields = [('CH$COMPOUND_CLASS:', r['compound_class']), ('CH$FORMULA:', r['molecular_formula']),
+              ('CH$EXACT_MASS:', r['exact_mass']), ('CH$MOLECULAR_WEIGHT:', r['molecular_weight']),
+              ('CH$SMILES:', r['smiles']), ('CH$LINK: INCHIKEY', _inchikey(r)),
+              ('CH$LINK: PUBCHEM', 'CID:{}'.format(r['pubchem_id']) if _present(r['pubchem_id']) else None),
+              ('CH$LINK: CHEMSPIDER', r['chemspider_id']), ('COPYRIGHT:', r['copyright']),
+              ('AC$INSTRUMENT:', r['instrument']), ('AC$INSTRUMENT_TYPE:', r['instrument_type']),
+              ('AC$MASS_SPECTROMETRY: MS_TYPE', 'MS{}'.format(_number(r['ms_level'])) if r['ms_level'] else None),
+              ('AC$MASS_SPECTROMETRY: ION_MODE', r['polarity']),
+              ('AC$MASS_SPECTROMETRY: FRAGMENTATION_MODE', r['fragmentation_type']),
+              ('AC$MASS_SPECTROMETRY: COLLISION_ENERGY', r['collision_energy']),
+              ('AC$MASS_SPECTROMETRY: RESOLUTION', r['resolution']),
+              ('AC$MASS_SPECTROMETRY: ACCURACY', r['mass_accuracy']),
+              ('AC$MASS_SPECTROMETRY: ERROR', r['mass_error']),
+              ('AC$CHROMATOGRAPHY: RETENTION_TIME', r['retention_time']),
+              ('AC$CHROMATOGRAPHY: RETENTION_INDEX', r['retention_index']),
+              ('MS$FOCUSED_ION: PRECURSOR_M/Z', r['precursor_mz']),
+              ('MS$FOCUSED_ION: PRECURSOR_TYPE', r['precursor_type']), ('PK$SPLASH:', r['splash'])]
+    lines.extend('{} {}'.format(key, _text(value)) for key, value in fields if _present(value))
+
+    lines.append('PK$NUM_PEAK: {}'.format(len(r['peaks'])))
+    lines.append('PK$PEAK: m/z int. rel.int.')
+    max_i = max([p[1] for p in r['peaks']] or [0])
+    scale = 999.0 / max_i if max_i > 0 else 0
+    lines.extend('  %r %r %d' % (mz, i, round(i * scale)) for mz, i, _ in r['peaks'])
+    return '\n'.join(lines) + '\n//\n'
+
+
+def _present(value):
+    return value is not None and value != ''
+
+
+def _number(value):
+    """ A number without the decimal point of a whole float (e.g. the ms_level 2.0)
+    """
+    value = float(value)
+    return '{:d}'.format(int(value)) if value.is_integer() else repr(value)
+
+
+def _text(value):
+    if isinstance(value, float):
+        return _number(value)
+    return six.text_type(value).strip() if value is not None else ''
+
+
+def _inchikey(r):
+    # the random inchikey of a compound that could not be identified is not exported
+    inchikey_id = r['inchikey_id']
+    return None if not inchikey_id or inchikey_id.startswith('UNKNOWN_') else inchikey_id
+
+
+def _other_names(r):
+    return [name.strip() for name in (r['other_names'] or '').split(' <#> ') if name.strip()]
+
+
+def _arrow_schema(columns):
+    """ The Arrow schema of library_spectra_meta or metab_compound columns
+    """
+    import pyarrow as pa
+    fields = []
+    for col in columns:
+        if col in _FLOAT_COLUMNS:
+            fields.append((col, pa.float64()))
+        elif col in _INT_COLUMNS:
+            fields.append((col, pa.int64()))
+        elif col in DICTIONARY_COLUMNS:
+            fields.append((col, pa.dictionary(pa.int32(), pa.string())))
+        else:
+            fields.append((col, pa.string()))
+    return pa.schema(fields)
+
+
+def _arrow_pth(out_pth, table, partition, file_format):
+    ext = '.parquet' if file_format == 'parquet' else '.arrow'
+    if partition is None:
+        return os.path.join(out_pth, table + ext)
+    directory = os.path.join(out_pth, table, partition)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    return os.path.join(directory, 'part-0' + ext)
+
+
+class _ArrowWriter(object):
+    """ Write record batches to a Parquet or Arrow IPC file (one row group or record batch per write)
+    """
+    def __init__(self, pth, schema, file_format, compression=None):
+        import pyarrow as pa
+        if file_format == 'parquet':
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(pth, schema, compression=compression or 'snappy')
+        else:
+            # the dictionaries grow with each batch (see _DictionaryEncoder) so are written as deltas
+            options = pa.ipc.IpcWriteOptions(compression=compression, emit_dictionary_deltas=True)
+            self.writer = pa.ipc.new_file(pth, schema, options=options)
+
+    def write(self, batch):
+        self.writer.write_batch(batch)
+
+    def close(self):
+        self.writer.close()
+
+
+class _DictionaryEncoder(object):
+    """ Dictionary encode the values of a column with one dictionary for all the batches (new values are appended)
+    """
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def encode(self, values):
+        import pyarrow as pa
+        indices = []
+        for value in values:
+            if value is None:
+                indices.append(None)
+                continue
+            code = self.codes.get(value)
+            if code is None:
+                code = self.codes[value] = len(self.values)
+                self.values.append(value)
+            indices.append(code)
+        return pa.DictionaryArray.from_arrays(pa.array(indices, type=pa.int32()),
+                                              pa.array(self.values, type=pa.string()))
+
+
+def _write_rows(conn, db_type, sql, params, pth, schema, file_format, row_group_size, compression):
+    """ Stream the rows of a query to a Parquet or Arrow file (a row group per page of rows)
+    """
+    import pyarrow as pa
+    encoders = {field.name: _DictionaryEncoder() for field in schema if pa.types.is_dictionary(field.type)}
+    writer = _ArrowWriter(pth, schema, file_format, compression)
+    n = 0
+    c = _stream_cursor(conn, db_type, row_group_size)
+    try:
+        c.execute(sql, params)
+        for rows in _fetch_pages(c, row_group_size):
+            arrays = []
+            for field, values in zip(schema, zip(*rows)):
+                if field.name in encoders:
+                    arrays.append(encoders[field.name].encode([_text_or_none(v) for v in values]))
+                elif pa.types.is_string(field.type):
+                    arrays.append(pa.array([_text_or_none(v) for v in values], type=field.type))
+                else:
+                    arrays.append(pa.array(values, type=field.type))
+            writer.write(pa.record_batch(arrays, schema=schema))
+            n += len(rows)
+    finally:
+        c.close()
+        writer.close()
+    return n
+
+
+def _write_peaks(conn, db_type, sql, params, pth, schema, file_format, row_group_size, compression):
+    """ Stream the (library_spectra_meta_id, mz, i) rows of a query (ordered by the spectrum) to a Parquet or Arrow
+    file, either a row per peak or a row per spectrum with list columns (see export_arrow)
+    """
+    import pyarrow as pa
+    as_lists = pa.types.is_list(schema.field('mz').type)
+    writer = _ArrowWriter(pth, schema, file_format, compression)
+    n = 0
+    carry = np.empty((0, 3))
+    c = _stream_cursor(conn, db_type, row_group_size)
+    try:
+        c.execute(sql, params)
+        for rows in _fetch_pages(c, row_group_size):
+            page = np.array(rows, dtype=np.float64).reshape(-1, 3)
+            if not as_lists:
+                writer.write(_peak_batch(page, schema))
+                n += len(page)
+                continue
+            # the peaks of the last spectrum of the page may continue on the next page
+            page = np.concatenate([carry, page])
+            last = np.searchsorted(page[:, 0], page[-1, 0])
+            carry = page[last:]
+            if last:
+                writer.write(_peak_list_batch(page[:last], schema))
+                n += len(np.unique(page[:last, 0]))
+        if len(carry):
+            writer.write(_peak_list_batch(carry, schema))
+            n += 1
+    finally:
+        c.close()
+        writer.close()
+    return n
+
+
+def _peak_batch(page, schema):
+    import pyarrow as pa
+    return pa.record_batch([pa.array(page[:, 0].astype(np.int64)), pa.array(page[:, 1]), pa.array(page[:, 2])],
+                           schema=schema)
+
+
+def _peak_list_batch(page, schema):
+    import pyarrow as pa
+    ids = page[:, 0].astype(np.int64)
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    offsets = pa.array(np.r_[starts, len(ids)].astype(np.int32))
+    return pa.record_batch([pa.array(ids[starts]), pa.ListArray.from_arrays(offsets, pa.array(page[:, 1])),
+                            pa.ListArray.from_arrays(offsets, pa.array(page[:, 2]))], schema=schema)
+
+
+def _text_or_none(value):
+    return None if value is None else six.text_type(value)
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+from __future__ import absolute_import, unicode_literals, print_function
+import numpy as np
+from .db import iter_spectra
+from .query import _to_float
+
+DEFAULT_BIN_WIDTH = 0.01
+
+
+class BinnedIndex(object):
+    """Binned inverted index of a value of the peaks of the library spectra (see FragmentIndex and NeutralLossIndex)
+
+    The postings (the value, library_spectra_meta id and relative intensity of each peak) are stored in compact numpy
+    arrays sorted by value with the offset of the first posting of each bin, so the postings within the tolerance
+    of a value are found without a scan of the library_spectra table. The index can be saved to (and loaded from) a
+    sidecar file.
+
+    Args:
+        bin_width (float): Width of the bins [default 0.01]
+
+    Returns:
+        BinnedIndex object
+    """
+    kind = None
+
+    def __init__(self, bin_width=DEFAULT_BIN_WIDTH):
+        self.bin_width = float(bin_width)
+        self.values = np.empty(0, dtype=np.float64)
+        self.meta_ids = np.empty(0, dtype=np.int64)
+        self.intensity = np.empty(0, dtype=np.float32)
+        self.first_bin = 0
+        self.bin_offsets = np.zeros(1, dtype=np.int64)
+        # postings added since the arrays were last sorted
+        self._pending = []
+
+    def __len__(self):
+        self._consolidate()
+        return len(self.values)
+
+    @classmethod
+    def from_db(cls, conn, db_type='sqlite', bin_width=DEFAULT_BIN_WIDTH, page_size=1000):
+        """ Build the index from the spectra of an existing database (a single streaming pass through the spectra)
+
+        Args:
+            conn (connection object): Database connection object
+            db_type (str): Type of database (sqlite, mysql, postgres or django_mysql) [default "sqlite"]
+            bin_width (float): Width of the bins [default 0.01]
+            page_size (int): Number of spectra read at a time [default 1000]
+
+        Returns:
+           index object
+        """
+        index = cls(bin_width)
+        for page in iter_spectra(conn, page_size=page_size, db_type=db_type, peaks_output='numpy'):
+            meta_ids = np.concatenate([np.full(len(s['peaks']), s['id'], dtype=np.int64) for s in page])
+            peaks = np.concatenate([s['peaks'] for s in page])
+            index.add_peaks(meta_ids, peaks[:, 0], peaks[:, 1],
+                            precursor_mz={s['id']: _to_float(s['precursor_mz']) for s in page})
+        index._consolidate()
+        return index
+
+    @classmethod
+    def load(cls, pth):
+        """ Load an index saved with save
+
+        Args:
+            pth (str): Path of the sidecar file
+
+        Returns:
+           index object
+        """
+        with np.load(pth) as data:
+            if 'kind' in data.files and str(data['kind']) != cls.kind:
+                raise ValueError('{} is a {} index (not a {} index)'.format(pth, data['kind'], cls.kind))
+            index = cls(float(data['bin_width']))
+            # the first fragment index files stored the values as "mz"
+            values = data['values'] if 'values' in data.files else data['mz']
+            index._set_postings(values, data['meta_ids'], data['intensity'])
+        return index
+
+    def save(self, pth):
+        """ Save the index to a sidecar file (numpy .npz format)
+
+        Args:
+            pth (str): Path of the sidecar file
+        """
+        self._consolidate()
+        # a file object is used so numpy does not add the .npz extension
+        with open(pth, 'wb') as f:
+            np.savez(f, kind=np.array(self.kind), bin_width=np.array(self.bin_width), values=self.values,
+                     meta_ids=self.meta_ids, intensity=self.intensity)
+
+    def add_peaks(self, meta_ids, mz, intensity, precursor_mz=None):
+        """ Add the peaks of complete spectra to the index
+
+        Args:
+            meta_ids (list): library_spectra_meta id of each peak
+            mz (list): m/z of each peak
+            intensity (list): Intensity of each peak (stored relative to the most intense peak of the spectrum)
+            precursor_mz (dict): Precursor m/z of each spectrum (library_spectra_meta id to m/z) [default None]
+        """
+        meta_ids = np.asarray(meta_ids, dtype=np.int64)
+        if not len(meta_ids):
+            return
+        mz = np.asarray(mz, dtype=np.float64)
+        intensity = np.asarray(intensity, dtype=np.float64)
+
+        spectra, inverse = np.unique(meta_ids, return_inverse=True)
+        base = np.zeros(len(spectra))
+        np.maximum.at(base, inverse, intensity)
+        base[base == 0] = 1
+        relative = (intensity / base[inverse] * 100).astype(np.float32)
+
+        values, keep = self._peak_values(spectra, inverse, mz, precursor_mz or {})
+        self._pending.append((values[keep], meta_ids[keep], relative[keep]))
+
+    def add_peak_rows(self, rows, precursor_mz=None):
+        """ Add the library_spectra rows (id, mz, i, other, library_spectra_meta_id) of complete spectra to the index
+
+        Args:
+            rows (list): library_spectra rows
+            precursor_mz (dict): Precursor m/z of each spectrum (library_spectra_meta id to m/z) [default None]
+        """
+        if rows:
+            self.add_peaks([r[4] for r in rows], [r[1] for r in rows], [r[2] for r in rows], precursor_mz)
+
+    def remove(self, meta_ids):
+        """ Remove the postings of spectra from the index
+
+        Args:
+            meta_ids (list): The library_spectra_meta ids of the spectra
+        """
+        self._consolidate()
+        keep = ~np.isin(self.meta_ids, np.asarray(meta_ids, dtype=np.int64))
+        self._set_postings(self.values[keep], self.meta_ids[keep], self.intensity[keep])
+
+    def postings(self, value, tol=0.01):
+        """ Get the postings within the tolerance of a value
+
+        Args:
+            value (float): m/z (or neutral loss)
+            tol (float): Tolerance in Da [default 0.01]
+
+        Returns:
+           tuple of the numpy arrays of the library_spectra_meta ids, values and relative intensity of the postings
+        """
+        self._consolidate()
+        start, end = self._bin_range(value - tol, value + tol)
+        within = np.flatnonzero(np.abs(self.values[start:end] - value) <= tol) + start
+        return self.meta_ids[within], self.values[within], self.intensity[within]
+
+    def query(self, value, tol=0.01, min_intensity=0.0):
+        """ Find the spectra with a posting within the tolerance of a value
+
+        Args:
+            value (float): m/z (or neutral loss)
+            tol (float): Tolerance in Da [default 0.01]
+            min_intensity (float): Minimum intensity of the peak relative to the most intense peak of the spectrum
+                                   (0 to 100) [default 0]
+
+        Returns:
+           sorted numpy array of the library_spectra_meta ids
+        """
+        meta_ids, _, intensity = self.postings(value, tol)
+        return np.unique(meta_ids[intensity >= min_intensity])
+
+    def _query_many(self, values, tol=0.01, mode='and', min_intensity=0.0, min_matches=None):
+        if min_matches is None:
+            if mode not in ('and', 'or'):
+                raise ValueError('mode must be either "and" or "or"')
+            min_matches = len(values) if mode == 'and' else 1
+
+        if not len(values):
+            return np.empty(0, dtype=np.int64)
+
+        matches = np.concatenate([self.query(value, tol, min_intensity) for value in values])
+        meta_ids, counts = np.unique(matches, return_counts=True)
+        return meta_ids[counts >= min_matches]
+
+    def _peak_values(self, spectra, inverse, mz, precursor_mz):
+        """ The value indexed for each peak and a mask of the peaks to index (by default the m/z of every peak,
+        see NeutralLossIndex for another value)
+        """
+        return mz, np.ones(len(mz), dtype=bool)
+
+    def _bin_range(self, low, high):
+        """ Range of the postings of the bins between the low and high values
+        """
+        n_bins = len(self.bin_offsets) - 1
+        lo = min(max(int(np.floor(low / self.bin_width)) - self.first_bin, 0), n_bins)
+        hi = min(max(int(np.floor(high / self.bin_width)) - self.first_bin + 1, 0), n_bins)
+        return self.bin_offsets[lo], self.bin_offsets[hi]
+
+    def _consolidate(self):
+        """ Merge the pending postings into the sorted arrays
+        """
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        self._set_postings(np.concatenate([self.values] + [p[0] for p in pending]),
+                           np.concatenate([self.meta_ids] + [p[1] for p in pending]),
+                           np.concatenate([self.intensity] + [p[2] for p in pending]))
+
+    def _set_postings(self, values, meta_ids, intensity):
+        order = np.lexsort((meta_ids, values))
+        self.values, self.meta_ids, self.intensity = values[order], meta_ids[order], intensity[order]
+
+        bins = np.floor(self.values / self.bin_width).astype(np.int64)
+        if not len(bins):
+            self.first_bin = 0
+            self.bin_offsets = np.zeros(1, dtype=np.int64)
+            return
+        self.first_bin = int(bins[0])
+        self.bin_offsets = np.searchsorted(bins, np.arange(bins[0], bins[-1] + 2))
+
+
+class FragmentIndex(BinnedIndex):
+    """Binned inverted index of the fragment m/z of the library spectra
+
+    The index is updated by an Importer as each chunk is inserted (see fragment_index_pth).
+
+    Example:
+        >>> from msp2db.db import get_connection
+        >>> from msp2db.index import FragmentIndex
+        >>> conn = get_connection('sqlite', 'library.db')
+        >>> index = FragmentIndex.from_db(conn)
+        >>> index.save('library.db.fragments.npz')
+        >>> index.query(184.0733, tol=0.005, min_intensity=10)
+        array([12, 57, 103])
+        >>> index.query_fragments([184.0733, 104.1070], tol=0.005, mode='and')
+        array([57])
+
+    Args:
+        bin_width (float): Width of the m/z bins [default 0.01]
+
+    Returns:
+        FragmentIndex object
+    """
+    kind = 'fragment'
+
+    def query_fragments(self, mzs, tol=0.01, mode='and', min_intensity=0.0, min_matches=None):
+        """ Find the spectra with peaks matching all (AND) or any (OR) of a list of fragments
+
+        Args:
+            mzs (list): Fragment m/z values
+            tol (float): m/z tolerance in Da [default 0.01]
+            mode (str): Either "and" (all the fragments) or "or" (any of the fragments) [default "and"]
+            min_intensity (float): Minimum relative intensity of the matched peaks (0 to 100) [default 0]
+            min_matches (int): Minimum number of matched fragments (overrides the mode) [default None]
+
+        Returns:
+           sorted numpy array of the library_spectra_meta ids
+        """
+        return self._query_many(mzs, tol, mode, min_intensity, min_matches)
+
+
+class NeutralLossIndex(BinnedIndex):
+    """Binned inverted index of the neutral losses (precursor m/z - fragment m/z) of the library spectra
+
+    Only the spectra with a precursor m/z are indexed (and only the positive losses). The losses are calculated when
+    the index is built (for all the peaks of a chunk of spectra at once) so a loss query does not have to calculate
+    the loss of every peak. The index is updated by an Importer as each chunk is inserted (see
+    neutral_loss_index_pth).
+
+    Example:
+        >>> from msp2db.db import get_connection
+        >>> from msp2db.index import NeutralLossIndex
+        >>> conn = get_connection('sqlite', 'library.db')
+        >>> index = NeutralLossIndex.from_db(conn)
+        >>> index.query(162.0528, tol=0.005)
+        array([4, 31])
+        >>> index.query_losses([162.0528, 18.0106], tol=0.005, mode='or')
+        array([4, 9, 31])
+
+    Args:
+        bin_width (float): Width of the neutral loss bins [default 0.01]
+
+    Returns:
+        NeutralLossIndex object
+    """
+    kind = 'neutral_loss'
+
+    def query_losses(self, losses, tol=0.01, mode='and', min_intensity=0.0, min_matches=None):
+        """ Find the spectra with peaks matching all (AND) or any (OR) of a list of neutral losses
+
+        Args:
+            losses (list): Neutral losses (Da)
+            tol (float): Tolerance in Da [default 0.01]
+            mode (str): Either "and" (all the losses) or "or" (any of the losses) [default "and"]
+            min_intensity (float): Minimum relative intensity of the matched peaks (0 to 100) [default 0]
+            min_matches (int): Minimum number of matched losses (overrides the mode) [default None]
+
+        Returns:
+           sorted numpy array of the library_spectra_meta ids
+        """
+        return self._query_many(losses, tol, mode, min_intensity, min_matches)
+
+    def _peak_values(self, spectra, inverse, mz, precursor_mz):
+        precursor = np.array([_to_float(precursor_mz.get(int(meta_id))) for meta_id in spectra], dtype=np.float64)
+        losses = precursor[inverse] - mz
+        # NaN losses (no precursor m/z) are not > 0
+        return losses, losses > 0
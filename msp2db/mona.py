@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+from __future__ import absolute_import, unicode_literals, print_function
+import io
+import json
+import re
+import numpy as np
+import six
+
+# the MoNA metaData names (lower case) of the library_spectra_meta columns
+MONA_META_NAMES = {
+    'collision energy': 'collision_energy',
+    'ms level': 'ms_level',
+    'ms type': 'ms_level',
+    'accession': 'accession',
+    'resolution': 'resolution',
+    'ionization mode': 'polarity',
+    'ion mode': 'polarity',
+    'polarity': 'polarity',
+    'fragmentation mode': 'fragmentation_type',
+    'fragmentation type': 'fragmentation_type',
+    'precursor m/z': 'precursor_mz',
+    'precursor type': 'precursor_type',
+    'adduct': 'precursor_type',
+    'instrument type': 'instrument_type',
+    'instrument': 'instrument',
+    'copyright': 'copyright',
+    'mass accuracy': 'mass_accuracy',
+    'mass error': 'mass_error',
+    'origin': 'origin',
+    'retention time': 'retention_time',
+    'retention index': 'retention_index',
+}
+
+# the MoNA metaData names (lower case) of the metab_compound columns
+MONA_COMPOUND_NAMES = {
+    'inchikey': 'inchikey_id',
+    'molecular formula': 'molecular_formula',
+    'formula': 'molecular_formula',
+    'molecular weight': 'molecular_weight',
+    'mw': 'molecular_weight',
+    'pubchem cid': 'pubchem_id',
+    'chemspider': 'chemspider_id',
+    'compound class': 'compound_class',
+    'total exact mass': 'exact_mass',
+    'exact mass': 'exact_mass',
+    'smiles': 'smiles',
+}
+
+# columns stored as numbers (values that are not numbers, e.g. "5.2 min", are ignored as for the MSP files)
+_NUMERIC_FIELDS = {'precursor_mz', 'mass_accuracy', 'mass_error', 'retention_time', 'retention_index',
+                   'molecular_weight', 'exact_mass'}
+_DIGITS_RE = re.compile(r'^\D*(\d*)')
+_SEPARATORS_RE = re.compile(r'[\s,]*')
+_BUFFER_SIZE = 1024 ** 2
+
+
+def iter_json_records(f, buffer_size=_BUFFER_SIZE, offsets=False):
+    """ Iterate through the objects of a JSON array (e.g. the MoNA JSON export) without loading the whole file
+
+    The file is read in blocks of buffer_size characters and each object is decoded as soon as it is complete, so the
+    memory use only depends on the size of the largest record. The file can also be opened part way through the
+    array (after any object), e.g. to resume an import.
+
+    Example:
+        >>> from msp2db.mona import iter_json_records
+        >>> with open('MoNA-export-All_Spectra.json', 'rb') as f:
+        >>>     for record, _ in iter_json_records(f):
+        >>>         print(record['id'])
+
+    Args:
+        f (file object): Text or binary (utf-8) file object of the JSON array [required]
+        buffer_size (int): Number of characters read at a time [default 1048576]
+        offsets (boolean): Calculate the number of bytes (utf-8) of each object (and the separators before it)
+                           [default False]
+
+    Returns:
+       generator of (record dictionary, number of bytes or 0) tuples
+    """
+    if isinstance(f.read(0), bytes):
+        f = io.TextIOWrapper(f, encoding='utf-8')
+
+    decoder = json.JSONDecoder()
+    buf = ''
+    # pos is the current position in buf and last the end of the previous object
+    pos = last = 0
+    opening = True
+    eof = False
+
+    while True:
+        pos = _SEPARATORS_RE.match(buf, pos).end()
+        if opening and buf[pos:pos + 1] == '[':
+            pos = _SEPARATORS_RE.match(buf, pos + 1).end()
+            opening = False
+
+        if pos < len(buf) and buf[pos] == ']':
+            return
+
+        obj = None
+        if pos < len(buf):
+            if buf[pos] != '{':
+                raise ValueError('Expected a JSON object at character {} of the block: {!r}'.format(
+                    pos, buf[pos:pos + 20]))
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # an incomplete object at the end of the block
+                if eof:
+                    raise
+
+        if obj is None:
+            if eof:
+                return
+            block = f.read(buffer_size)
+            eof = not block
+            buf = buf[last:] + block
+            pos -= last
+            last = 0
+            continue
+
+        opening = False
+        nbytes = len(buf[last:end].encode('utf-8')) if offsets else 0
+        pos = last = end
+        yield obj, nbytes
+
+
+def parse_spectrum_string(spectrum):
+    """ Parse the peaks of a MoNA spectrum string ("mz:intensity mz:intensity ...")
+
+    Example:
+        >>> from msp2db.mona import parse_spectrum_string
+        >>> parse_spectrum_string('109.0679:4.204204 119.0517:100')
+        array([[109.0679  ,   4.204204],
+               [119.0517  , 100.      ]])
+
+    Args:
+        spectrum (str): The spectrum string
+
+    Returns:
+       numpy array of the m/z (column 0) and intensity (column 1) of each peak
+    """
+    values = spectrum.replace(':', ' ').split() if spectrum else []
+    if len(values) % 2:
+        raise ValueError('Invalid spectrum string: {!r}'.format(spectrum[:50]))
+    return np.array(values, dtype=np.float64).reshape(-1, 2)
+
+
+def record_info(record):
+    """ Get the meta data and compound details of a MoNA JSON record
+
+    The metaData names of the spectrum and compound are mapped onto the library_spectra_meta and metab_compound
+    columns (see MONA_META_NAMES and MONA_COMPOUND_NAMES), the first compound of the record is used.
+
+    Args:
+        record (dict): The MoNA JSON record
+
+    Returns:
+       tuple of the meta data dictionary, compound dictionary, list of the other names and the InChI (str)
+    """
+    compounds = record.get('compound') or [{}]
+    compound = compounds[0]
+
+    meta_info = {}
+    compound_info = {}
+    # the compound values are set by the first occurrence and the meta values by the last (as for the MSP files)
+    for md in (compound.get('metaData') or []) + (record.get('metaData') or []):
+        name = (md.get('name') or '').strip().lower()
+        value = _value(md.get('value'))
+        if not value:
+            continue
+        if name in MONA_META_NAMES:
+            key = MONA_META_NAMES[name]
+            value = _field_value(key, value)
+            if value:
+                meta_info[key] = value
+        elif name in MONA_COMPOUND_NAMES:
+            key = MONA_COMPOUND_NAMES[name]
+            value = _field_value(key, value)
+            if value and not compound_info.get(key):
+                compound_info[key] = value
+
+    names = [n['name'].strip() for n in compound.get('names') or [] if n.get('name')]
+    if names:
+        compound_info['name'] = names[0]
+        meta_info['name'] = names[0]
+
+    if compound.get('inchiKey'):
+        compound_info['inchikey_id'] = compound['inchiKey'].strip()
+
+    if record.get('id'):
+        meta_info['accession'] = _value(record['id'])
+
+    splash = record.get('splash') or {}
+    if splash.get('splash'):
+        meta_info['splash'] = splash['splash']
+
+    inchi = _value(compound.get('inchi'))
+    if not inchi:
+        inchi = next((_value(md.get('value')) for md in compound.get('metaData') or []
+                      if (md.get('name') or '').lower() == 'inchi'), '')
+
+    return meta_info, compound_info, names[1:], inchi
+
+
+def _value(value):
+    if value is None:
+        return ''
+    return six.text_type(value).strip()
+
+
+def _field_value(key, value):
+    if key == 'ms_level' or key == 'pubchem_id':
+        return _DIGITS_RE.match(value).group(1)
+    if key in _NUMERIC_FIELDS:
+        try:
+            float(value.replace(',', '.'))
+        except ValueError:
+            return ''
+        return value.replace(',', '.')
+    return value
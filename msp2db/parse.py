@@ -1,15 +1,27 @@
 # coding: utf-8
 from __future__ import absolute_import, unicode_literals, print_function
+import collections
 import datetime
+import io
+import itertools
+import json
+import multiprocessing
 import re
 import os
 import pubchempy as pcp
 import csv
 import uuid
 import six
-from .re import get_compound_regex, get_meta_regex
-from .db import get_connection, insert_query_m, _make_sql_compatible, db_dict
-from .utils import get_precursor_mz, line_count, get_blank_dict
+from .re import get_compound_regex, get_meta_regex, get_inchi_regex
+from .chem import structure_info, structure_info_batch, RDKIT_AVAILABLE
+from .splash import splash_batch, group_peaks
+from .index import FragmentIndex, NeutralLossIndex
+from .summary import summarise_peak_rows, SUMMARY_COLUMNS
+from .synonyms import synonym_rows, insert_synonyms
+from .db import get_connection, insert_query_m, _make_sql_compatible, db_dict, bulk_load, chunk_transaction, \
+    iter_table, iter_spectra, create_table, delete_spectra
+from .utils import get_precursor_mz, line_count, get_blank_dict, record_hash
+from .mona import iter_json_records, parse_spectrum_string, record_info
 
 try:
     # For Python 3.0 and later
@@ -24,65 +36,361 @@ except ImportError:
     from httplib import BadStatusLine
 
 
-class LibraryData(object):
-    """MSP file parser to SQL databases
+_pubchem_cache = {}
+pubchem_cache_stats = {'hits': 0, 'misses': 0}
 
-    After creating a SQL database for the library spectra using create_db, MSP files can be parsed into the database
-    using the LibraryData class.
+
+def get_pubchem_compounds(in_str, pcp_type):
+    """ Search PubChem compounds via the API (the results are cached for the lifetime of the process)
+
+    The same compound is often repeated many times within (and between) libraries, so each search is only sent to
+    PubChem once. Failed requests are not cached. The cache hits and misses are recorded in pubchem_cache_stats.
+
+    Example:
+        >>> from msp2db.parse import get_pubchem_compounds
+        >>> pccs = get_pubchem_compounds('KWILGNNWGSNMPA-UHFFFAOYSA-N', 'inchikey')
+
+    Args:
+        in_str (str): The search term
+        pcp_type (str): The type of search (e.g. 'cid', 'smiles', 'name' or 'inchikey')
+
+    Returns:
+       list of pubchempy Compounds (empty if nothing found) or None if the request failed
+
+    """
+    key = (pcp_type, six.text_type(in_str))
+    if key in _pubchem_cache:
+        pubchem_cache_stats['hits'] += 1
+        return _pubchem_cache[key]
+
+    pubchem_cache_stats['misses'] += 1
+
+    try:
+        pccs = pcp.get_compounds(in_str, pcp_type)
+    except pcp.PubChemHTTPError as e:
+        print(e)
+        return None
+    except URLError as e:
+        print(e)
+        return None
+    except BadStatusLine as e:
+        print(e)
+        return None
+
+    _pubchem_cache[key] = pccs
+    return pccs
+
+
+def clear_pubchem_cache():
+    """ Remove all previous PubChem searches from the cache (and reset the cache statistics)
+    """
+    _pubchem_cache.clear()
+    pubchem_cache_stats['hits'] = 0
+    pubchem_cache_stats['misses'] = 0
+
+
+# line patterns checked for every line of a MSP file (compiled once rather than looked up in the re cache per line)
+_COMMENT_RE = re.compile('^Comment.*$', re.IGNORECASE)
+_QUOTED_RE = re.compile('"([^"]*)"')
+_PEAKS_RE = re.compile('^(?:Num Peaks|PK\$PEAK:)', re.IGNORECASE)
+_ANNOTATION_RE = re.compile('^PK\$ANNOTATION', re.IGNORECASE)
+_ANNOTATION_COLUMNS_RE = re.compile('^PK\$ANNOTATION:(.*)', re.IGNORECASE)
+_MASSBANK_PEAK_HEADER_RE = re.compile('^PK\$PEAK: m/z int\. rel\.int\.$', re.IGNORECASE)
+_NUM_PEAK_RE = re.compile('^PK\$NUM.*PEAK(.*)', re.IGNORECASE)
+_ADDUCT_POLARITY_RE = re.compile('^\[.*\](\-|\+)', re.IGNORECASE)
+
+# for the MySQL bulk insert the unique and foreign key checks (and the secondary keys of MyISAM tables) of these
+# tables are disabled until the end of the import
+_BULK_TABLES = ['metab_compound', 'library_spectra_meta', 'library_spectra', 'library_spectra_annotation']
+
+
+def _is_json(pth):
+    """ MoNA JSON exports are identified by the .json extension
+    """
+    return pth.lower().endswith('.json')
+
+
+def compile_regex(regex):
+    """ Compile a dictionary of regexes (e.g. from get_meta_regex) ignoring the case
+
+    Args:
+        regex (dict): dictionary of the key to a list of regexes
+
+    Returns:
+       ordered dictionary of the key to a list of compiled regexes
+    """
+    return collections.OrderedDict((k, [re.compile(reg, re.IGNORECASE) for reg in regexes])
+                                   for k, regexes in six.iteritems(regex))
+
+
+class Importer(object):
+    """Reusable MSP importer for SQL databases
+
+    The configuration is set when the Importer is created and the import is run with import_path (MSP files or
+    directories) or import_stream (file objects). The connection, compiled regexes, compound index (the inchikeys
+    already in the database), ids and the SPLASH worker pool are kept open between imports, so many (small) imports
+    can be run with the same Importer without the set up cost of each one.
 
     Example:
         >>> from msp2db.db import create_db
-        >>> from msp2db.parse import LibraryData
-        >>> db_pth = 'spectral_library.db'
-        >>> create_db(file_pth=db_pth, db_type='sqlite', db_name='spectra')
-        >>> libdata = LibraryData(msp_pth='MoNA-export-FAHFA.msp',
-        >>>                  db_pth=db_pth,
-        >>>                  db_type='sqlite',
-        >>>                  schema='mona',
-        >>>                  source='fahfa',
-        >>>                  chunk=200)
+        >>> from msp2db.parse import Importer
+        >>> create_db(file_pth='spectral_library.db')
+        >>> with Importer(db_pth='spectral_library.db', schema='mona') as importer:
+        >>>     importer.import_path('MoNA-export-FAHFA.msp', source='fahfa')
+        >>>     importer.import_path('MoNA-export-HMDB.msp', source='hmdb')
+        >>>     with open('new_records.msp') as f:
+        >>>         importer.import_stream(f, source='hmdb-update')
 
     Args:
-        msp_pth (str): path to msp file or directory [required]
-        db_pth (str): path to sqlite database (only required when using SQLite database) [default None]
-        source (str): Source of the msp files (e.g. massbank) [default 'unknown']
-        mslevel (int): If the msp file does not contain the mslevel this can be defined here [default None]
-        polarity (str): If the msp file does not contain the polarity this can be defined here [default None]
-        db_type (str): The type of database to submit to (either 'sqlite', 'mysql' or 'django_mysql') [default sqlite]
+        db_pth (str): path to sqlite database (only required when using SQLite database), for PostgreSQL this can be
+                      used for the connection string instead of the user, password, name, host and port [default None]
+        db_type (str): The type of database to submit to (either 'sqlite', 'mysql', 'postgres' or 'django_mysql')
+                       [default sqlite]
         user (str): Username for database (only required for non Django mysql databases) [default None]
         password (str): Password for database (only required for non Django mysql databases) [default None]
         mysql_db_name (str):  Name of the mysql database (only required for non Django mysql databases) [default None]
+        host (str): Host of the MySQL or PostgreSQL server [default None]
+        port (int): Port of the MySQL or PostgreSQL server [default None]
         chunk (int): Chunks of spectra to parse data (useful to control memory usage) [default 200]
-        schema (str): MSP files can vary based on how they were made, two standard schemas are available either 'mona'
-                      based on the MassBank of North America (MoNA) MSP files. And 'massbank' which is based on the
-                      more controlled MassBank MSP files https://github.com/MassBank/MassBank-data [default 'mona']
-        user_meta_regex (dict): For other MSP files not derived from either MoNA or MassBank a custom dictionary of
-                                regexes can be used [default None]
-        user_compound_regex (dict): For other MSP files not derived from either MoNA or MassBank a custom dictionary of
-                                    regexes can be used [default None]
-        compound_lookup (boolean): Include compound lookup
-        celery_obj (boolean): If using Django a Celery task object can be used to keep track on ongoing tasks
-                              [default False]
+        schema (str): Either 'mona' or 'massbank' (see LibraryData) [default 'mona']
+        user_meta_regex (dict): Custom dictionary of meta data regexes [default None]
+        user_compound_regex (dict): Custom dictionary of compound regexes [default None]
+        compound_lookup (boolean): Include compound lookup [default True]
+        structure_lookup (boolean): If RDKit is installed, derive the InChIKey, molecular formula and exact mass from
+                                    any SMILES or InChI in the record before using PubChem lookups [default True]
+        structure_processes (int): Number of worker processes used to evaluate the structures of a file before
+                                   parsing [default 1]
+        mysql_bulk (str): Bulk insert method for MySQL databases either 'load_data' or 'multirow' [default None]
+        checkpoint (boolean): Record the progress of each import_path in the library_import_progress table
+                              [default True]
+        compute_splash (boolean): Calculate the SPLASH of each spectrum without a SPLASH in the MSP file
+                                  [default False]
+        splash_processes (int): Number of worker processes used to calculate the SPLASHs of each chunk [default 1]
+        fragment_index_pth (str): Path of a FragmentIndex sidecar file to update as each chunk is inserted (it is
+                                  built from the database if it does not exist) [default None]
+        neutral_loss_index_pth (str): Path of a NeutralLossIndex sidecar file to update as each chunk is inserted
+                                      (it is built from the database if it does not exist) [default None]
+        spectra_summary (boolean): Store the summary of each spectrum (number of peaks, base peak, TIC and m/z range)
+                                   in the library_spectra_summary table, see msp2db.summary [default True]
+        compound_synonyms (boolean): Store the name and other names of each new compound in the
+                                     metab_compound_synonym table (and full-text index), see msp2db.synonyms
+                                     [default True]
+        conn (connection object): Use an existing database connection (it is not closed by close) [default None]
 
     Returns:
-        LibraryData object
+        Importer object
     """
-    def __init__(self, msp_pth, db_pth=None,
-                 mslevel=None, polarity=None, source='unknown', db_type='sqlite', password=None, user=None,
-                 mysql_db_name=None, chunk=200, schema='mona', user_meta_regex=None, user_compound_regex=None,
-                 compound_lookup=True, celery_obj=False):
+    def __init__(self, db_pth=None, db_type='sqlite', password=None, user=None, mysql_db_name=None, chunk=200,
+                 schema='mona', user_meta_regex=None, user_compound_regex=None, compound_lookup=True,
+                 structure_lookup=True, structure_processes=1, mysql_bulk=None, host=None, port=None,
+                 checkpoint=True, compute_splash=False, splash_processes=1, fragment_index_pth=None,
+                 neutral_loss_index_pth=None, spectra_summary=True, compound_synonyms=True, conn=None):
 
-        # get the database connection (either sqlite, mysql or Django mysql)
-        conn = get_connection(db_type, db_pth, user, password, mysql_db_name)
+        self.db_pth = db_pth
+        self.db_type = db_type
+        self.user = user
+        self.password = password
+        self.mysql_db_name = mysql_db_name
+        self.host = host
+        self.port = port
+        self.chunk = chunk
+        self.compound_lookup = compound_lookup
+        self.structure_lookup = structure_lookup and RDKIT_AVAILABLE
+        self.structure_processes = structure_processes
+        self.mysql_bulk = mysql_bulk if db_type == 'mysql' else None
+        self.checkpoint = checkpoint
+        self.compute_splash = compute_splash
+        self.splash_processes = splash_processes
+        self.fragment_index_pth = fragment_index_pth
+        self.neutral_loss_index_pth = neutral_loss_index_pth
+        self.spectra_summary = spectra_summary
+        self.compound_synonyms = compound_synonyms
 
-        # set up object variables
-        self.c = conn.cursor()
         self.conn = conn
-        self.db_pth = db_pth
+        self.c = None
+        self.own_conn = conn is None
+        self.compound_ids = set()
+        self.splash_pool = None
+        # the peak indexes (see msp2db.index) updated with each chunk, a list of (sidecar path, index) tuples
+        self.peak_indexes = []
+        self.peak_rows_per_second = {}
+
+        # Either get standard regexs or the user provided regexes
+        if user_meta_regex:
+            self.meta_regex = user_meta_regex
+        else:
+            self.meta_regex = get_meta_regex(schema=schema)
+
+        if user_compound_regex:
+            self.compound_regex = user_compound_regex
+        else:
+            self.compound_regex = get_compound_regex(schema=schema)
+
+        self.inchi_regex = get_inchi_regex(schema=schema)
+        self.meta_patterns = compile_regex(self.meta_regex)
+        self.compound_patterns = compile_regex(self.compound_regex)
+        self.inchi_patterns = [re.compile(reg, re.IGNORECASE) for reg in self.inchi_regex]
+
+        self._reset()
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        """ Open the database connection (if one was not provided) and load the compound index
+
+        Called by import_path and import_stream if the Importer is not already open.
+
+        Returns:
+           the Importer object
+        """
+        if self.c is not None:
+            return self
+
+        # get the database connection (either sqlite, mysql, postgres or Django mysql)
+        if self.conn is None:
+            self.conn = get_connection(self.db_type, self.db_pth, self.user, self.password, self.mysql_db_name,
+                                       local_infile=self.mysql_bulk == 'load_data', host=self.host, port=self.port)
+        self.c = self.conn.cursor()
+        self.get_compound_ids()
+
+        if self.checkpoint:
+            create_table(self.conn, 'library_import_progress', self.db_type)
+
+        if self.spectra_summary:
+            create_table(self.conn, 'library_spectra_summary', self.db_type)
+
+        if self.compound_synonyms:
+            create_table(self.conn, 'metab_compound_synonym', self.db_type)
+
+        if self.compute_splash and self.splash_processes and self.splash_processes > 1:
+            # the pool is shared by all the chunks (and imports)
+            self.splash_pool = multiprocessing.Pool(processes=self.splash_processes)
+
+        for index_cls, pth in ((FragmentIndex, self.fragment_index_pth),
+                               (NeutralLossIndex, self.neutral_loss_index_pth)):
+            if not pth:
+                continue
+            if os.path.exists(pth):
+                self.peak_indexes.append((pth, index_cls.load(pth)))
+            else:
+                self.peak_indexes.append((pth, index_cls.from_db(self.conn, self.db_type)))
+
+        return self
+
+    def import_path(self, msp_pth, source='unknown', mslevel=None, polarity=None, celery_obj=False, resume=False,
+                    incremental=False):
+        """ Import a MSP file (or directory of MSP files) into the database
+
+        Files with the .json extension are read as MoNA JSON exports (see msp2db.mona), the metaData of each record
+        is mapped directly onto the meta and compound details and the JSON array is read incrementally.
+
+        Example:
+            >>> importer.import_path('MoNA-export-FAHFA.msp', source='fahfa')
+
+        Args:
+            msp_pth (str): path to msp file (or MoNA JSON file) or directory [required]
+            source (str): Source of the msp files (e.g. massbank) [default 'unknown']
+            mslevel (int): If the msp file does not contain the mslevel this can be defined here [default None]
+            polarity (str): If the msp file does not contain the polarity this can be defined here [default None]
+            celery_obj (boolean): If using Django a Celery task object can be used to keep track on ongoing tasks
+                                  [default False]
+            resume (boolean): Resume the last incomplete import of msp_pth from its last committed chunk
+                              [default False]
+            incremental (boolean): Only import the records that are new or have changed since the last incremental
+                                   import of the same source, records no longer present are removed [default False]
+
+        Returns:
+           Number of spectra inserted
+        """
+        if incremental and resume:
+            raise ValueError('An incremental import can not be resumed (run the incremental import again)')
+
+        self.open()
+        self._reset(source, mslevel, polarity, incremental, checkpoint=self.checkpoint or resume)
+        self.msp_pth = os.path.abspath(msp_pth)
+
+        if resume:
+            create_table(self.conn, 'library_import_progress', self.db_type)
+            if not self._load_checkpoint():
+                return 0
+
+        if self.progress_id is None:
+            # a checkpoint of the starting ids so that the rows of a first chunk that is not committed completely
+            # are removed when resuming
+            self._save_checkpoint()
+        first_id = self.current_id_meta
+
+        # parse the file(s), for the MySQL bulk insert the key checks are disabled until the end of the import
+        with bulk_load(self.conn, _BULK_TABLES, self.db_type if self.mysql_bulk else None):
+            self._parse_files(msp_pth, self.chunk, self.db_type, celery_obj=celery_obj,
+                              compound_lookup=self.compound_lookup)
+
+        self._report_rates()
+        return self.current_id_meta - first_id
+
+    def import_stream(self, f, source='unknown', mslevel=None, polarity=None, incremental=False, name='<stream>',
+                      file_format='msp'):
+        """ Import the MSP (or MoNA JSON) records of a file object (e.g. a decompressed download or stdin) into the
+        database
+
+        The stream is only read once (so the structures are not evaluated in a pool before parsing) and the import
+        can not be resumed.
+
+        Example:
+            >>> with gzip.open('MoNA-export-FAHFA.msp.gz', 'rt') as f:
+            >>>     importer.import_stream(f, source='fahfa')
+
+        Args:
+            f (file object): Text or binary (utf-8) file object of the MSP records [required]
+            source (str): Source of the msp records (e.g. massbank) [default 'unknown']
+            mslevel (int): If the records do not contain the mslevel this can be defined here [default None]
+            polarity (str): If the records do not contain the polarity this can be defined here [default None]
+            incremental (boolean): Only import the records that are new or have changed since the last incremental
+                                   import of the same source [default False]
+            name (str): Name of the stream used in the messages [default '<stream>']
+            file_format (str): Format of the records either 'msp' or 'json' (a MoNA JSON export) [default 'msp']
+
+        Returns:
+           Number of spectra inserted
+        """
+        if file_format not in ('msp', 'json'):
+            raise ValueError('Unknown file format "{}" (either "msp" or "json")'.format(file_format))
+
+        self.open()
+        self._reset(source, mslevel, polarity, incremental, checkpoint=False)
+        self.msp_pth = name
+        self.current_file = name
+        first_id = self.current_id_meta
+
+        if isinstance(f.read(0), bytes):
+            f = io.TextIOWrapper(f, encoding='utf-8')
+
+        parse = self._parse_json if file_format == 'json' else self._parse_lines
+        with bulk_load(self.conn, _BULK_TABLES, self.db_type if self.mysql_bulk else None):
+            parse(f, self.chunk, self.db_type, compound_lookup=self.compound_lookup)
+            self._finish_import(self.db_type)
+
+        self._report_rates()
+        return self.current_id_meta - first_id
+
+    def close(self):
+        """ Close the SPLASH worker pool and the database connection (unless the connection was provided)
+        """
+        self._close_pool()
+        if self.conn is not None and self.own_conn:
+            self.conn.close()
+            self.conn = None
+        self.c = None
+
+    def _reset(self, source='unknown', mslevel=None, polarity=None, incremental=False, checkpoint=False):
+        """Reset the state of the parser for a new import
+        """
         self.meta_info_all = []
         self.compound_info_all = []
-        self.compound_ids = []
-        self.get_compound_ids()
         self.spectra_all = []
         self.spectra_annotation_all = []
         self.start_spectra = False
@@ -94,26 +402,47 @@ class LibraryData(object):
         self.mslevel = mslevel
         self.polarity = polarity
         self.other_names = []
-
-        # Either get standard regexs or the user provided regexes
-        if user_meta_regex:
-            self.meta_regex = user_meta_regex
-        else:
-            self.meta_regex = get_meta_regex(schema=schema)
-
-        if user_compound_regex:
-            self.compound_regex = user_meta_regex
-        else:
-            self.compound_regex = get_compound_regex(schema=schema)
+        self.inchi = ''
+        self.msp_pth = None
+        self.save_progress = checkpoint
+        self.progress_id = None
+        self.current_file = None
+        self.file_offset = 0
+        self.record_ordinal = 0
+        self.resume_file = None
+        self.resume_offset = 0
+        self.incremental = incremental
+        self.record_lines = []
+        self.record_has_peaks = False
+        self.previous_hashes = {}
+        self.hash_all = []
+        self.inserted_accessions = set()
+        self.delta_stats = {'new': 0, 'changed': 0, 'unchanged': 0, 'retired': 0}
 
         # initiate the meta data
         self.meta_info = get_blank_dict(self.meta_regex)
         self.compound_info = get_blank_dict(self.compound_regex)
+
+        if self.c is None:
+            return
+
         self._get_current_ids()
 
-        # parse the file(s)
-        self._parse_files(msp_pth, chunk, db_type, celery_obj=celery_obj,
-                          compound_lookup=compound_lookup)
+        if incremental:
+            create_table(self.conn, 'library_spectra_hash', self.db_type)
+            self._load_previous_hashes()
+
+    def _report_rates(self):
+        if self.mysql_bulk:
+            for table, rate in six.iteritems(self.peak_rows_per_second):
+                print('peak rows per second {}: {:.0f}'.format(table, rate))
+
+    def _close_pool(self):
+        if self.splash_pool is not None:
+            self.splash_pool.close()
+            self.splash_pool.join()
+            self.splash_pool = None
+
 
     def _get_current_ids(self, source=True, meta=True, spectra=True, spectra_annotation=True):
         """Get the current id for each table in the database
@@ -184,24 +513,179 @@ class LibraryData(object):
             for folder, subs, files in sorted(os.walk(msp_pth)):
                 for msp_file in sorted(files):
                     msp_file_pth = os.path.join(folder, msp_file)
-                    if os.path.isdir(msp_file_pth) or not msp_file_pth.lower().endswith(('txt', 'msp')):
+                    if os.path.isdir(msp_file_pth) or not msp_file_pth.lower().endswith(('txt', 'msp', 'json')):
+                        continue
+                    if self.resume_file and os.path.abspath(msp_file_pth) != self.resume_file:
+                        # already imported (the files are always processed in the same order)
                         continue
                     print('MSP FILE PATH', msp_file_pth)
 
-                    self.num_lines = line_count(msp_file_pth)
+                    # the line count is only needed to report the progress of a celery task
+                    self.num_lines = line_count(msp_file_pth) if celery_obj else None
+                    self._prefetch_structures(msp_file_pth, compound_lookup)
                     # each file is processed separately but we want to still process in chunks so we save the number
                     # of spectra currently being processed with the c variable
-                    with open(msp_file_pth, "r") as f:
-                        c = self._parse_lines(f, chunk, db_type, celery_obj,
-                                              c,
-                                              compound_lookup=compound_lookup)
-        else:
-            self.num_lines = line_count(msp_pth)
-            with open(msp_pth, "r") as f:
-                self._parse_lines(f, chunk, db_type, celery_obj,
+                    parse = self._parse_json if _is_json(msp_file_pth) else self._parse_lines
+                    with self._open_msp(msp_file_pth) as f:
+                        c = parse(f, chunk, db_type, celery_obj,
+                                  c,
                                   compound_lookup=compound_lookup)
+        else:
+            self.num_lines = line_count(msp_pth) if celery_obj else None
+            self._prefetch_structures(msp_pth, compound_lookup)
+            parse = self._parse_json if _is_json(msp_pth) else self._parse_lines
+            with self._open_msp(msp_pth) as f:
+                parse(f, chunk, db_type, celery_obj,
+                      compound_lookup=compound_lookup)
 
+        self._finish_import(db_type)
+
+    def _finish_import(self, db_type):
+        """Insert the last chunk, remove the retired records (incremental imports) and mark the import as complete
+        """
         self.insert_data(remove_data=True, db_type=db_type)
+        if self.incremental:
+            self._retire_records(db_type)
+        self._save_checkpoint('complete')
+        for pth, index in self.peak_indexes:
+            index.save(pth)
+
+    def _open_msp(self, msp_pth):
+        """Open a MSP file for parsing, if resuming an import of the file it is opened at the last committed record
+
+        The file is read in binary and decoded so that the byte offset of each line can be tracked for checkpoints
+        """
+        f = io.open(msp_pth, 'rb')
+        self.current_file = os.path.abspath(msp_pth)
+        if self.current_file == self.resume_file:
+            f.seek(self.resume_offset)
+            self.file_offset = self.resume_offset
+            self.resume_file = None
+        else:
+            self.file_offset = 0
+            self.record_ordinal = 0
+        # newline='' keeps the line endings so the length of each line in bytes is known
+        return io.TextIOWrapper(f, encoding='utf-8', newline='')
+
+    def _load_checkpoint(self):
+        """Get the last checkpoint of the import of msp_pth and remove any rows inserted after it
+
+        Returns:
+            False if the last import of msp_pth is already complete (otherwise True)
+        """
+        c = self.conn.cursor()
+        c.execute('SELECT id, library_spectra_source_id, source_file, byte_offset, record_ordinal, next_meta_id, '
+                  'next_spectra_id, next_spectra_annotation_id, status FROM library_import_progress '
+                  'WHERE msp_pth = {} ORDER BY id DESC LIMIT 1'.format(self._type_sign()), (self.msp_pth,))
+        rows = c.fetchall()
+        if not rows:
+            print('No previous import of {} found, starting a new import'.format(self.msp_pth))
+            return True
+
+        (self.progress_id, self.current_id_origin, self.resume_file, self.resume_offset, self.record_ordinal,
+         next_meta_id, next_spectra_id, next_spectra_annotation_id, status) = rows[0]
+
+        if status == 'complete':
+            print('The import of {} is already complete'.format(self.msp_pth))
+            return False
+
+        # rows from a chunk that was not committed completely (the children first as they reference the meta rows),
+        # each table of a chunk is committed separately so any of them can have rows after the checkpoint
+        create_table(self.conn, 'library_spectra_hash', self.db_type)
+        create_table(self.conn, 'library_spectra_summary', self.db_type)
+        for table, column, next_id in (('library_spectra_hash', 'library_spectra_meta_id', next_meta_id),
+                                       ('library_spectra_summary', 'library_spectra_meta_id', next_meta_id),
+                                       ('library_spectra', 'id', next_spectra_id),
+                                       ('library_spectra_annotation', 'id', next_spectra_annotation_id),
+                                       ('library_spectra_meta', 'id', next_meta_id)):
+            c.execute('DELETE FROM {} WHERE {} >= {}'.format(table, column, self._type_sign()), (next_id,))
+        self.conn.commit()
+
+        # the sidecars are only saved at the end of an import
+        self.peak_indexes = [(pth, type(index).from_db(self.conn, self.db_type, index.bin_width))
+                             for pth, index in self.peak_indexes]
+
+        # the source row is inserted with the first chunk (which may not have been committed)
+        c.execute('SELECT count(*) FROM library_spectra_source WHERE id = {}'.format(self._type_sign()),
+                  (self.current_id_origin,))
+        self.update_source = not c.fetchall()[0][0]
+        self._get_current_ids(source=False)
+        print('Resuming the import of {} from record {} of {}'.format(self.msp_pth, self.record_ordinal,
+                                                                       self.resume_file))
+        return True
+
+    def _save_checkpoint(self, status='running'):
+        """Record the progress of the import after a chunk has been committed
+        """
+        if not self.save_progress:
+            return
+
+        ts = self._type_sign()
+        values = (self.current_id_origin, self.msp_pth, self.current_file, self.file_offset, self.record_ordinal,
+                  self.current_id_meta, self.current_id_spectra, self.current_id_spectra_annotation, status,
+                  str(datetime.datetime.now()))
+        cn = 'library_spectra_source_id, msp_pth, source_file, byte_offset, record_ordinal, next_meta_id, ' \
+             'next_spectra_id, next_spectra_annotation_id, status, updated_at'
+
+        c = self.conn.cursor()
+        if self.progress_id is None:
+            c.execute('SELECT max(id) FROM library_import_progress')
+            self.progress_id = (c.fetchall()[0][0] or 0) + 1
+            c.execute('INSERT INTO library_import_progress (id, {}) VALUES ({})'.format(cn, ', '.join([ts] * 11)),
+                      (self.progress_id,) + values)
+        else:
+            c.execute('UPDATE library_import_progress SET {} WHERE id = {}'.format(
+                ', '.join('{} = {}'.format(col.strip(), ts) for col in cn.split(',')), ts),
+                values + (self.progress_id,))
+        self.conn.commit()
+
+    def _type_sign(self):
+        return '?' if self.db_type == 'sqlite' else '%s'
+
+    def _prefetch_structures(self, msp_pth, compound_lookup=True):
+        """Evaluate all the SMILES and InChIs in a file with a pool of worker processes before parsing
+
+        The results are stored in the structure memo cache (see msp2db.chem) so each record lookup during parsing
+        is just a cache lookup. Only used when structure_processes is greater than 1.
+
+        Args:
+            msp_pth (str): path to msp file [required]
+            compound_lookup (bool): Compound lookup
+        """
+        # for incremental imports most records will be unchanged (and will not be parsed)
+        if not (compound_lookup and self.structure_lookup and self.structure_processes
+                and self.structure_processes > 1) or self.incremental:
+            return
+
+        structures = []
+        if _is_json(msp_pth):
+            with io.open(msp_pth, 'rb') as f:
+                for record, _ in iter_json_records(f):
+                    _, compound_info, _, inchi = record_info(record)
+                    if compound_info.get('smiles'):
+                        structures.append(('smiles', compound_info['smiles']))
+                    if inchi:
+                        structures.append(('inchi', inchi))
+            structure_info_batch(structures, processes=self.structure_processes)
+            return
+
+        with open(msp_pth, "r") as f:
+            for line in f:
+                line = line.rstrip()
+                if _COMMENT_RE.match(line):
+                    lines = _QUOTED_RE.findall(line)
+                else:
+                    lines = [line]
+
+                for l in lines:
+                    for structure_type, regexes in (('smiles', self.compound_patterns.get('smiles', [])),
+                                                    ('inchi', self.inchi_patterns)):
+                        for reg in regexes:
+                            m = reg.search(l)
+                            if m:
+                                structures.append((structure_type, m.group(1).strip()))
+
+        structure_info_batch(structures, processes=self.structure_processes)
 
     def _parse_lines(self, f, chunk, db_type, celery_obj=False, c=0,
                      compound_lookup=True):
@@ -221,28 +705,204 @@ class LibraryData(object):
 
         for i, line in enumerate(f):
 
+            if self.save_progress:
+                self.file_offset += len(line.encode('utf-8'))
+
             line = line.rstrip()
 
             if i == 0:
                 old = self.current_id_meta
 
-            self._update_libdata(line, compound_lookup)
+            if self.incremental:
+                self._update_record(line, compound_lookup)
+            else:
+                self._update_libdata(line, compound_lookup)
 
             if self.current_id_meta > old:
                 old = self.current_id_meta
+                self.record_ordinal += 1
                 c += 1
 
             if c > chunk:
+                self._insert_chunk(db_type, celery_obj, i)
+                c = 0
+
+        if self.incremental:
+            # the last record of the file might not have a terminating line
+            self._end_record(compound_lookup)
+        return c
+
+    def _parse_json(self, f, chunk, db_type, celery_obj=False, c=0, compound_lookup=True):
+        """Parse the records of a MoNA JSON file (a JSON array) and insert into database
+
+        The records are read one at a time (see msp2db.mona.iter_json_records) and the metaData of each record is
+        mapped directly onto the meta and compound details, rather than matching each line with the regexes.
 
-                if celery_obj:
-                    celery_obj.update_state(state='current spectra {}'.format(str(i)),
-                                            meta={'current': i, 'total': self.num_lines})
-                print(self.current_id_meta)
-                self.insert_data(remove_data=True, db_type=db_type)
-                self.update_source = False
+        Args:
+            f (file object): the opened file object
+            db_type (str): The type of database to submit to (either 'sqlite', 'mysql' or 'django_mysql') [required]
+            chunk (int): Chunks of spectra to parse data (useful to control memory usage) [required]
+            celery_obj (boolean): If using Django a Celery task object can be used to keep track on ongoing tasks
+                              [default False]
+            c (int): Number of spectra currently processed (will reset to 0 after that chunk of spectra has been
+                     inserted into the database
+            compound_lookup (bool): Compound lookup
+        """
+        for i, (record, nbytes) in enumerate(iter_json_records(f, offsets=self.save_progress)):
+            self.file_offset += nbytes
+            old = self.current_id_meta
+
+            if self.incremental:
+                self._update_json_record(record, compound_lookup)
+            else:
+                self._store_json_record(record, compound_lookup)
+
+            if self.current_id_meta > old:
+                self.record_ordinal += 1
+                c += 1
+
+            if c > chunk:
+                self._insert_chunk(db_type, celery_obj, i)
                 c = 0
         return c
 
+    def _insert_chunk(self, db_type, celery_obj, i):
+        """Insert the current chunk (the chunk always ends at the end of a record) and save the checkpoint
+        """
+        if celery_obj:
+            celery_obj.update_state(state='current spectra {}'.format(str(i)),
+                                    meta={'current': i, 'total': self.num_lines})
+        print(self.current_id_meta)
+        self.insert_data(remove_data=True, db_type=db_type)
+        self.update_source = False
+        # the chunk always ends at the end of a record so the import can be resumed from here
+        self._save_checkpoint()
+
+    def _store_json_record(self, record, compound_lookup=True):
+        """Store the meta data, compound details and peaks of a MoNA JSON record
+        """
+        meta_info, compound_info, self.other_names, self.inchi = record_info(record)
+        for k, v in six.iteritems(meta_info):
+            if k in self.meta_info:
+                self.meta_info[k] = v
+        for k, v in six.iteritems(compound_info):
+            if k in self.compound_info:
+                self.compound_info[k] = v
+
+        if self.mslevel:
+            self.meta_info['ms_level'] = self.mslevel
+
+        if self.polarity:
+            self.meta_info['polarity'] = self.polarity
+
+        self._store_info(compound_lookup)
+
+        peaks = parse_spectrum_string(record.get('spectrum'))
+        first_id = self.current_id_spectra
+        self.current_id_spectra += len(peaks)
+        self.spectra_all.extend(zip(range(first_id, self.current_id_spectra), peaks[:, 0].tolist(),
+                                    peaks[:, 1].tolist(), itertools.repeat(''),
+                                    itertools.repeat(self.current_id_meta)))
+        self.current_id_meta += 1
+
+    def _update_json_record(self, record, compound_lookup=True):
+        """Store a MoNA JSON record only if it is new or has changed since the last import (incremental imports only)
+        """
+        content_hash = record_hash([json.dumps(record, sort_keys=True)])
+        if self._unchanged(content_hash):
+            return
+
+        meta_id = self.current_id_meta
+        self._store_json_record(record, compound_lookup)
+        self._record_inserted(meta_id, content_hash)
+
+    def _load_previous_hashes(self):
+        """Get the hashes of the records from the previous incremental imports of the source (and use the same
+        library_spectra_source row)
+        """
+        ts = self._type_sign()
+        c = self.conn.cursor()
+        c.execute('SELECT max(m.library_spectra_source_id) FROM library_spectra_hash h '
+                  'JOIN library_spectra_meta m ON m.id = h.library_spectra_meta_id WHERE h.source = {}'.format(ts),
+                  (self.source,))
+        source_id = c.fetchall()[0][0]
+        if source_id:
+            self.current_id_origin = source_id
+            self.update_source = False
+
+        c.execute('SELECT library_spectra_meta_id, accession, content_hash FROM library_spectra_hash '
+                  'WHERE source = {}'.format(ts), (self.source,))
+        for meta_id, accession, content_hash in c:
+            self.previous_hashes.setdefault(content_hash, []).append((meta_id, accession))
+
+    def _update_record(self, line, compound_lookup=True):
+        """Collect the lines of the current record, the record is only parsed if it is new or has changed since the
+        last import (incremental imports only)
+        """
+        self.record_lines.append(line)
+        if _PEAKS_RE.match(line):
+            self.record_has_peaks = True
+        elif self.record_has_peaks and line in ('', '//'):
+            self._end_record(compound_lookup)
+
+    def _end_record(self, compound_lookup=True):
+        """Skip the collected record if it is unchanged since the last import, otherwise parse it
+        """
+        lines = self.record_lines
+        self.record_lines = []
+
+        if not self.record_has_peaks:
+            # not a record (e.g. blank lines at the end of a file)
+            for line in lines:
+                self._update_libdata(line, compound_lookup)
+            return
+        self.record_has_peaks = False
+
+        content_hash = record_hash(lines)
+        if self._unchanged(content_hash):
+            return
+
+        meta_id = self.current_id_meta
+        for line in lines:
+            self._update_libdata(line, compound_lookup)
+        self._record_inserted(meta_id, content_hash)
+
+    def _unchanged(self, content_hash):
+        """Check if a record is unchanged since the last import (each previous record can only be matched once)
+        """
+        if self.previous_hashes.get(content_hash):
+            self.previous_hashes[content_hash].pop()
+            self.delta_stats['unchanged'] += 1
+            return True
+        return False
+
+    def _record_inserted(self, meta_id, content_hash):
+        """Record the hash of an inserted record
+        """
+        accession = None
+        if self.meta_info_all and self.meta_info_all[-1][0] == str(meta_id):
+            accession = self.meta_info_all[-1][1 + list(self.meta_regex.keys()).index('accession')]
+
+        self.hash_all.append((meta_id, self.source, accession, content_hash))
+        self.inserted_accessions.add(accession)
+        self.delta_stats['new'] += 1
+
+    def _retire_records(self, db_type):
+        """Remove the records of the previous imports of the source that were not in this import
+        """
+        retired = [r for records in self.previous_hashes.values() for r in records]
+        delete_spectra(self.conn, [meta_id for meta_id, _ in retired], db_type)
+        for _, index in self.peak_indexes:
+            index.remove([meta_id for meta_id, _ in retired])
+
+        # a changed record is one that has been retired and inserted again with the same accession
+        changed = len([accession for _, accession in retired if accession in self.inserted_accessions])
+        self.delta_stats['changed'] = changed
+        self.delta_stats['new'] -= changed
+        self.delta_stats['retired'] = len(retired) - changed
+        print('{} records new, {} changed, {} unchanged and {} retired'.format(
+            self.delta_stats['new'], changed, self.delta_stats['unchanged'], self.delta_stats['retired']))
+
     def _update_libdata(self, line, compound_lookup=True):
         """Update the library meta data from the current line being parsed
 
@@ -255,8 +915,8 @@ class LibraryData(object):
         ####################################################
         # The mona msp files contain a "comments" line that contains lots of other information normally separated
         # into by ""
-        if re.match('^Comment.*$', line, re.IGNORECASE):
-            comments = re.findall('"([^"]*)"', line)
+        if _COMMENT_RE.match(line):
+            comments = _QUOTED_RE.findall(line)
             for c in comments:
                 self._parse_meta_info(c)
                 self._parse_compound_info(c)
@@ -275,33 +935,22 @@ class LibraryData(object):
         # Most MSP files have the a standard line of text before the spectra information begins. Here we check
         # for this line and store the relevant details for the compound and meta information to be ready for insertion
         # into the database
-        if self.collect_meta and (re.match('^Num Peaks(.*)$', line, re.IGNORECASE) or re.match('^PK\$PEAK:(.*)', line,
-                re.IGNORECASE) or re.match('^PK\$ANNOTATION(.*)', line, re.IGNORECASE)):
-            if compound_lookup:
-                self._store_compound_info()
-            else:
-                self.compound_info['inchikey_id'] = 'UNKNOWN_' + str(uuid.uuid4())
-
-            self._store_meta_info()
-
-            # Reset the temp meta and compound information
-            self.meta_info = get_blank_dict(self.meta_regex)
-            self.compound_info = get_blank_dict(self.compound_regex)
-            self.other_names = []
+        if self.collect_meta and (_PEAKS_RE.match(line) or _ANNOTATION_RE.match(line)):
+            self._store_info(compound_lookup)
             self.collect_meta = False
 
         # ignore additional information in the 3rd column if using the MassBank spectra schema
-        if re.match('^PK\$PEAK: m/z int\. rel\.int\.$', line, re.IGNORECASE):
+        if _MASSBANK_PEAK_HEADER_RE.match(line):
             self.ignore_additional_spectra_info = True
 
         # Check if annnotation or spectra is to be in the next lines to be parsed
-        if re.match('^Num Peaks(.*)$', line, re.IGNORECASE) or re.match('^PK\$PEAK:(.*)', line, re.IGNORECASE):
+        if _PEAKS_RE.match(line):
             self.start_spectra = True
             return
-        elif re.match('^PK\$ANNOTATION(.*)', line, re.IGNORECASE):
+        elif _ANNOTATION_RE.match(line):
             self.start_spectra_annotation = True
 
-            match = re.match('^PK\$ANNOTATION:(.*)', line, re.IGNORECASE)
+            match = _ANNOTATION_COLUMNS_RE.match(line)
             columns = match.group(1)
             cl = columns.split()
 
@@ -321,15 +970,29 @@ class LibraryData(object):
         if self.start_spectra:
             self._parse_spectra(line)
 
+    def _store_info(self, compound_lookup=True):
+        """Store the compound and meta details of the current record and reset them for the next record
+        """
+        if compound_lookup:
+            self._store_compound_info()
+        else:
+            self.compound_info['inchikey_id'] = 'UNKNOWN_' + str(uuid.uuid4())
+
+        self._store_meta_info()
+
+        # Reset the temp meta and compound information
+        self.meta_info = get_blank_dict(self.meta_regex)
+        self.compound_info = get_blank_dict(self.compound_regex)
+        self.other_names = []
+        self.inchi = ''
+
     def get_compound_ids(self):
-        """Extract the current compound ids in the database. Updates the self.compound_ids list
+        """Extract the current compound ids in the database. Updates the self.compound_ids set
         """
         cursor = self.conn.cursor()
         cursor.execute('SELECT inchikey_id FROM metab_compound')
         self.conn.commit()
-        for row in cursor:
-            if not row[0] in self.compound_ids:
-                self.compound_ids.append(row[0])
+        self.compound_ids.update(row[0] for row in cursor)
 
     def _store_compound_info(self):
         """Update the compound_info dictionary with the current chunk of compound details
@@ -340,6 +1003,10 @@ class LibraryData(object):
         other_name_l = [name for name in self.other_names if name != self.compound_info['name']]
         self.compound_info['other_names'] = ' <#> '.join(other_name_l)
 
+        local = False
+        if not self.compound_info['inchikey_id'] and self.structure_lookup:
+            local = self._set_inchi_local()
+
         if not self.compound_info['inchikey_id']:
             self._set_inchi_pcc(self.compound_info['pubchem_id'], 'cid', 0)
 
@@ -355,7 +1022,7 @@ class LibraryData(object):
             print('#########################')
             self.compound_info['inchikey_id'] = 'UNKNOWN_' + str(uuid.uuid4())
 
-        if not self.compound_info['pubchem_id'] and self.compound_info['inchikey_id']:
+        if not self.compound_info['pubchem_id'] and self.compound_info['inchikey_id'] and not local:
             self._set_inchi_pcc(self.compound_info['inchikey_id'], 'inchikey', 0)
 
         if not self.compound_info['name']:
@@ -366,7 +1033,7 @@ class LibraryData(object):
                 str(datetime.datetime.now()),
                 str(datetime.datetime.now()),
             ))
-            self.compound_ids.append(self.compound_info['inchikey_id'])
+            self.compound_ids.add(self.compound_info['inchikey_id'])
 
     def _store_meta_info(self):
         """Update the meta dictionary with the current chunk of meta data details
@@ -380,7 +1047,7 @@ class LibraryData(object):
 
         if not self.meta_info['polarity']:
             # have to do special check for polarity (as sometimes gets missed)
-            m = re.search('^\[.*\](\-|\+)', self.meta_info['precursor_type'], re.IGNORECASE)
+            m = _ADDUCT_POLARITY_RE.search(self.meta_info['precursor_type'])
             if m:
                 polarity = m.group(1).strip()
                 if polarity == '+':
@@ -400,7 +1067,7 @@ class LibraryData(object):
     def _parse_spectra_annotation(self, line):
         """Parse and store the spectral annotation details
         """
-        if re.match('^PK\$NUM.*PEAK(.*)', line, re.IGNORECASE):
+        if _NUM_PEAK_RE.match(line):
             self.start_spectra_annotation = False
             return
 
@@ -443,29 +1110,33 @@ class LibraryData(object):
 
         self.current_id_spectra += 1
 
+    def _set_inchi_local(self):
+        """Derive the inchikey (and any missing formula or exact mass) from the SMILES or InChI of the record
+
+        Returns:
+            True if the inchikey could be derived locally
+        """
+        info = structure_info(smiles=self.compound_info['smiles'], inchi=self.inchi)
+        if not info:
+            return False
+
+        self.compound_info['inchikey_id'] = info['inchikey_id']
+
+        if not self.compound_info['molecular_formula']:
+            self.compound_info['molecular_formula'] = info['molecular_formula']
+
+        if not self.compound_info['exact_mass']:
+            self.compound_info['exact_mass'] = info['exact_mass']
+
+        return True
+
     def _set_inchi_pcc(self, in_str, pcp_type, elem):
         """Check pubchem compounds via API for both an inchikey and any available compound details
         """
         if not in_str:
             return 0
 
-        try:
-            pccs = pcp.get_compounds(in_str, pcp_type)
-        except pcp.BadRequestError as e:
-            print(e)
-            return 0
-        except pcp.TimeoutError as e:
-            print(e)
-            return 0
-        except pcp.ServerError as e:
-            print(e)
-            return 0
-        except URLError as e:
-            print(e)
-            return 0
-        except BadStatusLine as e:
-            print(e)
-            return 0
+        pccs = get_pubchem_compounds(in_str, pcp_type)
 
         if pccs:
             pcc = pccs[elem]
@@ -485,10 +1156,25 @@ class LibraryData(object):
         Args:
              line (str): line of the msp file
         """
-        m = re.search(self.compound_regex['other_names'][0], line, re.IGNORECASE)
+        m = self.compound_patterns['other_names'][0].search(line)
         if m:
             self.other_names.append(m.group(1).strip())
 
+    def _get_inchi(self, line):
+        """Parse and extract the InChI that might be recorded for the compound (only the first one is used)
+
+        Args:
+             line (str): line of the msp file
+        """
+        if self.inchi:
+            return
+
+        for reg in self.inchi_patterns:
+            m = reg.search(line)
+            if m:
+                self.inchi = m.group(1).strip()
+                return
+
     def _parse_meta_info(self, line):
         """Parse and extract all meta data by looping through the dictionary of meta_info regexs
 
@@ -503,10 +1189,10 @@ class LibraryData(object):
         if self.polarity:
             self.meta_info['polarity'] = self.polarity
 
-        for k, regexes in six.iteritems(self.meta_regex):
+        for k, regexes in six.iteritems(self.meta_patterns):
             for reg in regexes:
 
-                m = re.search(reg, line, re.IGNORECASE)
+                m = reg.search(line)
 
                 if m:
                     self.meta_info[k] = m.group(1).strip()
@@ -520,15 +1206,16 @@ class LibraryData(object):
              line (str): line of the msp file
 
         """
-        for k, regexes in six.iteritems(self.compound_regex):
+        for k, regexes in six.iteritems(self.compound_patterns):
             for reg in regexes:
                 if self.compound_info[k]:
                     continue
-                m = re.search(reg, line, re.IGNORECASE)
+                m = reg.search(line)
                 if m:
                     self.compound_info[k] = m.group(1).strip()
 
         self._get_other_names(line)
+        self._get_inchi(line)
 
     def insert_data(self, remove_data=False, db_type='sqlite'):
         """Insert data stored in the current chunk of parsing into the selected database
@@ -538,41 +1225,55 @@ class LibraryData(object):
              remove_data (boolean): Remove the data stored within the LibraryData object for the current chunk of
                                     processing
              db_type (str): The type of database to submit to
-                            either 'sqlite', 'mysql' or 'django_mysql' [default sqlite]
+                            either 'sqlite', 'mysql', 'postgres' or 'django_mysql' [default sqlite]
         """
-        if self.update_source:
-            # print "insert ref id"
-            import msp2db
-            self.c.execute(
-                "INSERT INTO library_spectra_source (id, name, parsing_software) VALUES"
-                " ({a}, '{b}', 'msp2db-v{c}')".format(a=self.current_id_origin, b=self.source, c=msp2db.__version__))
-            self.conn.commit()
+        # for Django each chunk is inserted in one transaction (so a chunk is either inserted completely or not at all)
+        with chunk_transaction(self.conn, db_type):
+            if self.update_source:
+                # print "insert ref id"
+                import msp2db
+                self._insert([(self.current_id_origin, self.source, 'msp2db-v{}'.format(msp2db.__version__))],
+                             'library_spectra_source', 'id, name, parsing_software', db_type)
+
+            if self.compound_info_all:
+                self.compound_info_all = _make_sql_compatible(self.compound_info_all)
+
+                cn = ', '.join(self.compound_info.keys()) + ',created_at,updated_at'
+
+                self._insert(self.compound_info_all, 'metab_compound', cn, db_type, ignore_conflicts=True)
 
-        if self.compound_info_all:
-            self.compound_info_all = _make_sql_compatible(self.compound_info_all)
+                if self.compound_synonyms:
+                    insert_synonyms(self.conn, self._synonym_rows(), db_type)
 
-            cn = ', '.join(self.compound_info.keys()) + ',created_at,updated_at'
+            if self.meta_info_all:
+                if self.compute_splash:
+                    self._set_splash()
 
-            insert_query_m(self.compound_info_all, columns=cn, conn=self.conn, table='metab_compound',
-                           db_type=db_type)
+                self.meta_info_all = _make_sql_compatible(self.meta_info_all)
 
-        if self.meta_info_all:
-            self.meta_info_all = _make_sql_compatible(self.meta_info_all)
+                cn = 'id,' + ', '.join(self.meta_info.keys()) + ',library_spectra_source_id, inchikey_id'
 
-            cn = 'id,' + ', '.join(self.meta_info.keys()) + ',library_spectra_source_id, inchikey_id'
+                self._insert(self.meta_info_all, 'library_spectra_meta', cn, db_type)
 
-            insert_query_m(self.meta_info_all, columns=cn, conn=self.conn, table='library_spectra_meta',
-                       db_type=db_type)
+            if self.spectra_all:
+                cn = "id, mz, i, other, library_spectra_meta_id"
+                self._insert(self.spectra_all, 'library_spectra', cn, db_type)
 
-        if self.spectra_all:
-            cn = "id, mz, i, other, library_spectra_meta_id"
-            insert_query_m(self.spectra_all, columns=cn, conn=self.conn, table='library_spectra', db_type=db_type)
+            if self.spectra_summary and self.meta_info_all:
+                cn = 'library_spectra_meta_id, ' + ', '.join(SUMMARY_COLUMNS)
+                self._insert(summarise_peak_rows([row[0] for row in self.meta_info_all], self.spectra_all),
+                             'library_spectra_summary', cn, db_type)
 
+            if self.spectra_annotation_all:
+                cn = "id, mz, tentative_formula, mass_error, library_spectra_meta_id"
+                self._insert(self.spectra_annotation_all, 'library_spectra_annotation', cn, db_type)
 
-        if self.spectra_annotation_all:
-            cn = "id, mz, tentative_formula, mass_error, library_spectra_meta_id"
-            insert_query_m(self.spectra_annotation_all, columns=cn, conn=self.conn,
-                           table='library_spectra_annotation', db_type=db_type)
+            if self.hash_all:
+                cn = "library_spectra_meta_id, source, accession, content_hash"
+                self._insert(self.hash_all, 'library_spectra_hash', cn, db_type)
+
+        if self.peak_indexes:
+            self._update_peak_indexes()
 
         # self.conn.close()
         if remove_data:
@@ -580,8 +1281,53 @@ class LibraryData(object):
             self.spectra_all = []
             self.spectra_annotation_all = []
             self.compound_info_all = []
+            self.hash_all = []
             self._get_current_ids(source=False)
 
+    def _synonym_rows(self):
+        """The metab_compound_synonym rows of the compounds in the current chunk
+        """
+        columns = list(self.compound_info.keys())
+        cols = [columns.index(c) if c in columns else None for c in ('inchikey_id', 'name', 'other_names')]
+        return [row for compound in self.compound_info_all
+                for row in synonym_rows(*[compound[col] if col is not None else None for col in cols])]
+
+    def _update_peak_indexes(self):
+        """Add the peaks of the current chunk to the peak indexes (e.g. the fragment and neutral loss indexes)
+        """
+        precursor_mz = {}
+        if 'precursor_mz' in self.meta_info:
+            col = 1 + list(self.meta_info.keys()).index('precursor_mz')
+            precursor_mz = {int(row[0]): row[col] for row in self.meta_info_all}
+
+        for _, index in self.peak_indexes:
+            index.add_peak_rows(self.spectra_all, precursor_mz)
+
+    def _set_splash(self):
+        """Calculate the SPLASH of the spectra in the current chunk without a SPLASH
+        """
+        if 'splash' not in self.meta_info:
+            return
+
+        col = 1 + list(self.meta_info.keys()).index('splash')
+        peaks = group_peaks(self.spectra_all)
+        missing = [(i, int(row[0])) for i, row in enumerate(self.meta_info_all)
+                   if not row[col] and int(row[0]) in peaks]
+
+        splashes = splash_batch([peaks[meta_id] for _, meta_id in missing], pool=self.splash_pool)
+        for (i, _), splash in zip(missing, splashes):
+            row = list(self.meta_info_all[i])
+            row[col] = splash
+            self.meta_info_all[i] = tuple(row)
+
+    def _insert(self, rows, table, cn, db_type, ignore_conflicts=False):
+        """Insert the rows into a table (with the MySQL bulk insert method if selected) and record the peak rows per
+        second inserted into each table in self.peak_rows_per_second
+        """
+        rate = insert_query_m(rows, columns=cn, conn=self.conn, table=table, db_type=db_type, bulk=self.mysql_bulk,
+                              ignore_conflicts=ignore_conflicts)
+        self.peak_rows_per_second[table] = max(rate, self.peak_rows_per_second.get(table, 0))
+
     def get_db_dict(self):
         """ Get a dictionary of the library spectra from the associated database
 
@@ -598,7 +1344,8 @@ class LibraryData(object):
             >>>                  chunk=200)
             >>> libdata.db_dict()
 
-        If using a large database the resulting dictionary will be very large!
+        If using a large database the resulting dictionary will be very large! See iter_table and iter_spectra for
+        paged alternatives.
 
 
         Returns:
@@ -609,72 +1356,213 @@ class LibraryData(object):
         """
         return db_dict(self.c)
 
-    def close(self):
-        """ Close the database connections
+    def iter_table(self, table, page_size=10000, output='list'):
+        """ Iterate through the rows of a table of the associated database in fixed size pages
+
+        Example:
+            >>> for page in libdata.iter_table('library_spectra', page_size=50000, output='pandas'):
+            >>>     print(page.mz.max())
+
+        Args:
+            table (str): Name of the table
+            page_size (int): Maximum number of rows in each page [default 10000]
+            output (str): Type of each page either "list", "numpy" or "pandas" [default "list"]
+
+        Returns:
+           generator of pages of rows (see msp2db.db.iter_table)
+
+        """
+        return iter_table(self.conn, table, page_size=page_size, db_type=self.db_type, output=output)
+
+    def iter_spectra(self, page_size=1000, peaks_output='list'):
+        """ Iterate through the spectra (meta data joined with the peaks) of the associated database in fixed size
+        pages
+
+        Example:
+            >>> for page in libdata.iter_spectra(page_size=500):
+            >>>     print(len(page))
+
+        Args:
+            page_size (int): Maximum number of spectra in each page [default 1000]
+            peaks_output (str): Type of the peaks either "list" or "numpy" [default "list"]
+
+        Returns:
+           generator of pages of spectra dictionaries (see msp2db.db.iter_spectra)
+
         """
-        self.conn.close()
+        return iter_spectra(self.conn, page_size=page_size, db_type=self.db_type, peaks_output=peaks_output)
+
+
+class LibraryData(Importer):
+    """MSP file parser to SQL databases
+
+    After creating a SQL database for the library spectra using create_db, MSP files can be parsed into the database
+    using the LibraryData class. The MSP file(s) are imported when the object is created, use an Importer to run
+    many imports with the same connection.
+
+    Example:
+        >>> from msp2db.db import create_db
+        >>> from msp2db.parse import LibraryData
+        >>> db_pth = 'spectral_library.db'
+        >>> create_db(file_pth=db_pth, db_type='sqlite', db_name='spectra')
+        >>> libdata = LibraryData(msp_pth='MoNA-export-FAHFA.msp',
+        >>>                  db_pth=db_pth,
+        >>>                  db_type='sqlite',
+        >>>                  schema='mona',
+        >>>                  source='fahfa',
+        >>>                  chunk=200)
 
-        # build up list of inserts
+    Args:
+        msp_pth (str): path to msp file (or MoNA JSON file with the .json extension) or directory [required]
+        db_pth (str): path to sqlite database (only required when using SQLite database), for PostgreSQL this can be
+                      used for the connection string instead of the user, password, name, host and port [default None]
+        source (str): Source of the msp files (e.g. massbank) [default 'unknown']
+        mslevel (int): If the msp file does not contain the mslevel this can be defined here [default None]
+        polarity (str): If the msp file does not contain the polarity this can be defined here [default None]
+        db_type (str): The type of database to submit to (either 'sqlite', 'mysql', 'postgres' or 'django_mysql')
+                       [default sqlite]
+        user (str): Username for database (only required for non Django mysql databases) [default None]
+        password (str): Password for database (only required for non Django mysql databases) [default None]
+        mysql_db_name (str):  Name of the mysql database (only required for non Django mysql databases) [default None]
+        host (str): Host of the MySQL or PostgreSQL server [default None]
+        port (int): Port of the MySQL or PostgreSQL server [default None]
+        chunk (int): Chunks of spectra to parse data (useful to control memory usage) [default 200]
+        schema (str): MSP files can vary based on how they were made, two standard schemas are available either 'mona'
+                      based on the MassBank of North America (MoNA) MSP files. And 'massbank' which is based on the
+                      more controlled MassBank MSP files https://github.com/MassBank/MassBank-data [default 'mona']
+        user_meta_regex (dict): For other MSP files not derived from either MoNA or MassBank a custom dictionary of
+                                regexes can be used [default None]
+        user_compound_regex (dict): For other MSP files not derived from either MoNA or MassBank a custom dictionary of
+                                    regexes can be used [default None]
+        compound_lookup (boolean): Include compound lookup
+        celery_obj (boolean): If using Django a Celery task object can be used to keep track on ongoing tasks
+                              [default False]
+        structure_lookup (boolean): If RDKit is installed, derive the InChIKey, molecular formula and exact mass from
+                                    any SMILES or InChI in the record before using PubChem lookups [default True]
+        structure_processes (int): Number of worker processes used to evaluate the structures of a file before
+                                   parsing (only used for the local structure lookup) [default 1]
+        mysql_bulk (str): Bulk insert method for MySQL databases either 'load_data' (LOAD DATA LOCAL INFILE) or
+                          'multirow' (multi-row INSERT statements). The unique and foreign key checks (and the
+                          secondary keys of MyISAM tables) are disabled during the import [default None]
+        checkpoint (boolean): Record the progress of the import (the file, byte offset, record and ids of the last
+                              committed chunk) in the library_import_progress table [default True]
+        resume (boolean): Resume the last incomplete import of msp_pth from its last committed chunk (rather than
+                          starting a new import) [default False]
+        incremental (boolean): Only import the records that are new or have changed since the last incremental
+                               import of the same source, records no longer present are removed. A hash of each
+                               record is stored in the library_spectra_hash table (so the first incremental import of
+                               a source imports every record). Can not be used with resume [default False]
+        compute_splash (boolean): Calculate the SPLASH of each spectrum (that does not have a SPLASH in the MSP
+                                  file) from the peaks [default False]
+        splash_processes (int): Number of worker processes used to calculate the SPLASHs of each chunk [default 1]
+        fragment_index_pth (str): Path of a FragmentIndex sidecar file to update as each chunk is inserted
+                                  [default None]
+        neutral_loss_index_pth (str): Path of a NeutralLossIndex sidecar file to update as each chunk is inserted
+                                      [default None]
+        spectra_summary (boolean): Store the summary of each spectrum in the library_spectra_summary table
+                                   [default True]
+        compound_synonyms (boolean): Store the names of each new compound in the metab_compound_synonym table
+                                     [default True]
 
-        # add in bulk the splash keys
+    Returns:
+        LibraryData object
+    """
+    def __init__(self, msp_pth, db_pth=None,
+                 mslevel=None, polarity=None, source='unknown', db_type='sqlite', password=None, user=None,
+                 mysql_db_name=None, chunk=200, schema='mona', user_meta_regex=None, user_compound_regex=None,
+                 compound_lookup=True, celery_obj=False, structure_lookup=True, structure_processes=1,
+                 mysql_bulk=None, host=None, port=None, checkpoint=True, resume=False,
+                 incremental=False, compute_splash=False, splash_processes=1, fragment_index_pth=None,
+                 neutral_loss_index_pth=None, spectra_summary=True, compound_synonyms=True):
+
+        super(LibraryData, self).__init__(db_pth=db_pth, db_type=db_type, password=password, user=user,
+                                          mysql_db_name=mysql_db_name, chunk=chunk, schema=schema,
+                                          user_meta_regex=user_meta_regex, user_compound_regex=user_compound_regex,
+                                          compound_lookup=compound_lookup, structure_lookup=structure_lookup,
+                                          structure_processes=structure_processes, mysql_bulk=mysql_bulk, host=host,
+                                          port=port, checkpoint=checkpoint, compute_splash=compute_splash,
+                                          splash_processes=splash_processes,
+                                          fragment_index_pth=fragment_index_pth,
+                                          neutral_loss_index_pth=neutral_loss_index_pth,
+                                          spectra_summary=spectra_summary,
+                                          compound_synonyms=compound_synonyms)
+        self.open()
+        try:
+            self.import_path(msp_pth, source=source, mslevel=mslevel, polarity=polarity, celery_obj=celery_obj,
+                             resume=resume, incremental=incremental)
+        finally:
+            # the connection is kept open (for get_db_dict etc.) until close is called
+            self._close_pool()
 
 
-def add_splash_ids(splash_mapping_file_pth, conn, db_type='sqlite'):
+def add_splash_ids(splash_mapping_file_pth, conn, db_type='sqlite', chunk_size=10000):
     """ Add splash ids to database (in case stored in a different file to the msp files like for MoNA)
 
+    The mapping file is streamed into a temporary staging table which is then joined to library_spectra_meta in a
+    single UPDATE, so the memory use does not depend on the size of the database or the mapping file.
+
     Example:
         >>> from msp2db.db import get_connection
         >>> from msp2db.parse import add_splash_ids
         >>> conn = get_connection('sqlite', 'library.db')
         >>> add_splash_ids('splash_mapping_file.csv', conn, db_type='sqlite')
+        {'matched': 10241, 'unmatched': 3}
 
 
     Args:
         splash_mapping_file_pth (str): Path to the splash mapping file (needs to be csv format and have no headers,
                                        should contain two columns. The first the accession number the second the splash.
                                        e.g. AU100601, splash10-0a4i-1900000000-d2bc1c887f6f99ed0f74 \n
+        conn (connection object): Database connection object
+        db_type (str): Type of database either "sqlite", "mysql", "postgres" or "django_mysql" [default "sqlite"]
+        chunk_size (int): Number of rows of the mapping file loaded into the staging table at a time [default 10000]
 
-    """
-    # get dictionary of accession and library_spectra_meta_id
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, accession FROM library_spectra_meta")
-
-    accession_d = {row[1]: row[0] for row in cursor}
+    Returns:
+        dictionary of the number of accessions in the mapping file that were matched and unmatched to spectra in the
+        database
 
-    if db_type == 'sqlite':
-        type_sign = '?'
+    """
+    if db_type in ('django_mysql', 'django'):
+        vendor = {'postgresql': 'postgres'}.get(conn.vendor, conn.vendor)
     else:
-        type_sign = '%s'
-
-    rows = []
-    c = 0
-    # loop through splash mapping file
-    with open(splash_mapping_file_pth, "r") as f:
-
-        for line in f:
-            c+=1
-            line = line.rstrip()
-            line_l = line.split(',')
-
-            accession = line_l[0]
-            splash = line_l[1]
-            try:
-                aid = accession_d[accession]
-            except KeyError as e:
-                print("can't find accession {}".format(accession))
-                continue
+        vendor = db_type
 
-            row = (splash, aid)
-            rows.append(row)
+    cursor = conn.cursor()
+    cursor.execute('DROP TABLE IF EXISTS splash_staging')
+    cursor.execute('CREATE TEMPORARY TABLE splash_staging (accession varchar(255), splash varchar(255))')
 
-            if c > 200:
-                print(row)
-                cursor.executemany("UPDATE library_spectra_meta SET splash = {t} WHERE id = {t} ".format(t=type_sign), rows)
-                conn.commit()
-                rows = []
-                c = 0
+    # load the mapping file into the staging table
+    with open(splash_mapping_file_pth, "r") as f:
+        rows = ((row[0].strip(), row[1].strip()) for row in csv.reader(f) if len(row) > 1)
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            insert_query_m(chunk, 'splash_staging', conn, columns='accession, splash', db_type=db_type)
+
+    cursor.execute('CREATE INDEX splash_staging_accession ON splash_staging (accession)')
+
+    cursor.execute('SELECT count(DISTINCT accession) FROM splash_staging')
+    total = cursor.fetchall()[0][0]
+    cursor.execute('SELECT count(DISTINCT s.accession) FROM library_spectra_meta m '
+                   'JOIN splash_staging s ON s.accession = m.accession')
+    matched = cursor.fetchall()[0][0]
+
+    if vendor == 'mysql':
+        cursor.execute('UPDATE library_spectra_meta m JOIN splash_staging s ON s.accession = m.accession '
+                       'SET m.splash = s.splash')
+    elif vendor == 'postgres':
+        cursor.execute('UPDATE library_spectra_meta m SET splash = s.splash FROM splash_staging s '
+                       'WHERE s.accession = m.accession')
+    else:
+        cursor.execute('UPDATE library_spectra_meta SET splash = (SELECT s.splash FROM splash_staging s '
+                       'WHERE s.accession = library_spectra_meta.accession) '
+                       'WHERE accession IN (SELECT accession FROM splash_staging)')
 
-    cursor.executemany("UPDATE library_spectra_meta SET splash = {t} WHERE id = {t} ".format(t=type_sign), rows)
+    cursor.execute('DROP TABLE splash_staging')
     conn.commit()
 
+    print('splash ids added for {} accessions ({} accessions not found)'.format(matched, total - matched))
+    return {'matched': matched, 'unmatched': total - matched}
+
 
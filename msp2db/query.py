@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+from __future__ import absolute_import, unicode_literals, print_function
+import numpy as np
+import six
+from .db import iter_table, _mysql_index_exists
+
+# polarity is stored as free text (e.g. "POSITIVE", "positive" or "+")
+POLARITY_NAMES = {1: ('positive', 'pos', 'p', '+'), -1: ('negative', 'neg', 'n', '-')}
+
+
+def polarity_code(polarity):
+    """ Convert a polarity (as stored in library_spectra_meta) to a code
+
+    Example:
+        >>> from msp2db.query import polarity_code
+        >>> polarity_code('POSITIVE')
+        1
+
+    Args:
+        polarity (str): Polarity (e.g. 'positive', 'NEGATIVE' or '+'), an integer code is returned as is
+
+    Returns:
+       1 for positive, -1 for negative and 0 if unknown
+
+    """
+    if isinstance(polarity, (six.integer_types, np.integer)):
+        return int(polarity)
+    if not polarity:
+        return 0
+    polarity = six.text_type(polarity).strip().lower()
+    for code, names in six.iteritems(POLARITY_NAMES):
+        if polarity in names:
+            return code
+    return 0
+
+
+def precursor_tolerance(mz, ppm=10, mz_tol=None):
+    """ Get the tolerance (in Da) of a precursor m/z, the larger of the ppm and the absolute tolerance is used
+
+    Args:
+        mz (float): Precursor m/z (or numpy array of m/z values)
+        ppm (float): Tolerance in parts per million [default 10]
+        mz_tol (float): Absolute tolerance in Da [default None]
+
+    Returns:
+       tolerance in Da (float or numpy array)
+
+    """
+    tol = np.asarray(mz, dtype=float) * (ppm or 0) * 1e-6
+    if mz_tol:
+        tol = np.maximum(tol, mz_tol)
+    return tol
+
+
+class PrecursorIndex(object):
+    """In-memory index of the precursor m/z of the library spectra (sorted numpy arrays searched with binary search)
+
+    The precursor m/z, polarity, ms level and retention time of each spectrum are loaded once (e.g. with from_db) and
+    then each query is a binary search of the sorted m/z values. Spectra without a precursor m/z are not included.
+
+    Example:
+        >>> from msp2db.db import get_connection
+        >>> from msp2db.query import PrecursorIndex
+        >>> conn = get_connection('sqlite', 'library.db')
+        >>> index = PrecursorIndex.from_db(conn)
+        >>> index.query(179.0697, ppm=5, polarity='positive')
+        array([1, 57])
+        >>> index.query_batch([179.0697, 305.0667], ppm=5, rt=[3.4, 5.1], rt_tol=0.5)
+        [array([1]), array([])]
+
+    Args:
+        meta_ids (list): The library_spectra_meta ids
+        precursor_mz (list): Precursor m/z of each spectrum (None or NaN if unknown)
+        polarity (list): Polarity of each spectrum (either the stored text or the codes of polarity_code)
+                         [default None]
+        ms_level (list): MS level of each spectrum [default None]
+        retention_time (list): Retention time of each spectrum [default None]
+
+    Returns:
+        PrecursorIndex object
+    """
+    def __init__(self, meta_ids, precursor_mz, polarity=None, ms_level=None, retention_time=None):
+        n = len(meta_ids)
+        mz = np.array(precursor_mz, dtype=float)
+        polarity = np.array([polarity_code(p) for p in polarity] if polarity is not None else np.zeros(n),
+                            dtype=np.int8)
+        ms_level = np.array(ms_level if ms_level is not None else np.full(n, np.nan), dtype=float)
+        rt = np.array(retention_time if retention_time is not None else np.full(n, np.nan), dtype=float)
+
+        keep = np.flatnonzero(~np.isnan(mz))
+        order = keep[np.argsort(mz[keep], kind='stable')]
+
+        self.mz = mz[order]
+        self.meta_ids = np.array(meta_ids, dtype=np.int64)[order]
+        self.polarity = polarity[order]
+        self.ms_level = ms_level[order]
+        self.retention_time = rt[order]
+        self._subsets = {}
+
+    @classmethod
+    def from_sorted(cls, meta_ids, precursor_mz, polarity, ms_level, retention_time):
+        """ Create the index from arrays already sorted by precursor m/z (without copying them, e.g. the memory mapped
+        arrays of a snapshot)
+
+        Args:
+            meta_ids (numpy array): The library_spectra_meta ids (int64)
+            precursor_mz (numpy array): Sorted precursor m/z of each spectrum without NaN (float64)
+            polarity (numpy array): Polarity code of each spectrum (int8, see polarity_code)
+            ms_level (numpy array): MS level of each spectrum (float64)
+            retention_time (numpy array): Retention time of each spectrum (float64)
+
+        Returns:
+           PrecursorIndex object
+        """
+        index = cls.__new__(cls)
+        index.mz = precursor_mz
+        index.meta_ids = meta_ids
+        index.polarity = polarity
+        index.ms_level = ms_level
+        index.retention_time = retention_time
+        index._subsets = {}
+        return index
+
+    @classmethod
+    def from_db(cls, conn, db_type='sqlite', page_size=10000):
+        """ Load the index from the library_spectra_meta table of a database
+
+        Args:
+            conn (connection object): Database connection object
+            db_type (str): Type of database (sqlite, mysql, postgres or django_mysql) [default "sqlite"]
+            page_size (int): Number of rows fetched at a time [default 10000]
+
+        Returns:
+           PrecursorIndex object
+        """
+        columns = ['id', 'precursor_mz', 'polarity', 'ms_level', 'retention_time']
+        rows = [row for page in iter_table(conn, 'library_spectra_meta', page_size=page_size, db_type=db_type,
+                                           columns=columns)
+                for row in page]
+        if not rows:
+            return cls([], [])
+        meta_ids, mz, polarity, ms_level, rt = zip(*rows)
+        return cls(meta_ids, [_to_float(x) for x in mz], polarity, [_to_float(x) for x in ms_level],
+                   [_to_float(x) for x in rt])
+
+    def __len__(self):
+        return len(self.mz)
+
+    def query(self, mz, ppm=10, mz_tol=None, polarity=None, ms_level=None, rt=None, rt_tol=None):
+        """ Find the spectra with a precursor m/z within the tolerance of mz
+
+        Args:
+            mz (float): Precursor m/z
+            ppm (float): Tolerance in parts per million [default 10]
+            mz_tol (float): Absolute tolerance in Da (the larger of the two tolerances is used) [default None]
+            polarity (str): Only spectra of this polarity (e.g. 'positive') [default None]
+            ms_level (int): Only spectra of this ms level [default None]
+            rt (float): Retention time of the query (spectra without a retention time are excluded) [default None]
+            rt_tol (float): Retention time tolerance (required if rt is used) [default None]
+
+        Returns:
+           numpy array of the library_spectra_meta ids (ordered by precursor m/z)
+        """
+        return self.query_batch([mz], ppm=ppm, mz_tol=mz_tol, polarity=polarity, ms_level=ms_level,
+                                rt=None if rt is None else [rt], rt_tol=rt_tol)[0]
+
+    def query_batch(self, mz, ppm=10, mz_tol=None, polarity=None, ms_level=None, rt=None, rt_tol=None):
+        """ Find the spectra within the precursor m/z tolerance of each of a batch of m/z values (e.g. the features
+        of a LC-MS run)
+
+        The search bounds of all the queries are found with a single vectorised binary search.
+
+        Args:
+            mz (list): Precursor m/z values
+            ppm (float): Tolerance in parts per million [default 10]
+            mz_tol (float): Absolute tolerance in Da (the larger of the two tolerances is used) [default None]
+            polarity (str): Only spectra of this polarity (e.g. 'positive') [default None]
+            ms_level (int): Only spectra of this ms level [default None]
+            rt (list): Retention time of each query [default None]
+            rt_tol (float): Retention time tolerance (required if rt is used) [default None]
+
+        Returns:
+           list of numpy arrays of the library_spectra_meta ids (ordered by precursor m/z) for each query
+        """
+        if rt is not None and rt_tol is None:
+            raise ValueError('rt_tol is required to filter by retention time')
+
+        mz = np.asarray(mz, dtype=float)
+        tol = precursor_tolerance(mz, ppm, mz_tol)
+        sub_mz, sub_ids, sub_rt = self._subset(polarity, ms_level)
+
+        lo = np.searchsorted(sub_mz, mz - tol, side='left')
+        hi = np.searchsorted(sub_mz, mz + tol, side='right')
+
+        if rt is None:
+            return [sub_ids[l:h] for l, h in zip(lo, hi)]
+
+        results = []
+        for l, h, query_rt in zip(lo, hi, rt):
+            results.append(sub_ids[l:h][np.abs(sub_rt[l:h] - query_rt) <= rt_tol])
+        return results
+
+    def _subset(self, polarity, ms_level):
+        """ Get the sorted arrays of the spectra of a polarity and ms level (cached so a filter is only applied once)
+        """
+        key = (polarity_code(polarity) if polarity is not None else None,
+               float(ms_level) if ms_level is not None else None)
+        if key not in self._subsets:
+            mask = np.ones(len(self.mz), dtype=bool)
+            if key[0] is not None:
+                mask &= self.polarity == key[0]
+            if key[1] is not None:
+                mask &= self.ms_level == key[1]
+            self._subsets[key] = (self.mz[mask], self.meta_ids[mask], self.retention_time[mask])
+        return self._subsets[key]
+
+
+def query_precursor_sql(conn, mz, ppm=10, mz_tol=None, polarity=None, ms_level=None, rt=None, rt_tol=None,
+                        db_type='sqlite'):
+    """ Find the spectra with a precursor m/z within the tolerance of mz with a SQL query (rather than loading a
+    PrecursorIndex)
+
+    Uses the library_spectra_meta_precursor_idx index (see create_precursor_index) to avoid a scan of the table.
+
+    Example:
+        >>> from msp2db.db import get_connection
+        >>> from msp2db.query import query_precursor_sql
+        >>> conn = get_connection('sqlite', 'library.db')
+        >>> query_precursor_sql(conn, 179.0697, ppm=5, polarity='positive')
+        [1, 57]
+
+    Args:
+        conn (connection object): Database connection object
+        mz (float): Precursor m/z
+        ppm (float): Tolerance in parts per million [default 10]
+        mz_tol (float): Absolute tolerance in Da (the larger of the two tolerances is used) [default None]
+        polarity (str): Only spectra of this polarity (e.g. 'positive', a polarity that is not positive or negative
+                        only matches the spectra of unknown polarity) [default None]
+        ms_level (int): Only spectra of this ms level [default None]
+        rt (float): Retention time of the query (spectra without a retention time are excluded) [default None]
+        rt_tol (float): Retention time tolerance (required if rt is used) [default None]
+        db_type (str): Type of database (sqlite, mysql, postgres or django_mysql) [default "sqlite"]
+
+    Returns:
+       list of the library_spectra_meta ids (ordered by precursor m/z)
+
+    """
+    if rt is not None and rt_tol is None:
+        raise ValueError('rt_tol is required to filter by retention time')
+
+    type_sign = '?' if db_type == 'sqlite' else '%s'
+    tol = float(precursor_tolerance(mz, ppm, mz_tol))
+    where = ['precursor_mz BETWEEN {t} AND {t}'.format(t=type_sign)]
+    params = [mz - tol, mz + tol]
+
+    if polarity is not None:
+        # the same filter as the PrecursorIndex (see polarity_code), an unknown polarity (code 0) only matches the
+        # spectra without a positive or negative polarity
+        code = polarity_code(polarity)
+        if code:
+            names = POLARITY_NAMES[code]
+            where.append('lower(trim(polarity)) IN ({})'.format(', '.join([type_sign] * len(names))))
+        else:
+            names = [name for code_names in POLARITY_NAMES.values() for name in code_names]
+            where.append('(polarity IS NULL OR lower(trim(polarity)) NOT IN ({}))'.format(
+                ', '.join([type_sign] * len(names))))
+        params.extend(names)
+
+    if ms_level is not None:
+        where.append('ms_level = {}'.format(type_sign))
+        params.append(ms_level)
+
+    if rt is not None:
+        where.append('retention_time BETWEEN {t} AND {t}'.format(t=type_sign))
+        params.extend([rt - rt_tol, rt + rt_tol])
+
+    c = conn.cursor()
+    c.execute('SELECT id FROM library_spectra_meta WHERE {} ORDER BY precursor_mz, id'.format(' AND '.join(where)),
+              params)
+    return [row[0] for row in c.fetchall()]
+
+
+def create_precursor_index(conn, db_type='sqlite'):
+    """ Create the precursor m/z index of library_spectra_meta (if it does not already exist) used by
+    query_precursor_sql
+
+    Databases created with older versions of msp2db will not have the index.
+
+    Args:
+        conn (connection object): Database connection object
+        db_type (str): Type of database (sqlite, mysql, postgres or django_mysql) [default "sqlite"]
+
+    """
+    c = conn.cursor()
+    if db_type in ('mysql', 'django_mysql'):
+        # MySQL does not support CREATE INDEX IF NOT EXISTS
+        if _mysql_index_exists(c, 'library_spectra_meta_precursor_idx'):
+            return
+        c.execute('CREATE INDEX library_spectra_meta_precursor_idx ON library_spectra_meta '
+                  '(precursor_mz, retention_time)')
+    else:
+        c.execute('CREATE INDEX IF NOT EXISTS library_spectra_meta_precursor_idx ON library_spectra_meta '
+                  '(precursor_mz, retention_time)')
+    conn.commit()
+
+
+def _to_float(x):
+    try:
+        return float(x)
+    except (TypeError, ValueError):
+        return np.nan
@@ -89,3 +89,14 @@ def get_compound_regex(schema='mona'):
         meta_parse['smiles'] = ['^CH\$SMILES:\s+(.*)$']
 
     return meta_parse
+
+
+def get_inchi_regex(schema='mona'):
+    """ Create a list of regex for extracting the InChI for the spectra (used for local derivation of the InChIKey)
+    """
+    if schema == 'mona':
+        return ['^InChI(?:=|:)\s*(InChI=.*)$']
+    elif schema == 'massbank':
+        return ['^CH\$IUPAC:\s+(InChI=.*)$']
+
+    return []
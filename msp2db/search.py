@@ -0,0 +1,547 @@
+#!/usr/bin/env python
+from __future__ import absolute_import, unicode_literals, print_function
+import csv
+import json
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import tempfile
+import numpy as np
+import six
+from .db import iter_table, iter_spectra, create_db
+from .query import PrecursorIndex, polarity_code, _to_float
+from .parse import Importer
+
+METHODS = ('cosine', 'entropy')
+
+# the arrays of a SpectralLibrary saved by save (everything needed to search without normalising the intensities)
+LIBRARY_ARRAYS = ('meta_ids', 'offsets', 'mz', 'intensity', 'precursor_mz', 'polarity', 'ms_level', 'peak_spectrum',
+                  'mz_order', 'sorted_mz', 'cosine_i', 'entropy_i')
+
+HIT_COLUMNS = ['query_id', 'query_name', 'query_accession', 'query_precursor_mz', 'rank', 'library_spectra_meta_id',
+               'score', 'matched_peaks']
+
+# the library of each worker process of search_batch
+_worker_library = None
+
+
+class SpectralLibrary(object):
+    """In-memory spectral library (compact numpy arrays) for vectorised spectral similarity searches
+
+    The peaks of all the spectra are stored end to end (sorted by m/z within each spectrum) with the offset of the
+    first peak of each spectrum, so the peaks of spectrum j are mz[offsets[j]:offsets[j + 1]]. The intensities are
+    normalised when the library is loaded for both the cosine (weighted by m/z ** mz_power * intensity **
+    intensity_power and scaled to a unit norm) and the spectral entropy similarity (entropy weighted and scaled to a
+    sum of 1) so a search only has to match the peaks.
+
+    Example:
+        >>> from msp2db.db import get_connection
+        >>> from msp2db.search import SpectralLibrary
+        >>> conn = get_connection('sqlite', 'library.db')
+        >>> library = SpectralLibrary.from_db(conn, intensity_power=0.5)
+        >>> library.search([(85.0284, 12.0), (179.0697, 100.0)], precursor_mz=179.0697, tolerance=0.01, top_k=5)
+        [{'id': 1, 'score': 0.998, 'matched_peaks': 2}, ...]
+
+    Args:
+        meta_ids (list): The library_spectra_meta id of each spectrum
+        offsets (list): Offset of the first peak of each spectrum (and the total number of peaks at the end)
+        mz (list): m/z of the peaks
+        intensity (list): Intensities of the peaks
+        precursor_mz (list): Precursor m/z of each spectrum (None or NaN if unknown) [default None]
+        polarity (list): Polarity of each spectrum [default None]
+        ms_level (list): MS level of each spectrum [default None]
+        mz_power (float): m/z weighting of the cosine similarity [default 0]
+        intensity_power (float): Intensity weighting of the cosine similarity [default 1]
+
+    Returns:
+        SpectralLibrary object
+    """
+    def __init__(self, meta_ids, offsets, mz, intensity, precursor_mz=None, polarity=None, ms_level=None,
+                 mz_power=0.0, intensity_power=1.0):
+        self.meta_ids = np.asarray(meta_ids, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.mz = np.asarray(mz, dtype=np.float64)
+        self.mz_power = mz_power
+        self.intensity_power = intensity_power
+        n = len(self.meta_ids)
+
+        if precursor_mz is None:
+            precursor_mz = np.full(n, np.nan)
+        self.precursor_mz = np.array([_to_float(x) for x in precursor_mz], dtype=np.float64)
+        self.polarity = np.array([polarity_code(p) for p in polarity] if polarity is not None else np.zeros(n),
+                                 dtype=np.int8)
+        self.ms_level = np.array([_to_float(x) for x in ms_level] if ms_level is not None else np.full(n, np.nan),
+                                 dtype=np.float64)
+
+        # the spectrum (position) of each peak and all the peaks sorted by m/z (to find the peaks within the tolerance
+        # of a query peak in any spectrum with a binary search)
+        self.peak_spectrum = np.repeat(np.arange(n), np.diff(self.offsets))
+        self.mz_order = np.argsort(self.mz, kind='stable')
+        self.sorted_mz = self.mz[self.mz_order]
+        self.intensity = np.asarray(intensity, dtype=np.float64)
+        self.cosine_i = _normalise_cosine(self.mz, self.intensity, self.peak_spectrum, n, mz_power, intensity_power)
+        self.entropy_i = _normalise_entropy(self.intensity, self.peak_spectrum, n)
+
+        # the positions of the spectra are indexed (rather than the ids) so the candidates index the arrays directly
+        self.precursor_index = PrecursorIndex(np.arange(n), self.precursor_mz, self.polarity, self.ms_level)
+
+    @classmethod
+    def from_peaks(cls, meta_ids, peaks, precursor_mz=None, polarity=None, ms_level=None, **kwargs):
+        """ Create the library from a list of peak lists
+
+        Args:
+            meta_ids (list): The id of each spectrum
+            peaks (list): List of the peaks of each spectrum (list of (mz, intensity) tuples or n x 2 arrays)
+            precursor_mz (list): Precursor m/z of each spectrum [default None]
+            polarity (list): Polarity of each spectrum [default None]
+            ms_level (list): MS level of each spectrum [default None]
+            **kwargs: mz_power and intensity_power
+
+        Returns:
+           SpectralLibrary object
+        """
+        peaks = [_clean_peaks(p) for p in peaks]
+        offsets = np.r_[0, np.cumsum([len(p) for p in peaks])]
+        stacked = np.concatenate(peaks) if peaks else np.empty((0, 2))
+        return cls(meta_ids, offsets, stacked[:, 0], stacked[:, 1], precursor_mz, polarity, ms_level, **kwargs)
+
+    @classmethod
+    def from_db(cls, conn, db_type='sqlite', page_size=100000, **kwargs):
+        """ Load the spectra of the library_spectra_meta and library_spectra tables of a database
+
+        Args:
+            conn (connection object): Database connection object
+            db_type (str): Type of database (sqlite, mysql, postgres or django_mysql) [default "sqlite"]
+            page_size (int): Number of rows fetched at a time [default 100000]
+            **kwargs: mz_power and intensity_power
+
+        Returns:
+           SpectralLibrary object
+        """
+        meta = [row for page in iter_table(conn, 'library_spectra_meta', page_size=page_size, db_type=db_type,
+                                           columns=['id', 'precursor_mz', 'polarity', 'ms_level'], order_by='id')
+                for row in page]
+        meta_ids = np.array([row[0] for row in meta], dtype=np.int64)
+
+        peak_meta_ids, mz, intensity = [], [], []
+        for page in iter_table(conn, 'library_spectra', page_size=page_size, db_type=db_type,
+                               columns=['library_spectra_meta_id', 'mz', 'i']):
+            peak_meta_ids.append(np.array([row[0] for row in page], dtype=np.int64))
+            mz.append(np.array([row[1] for row in page], dtype=np.float64))
+            intensity.append(np.array([row[2] for row in page], dtype=np.float64))
+
+        peak_meta_ids = np.concatenate(peak_meta_ids) if peak_meta_ids else np.empty(0, dtype=np.int64)
+        mz = np.concatenate(mz) if mz else np.empty(0)
+        intensity = np.concatenate(intensity) if intensity else np.empty(0)
+
+        keep = (intensity > 0) & np.isin(peak_meta_ids, meta_ids)
+        order = np.lexsort((mz[keep], peak_meta_ids[keep]))
+        peak_meta_ids, mz, intensity = peak_meta_ids[keep][order], mz[keep][order], intensity[keep][order]
+        offsets = np.searchsorted(peak_meta_ids, np.r_[meta_ids, np.iinfo(np.int64).max])
+
+        return cls(meta_ids, offsets, mz, intensity, [row[1] for row in meta], [row[2] for row in meta],
+                   [row[3] for row in meta], **kwargs)
+
+    @classmethod
+    def load(cls, dir_pth, mmap_mode='r'):
+        """ Load a library saved with save, by default the arrays are memory mapped (so processes that load the same
+        library share the same memory rather than each having a copy)
+
+        Args:
+            dir_pth (str): Directory of the saved library
+            mmap_mode (str): numpy memory map mode (or None to read the arrays into memory) [default 'r']
+
+        Returns:
+           SpectralLibrary object
+        """
+        library = cls.__new__(cls)
+        for name in LIBRARY_ARRAYS:
+            setattr(library, name, np.load(os.path.join(dir_pth, name + '.npy'), mmap_mode=mmap_mode))
+        with open(os.path.join(dir_pth, 'library.json')) as f:
+            settings = json.load(f)
+        library.mz_power = settings['mz_power']
+        library.intensity_power = settings['intensity_power']
+        library.precursor_index = PrecursorIndex(np.arange(len(library.meta_ids)), library.precursor_mz,
+                                                 library.polarity, library.ms_level)
+        return library
+
+    def save(self, dir_pth):
+        """ Save the arrays of the library to a directory (one .npy file per array)
+
+        Args:
+            dir_pth (str): Directory to save the library to (created if it does not exist)
+        """
+        if not os.path.isdir(dir_pth):
+            os.makedirs(dir_pth)
+        for name in LIBRARY_ARRAYS:
+            np.save(os.path.join(dir_pth, name + '.npy'), getattr(self, name))
+        with open(os.path.join(dir_pth, 'library.json'), 'w') as f:
+            json.dump({'mz_power': self.mz_power, 'intensity_power': self.intensity_power}, f)
+
+    def __len__(self):
+        return len(self.meta_ids)
+
+    def candidates(self, precursor_mz=None, precursor_ppm=10, precursor_tol=None, polarity=None, ms_level=None):
+        """ Get the positions of the spectra within the precursor window (all the spectra if precursor_mz is None or
+        NaN)
+
+        Returns:
+           numpy array of the positions of the candidate spectra
+        """
+        if precursor_mz is None or np.isnan(precursor_mz):
+            candidates = np.arange(len(self))
+            if polarity is not None:
+                candidates = candidates[self.polarity[candidates] == polarity_code(polarity)]
+            if ms_level is not None:
+                candidates = candidates[self.ms_level[candidates] == float(ms_level)]
+            return candidates
+        return self.precursor_index.query(precursor_mz, ppm=precursor_ppm, mz_tol=precursor_tol, polarity=polarity,
+                                          ms_level=ms_level)
+
+    def search(self, query_peaks, precursor_mz=None, tolerance=0.01, top_k=10, method='cosine', precursor_ppm=10,
+               precursor_tol=None, polarity=None, ms_level=None, min_matched_peaks=1, min_score=0.0):
+        """ Search the library for the spectra most similar to a query spectrum
+
+        The candidates are the spectra within the precursor window (if precursor_mz is provided) and the peaks of all
+        the candidates are matched to the query peaks (within tolerance, each query peak matches at most one peak of
+        each candidate) and scored at once.
+
+        Args:
+            query_peaks (list): Peaks of the query spectrum (list of (mz, intensity) tuples or n x 2 array)
+            precursor_mz (float): Precursor m/z of the query, used to pre-filter the candidates [default None]
+            tolerance (float): Fragment m/z tolerance in Da [default 0.01]
+            top_k (int): Maximum number of hits [default 10]
+            method (str): Similarity either "cosine" (weighted dot product) or "entropy" (spectral entropy
+                          similarity) [default "cosine"]
+            precursor_ppm (float): Precursor tolerance in parts per million [default 10]
+            precursor_tol (float): Absolute precursor tolerance in Da (the larger tolerance is used) [default None]
+            polarity (str): Only candidates of this polarity [default None]
+            ms_level (int): Only candidates of this ms level [default None]
+            min_matched_peaks (int): Minimum number of matched peaks of a hit [default 1]
+            min_score (float): Minimum score of a hit [default 0]
+
+        Returns:
+           list of dictionaries of the hits ('id', 'score' and 'matched_peaks') ordered by decreasing score
+        """
+        candidates = self.candidates(precursor_mz, precursor_ppm, precursor_tol, polarity, ms_level)
+        scores, matched = self.score(query_peaks, candidates, tolerance=tolerance, method=method)
+
+        keep = np.flatnonzero((matched >= min_matched_peaks) & (scores >= min_score))
+        top = keep[np.lexsort((self.meta_ids[candidates[keep]], -scores[keep]))][:top_k]
+
+        return [{'id': int(self.meta_ids[candidates[j]]), 'score': float(scores[j]), 'matched_peaks': int(matched[j])}
+                for j in top]
+
+    def score(self, query_peaks, candidates=None, tolerance=0.01, method='cosine'):
+        """ Score a query spectrum against candidate spectra of the library
+
+        Args:
+            query_peaks (list): Peaks of the query spectrum (list of (mz, intensity) tuples or n x 2 array)
+            candidates (numpy array): Positions of the candidate spectra (all spectra if None) [default None]
+            tolerance (float): Fragment m/z tolerance in Da [default 0.01]
+            method (str): Similarity either "cosine" or "entropy" [default "cosine"]
+
+        Returns:
+           tuple of the numpy arrays of the score and number of matched peaks of each candidate
+        """
+        if method not in METHODS:
+            raise ValueError('method must be one of {}'.format(', '.join(METHODS)))
+        if candidates is None:
+            candidates = np.arange(len(self))
+        candidates = np.asarray(candidates, dtype=np.int64)
+
+        query = _clean_peaks(query_peaks)
+        q_mz = query[:, 0]
+        if method == 'cosine':
+            q_i = _normalise_cosine(q_mz, query[:, 1], np.zeros(len(q_mz), dtype=np.int64), 1, self.mz_power,
+                                    self.intensity_power)
+            lib_i = self.cosine_i
+        else:
+            q_i = _normalise_entropy(query[:, 1], np.zeros(len(q_mz), dtype=np.int64), 1)
+            lib_i = self.entropy_i
+
+        n_candidates = len(candidates)
+        if not len(q_mz) or not n_candidates:
+            return np.zeros(n_candidates), np.zeros(n_candidates, dtype=np.int64)
+
+        # the library peaks are either found from the query peaks (with the peaks of all the spectra sorted by m/z)
+        # or by gathering the peaks of each candidate, whichever has fewer peaks to check
+        lo = np.searchsorted(self.sorted_mz, q_mz - tolerance, side='left')
+        hi = np.searchsorted(self.sorted_mz, q_mz + tolerance, side='right')
+        if (hi - lo).sum() < (self.offsets[candidates + 1] - self.offsets[candidates]).sum():
+            seg, q_idx, lib_idx = self._window_pairs(q_mz, lo, hi, candidates)
+        else:
+            seg, q_idx, lib_idx = self._gather_pairs(q_mz, candidates, tolerance)
+
+        a, b = q_i[q_idx], lib_i[lib_idx]
+
+        # each query peak is only matched to the most intense of the library peaks of a candidate
+        key = seg * len(q_mz) + q_idx
+        order = np.lexsort((-(a * b), key))
+        first = order[np.r_[True, key[order][1:] != key[order][:-1]]] if len(order) else order
+        seg, a, b = seg[first], a[first], b[first]
+
+        if method == 'cosine':
+            contribution = a * b
+        else:
+            contribution = (_xlog2x(a + b) - _xlog2x(a) - _xlog2x(b)) / 2
+
+        scores = np.bincount(seg, weights=contribution, minlength=n_candidates)
+        matched = np.bincount(seg, minlength=n_candidates)
+        return np.clip(scores, 0, 1), matched
+
+    def _gather_pairs(self, q_mz, candidates, tolerance):
+        """ Match the peaks of each candidate to the nearest query peak (within the tolerance)
+        """
+        starts = self.offsets[candidates]
+        lengths = self.offsets[candidates + 1] - starts
+        seg = np.repeat(np.arange(len(candidates)), lengths)
+        peak_idx = _ranges(starts, lengths)
+        lib_mz = self.mz[peak_idx]
+
+        pos = np.searchsorted(q_mz, lib_mz)
+        left = np.clip(pos - 1, 0, len(q_mz) - 1)
+        right = np.clip(pos, 0, len(q_mz) - 1)
+        nearest = np.where(np.abs(q_mz[left] - lib_mz) <= np.abs(q_mz[right] - lib_mz), left, right)
+        within = np.flatnonzero(np.abs(q_mz[nearest] - lib_mz) <= tolerance)
+        return seg[within], nearest[within], peak_idx[within]
+
+    def _window_pairs(self, q_mz, lo, hi, candidates):
+        """ Match the library peaks within the tolerance of each query peak (lo:hi of the sorted peaks) to the nearest
+        query peak, only the peaks of the candidates are kept
+        """
+        lengths = hi - lo
+        q_idx = np.repeat(np.arange(len(q_mz)), lengths)
+        lib_idx = self.mz_order[_ranges(lo, lengths)]
+
+        # the candidate of each peak (the candidates are not necessarily in order)
+        cand_order = np.argsort(candidates, kind='stable')
+        sorted_candidates = candidates[cand_order]
+        spectrum = self.peak_spectrum[lib_idx]
+        pos = np.clip(np.searchsorted(sorted_candidates, spectrum), 0, len(candidates) - 1)
+        keep = np.flatnonzero(sorted_candidates[pos] == spectrum)
+        seg, q_idx, lib_idx = cand_order[pos[keep]], q_idx[keep], lib_idx[keep]
+
+        # the nearest query peak of each library peak
+        order = np.lexsort((q_idx, np.abs(q_mz[q_idx] - self.mz[lib_idx]), lib_idx))
+        first = order[np.r_[True, lib_idx[order][1:] != lib_idx[order][:-1]]] if len(order) else order
+        return seg[first], q_idx[first], lib_idx[first]
+
+
+def read_msp_spectra(msp_pth, schema='mona', page_size=1000, **kwargs):
+    """ Read the spectra of MSP files (e.g. the query spectra of a search) with the msp2db parser
+
+    The spectra are parsed into a temporary in memory SQLite database by an Importer (without the compound lookups)
+    and then read back a page at a time.
+
+    Example:
+        >>> from msp2db.search import read_msp_spectra
+        >>> for spectrum in read_msp_spectra('queries.msp'):
+        >>>     print(spectrum['name'], spectrum['precursor_mz'], len(spectrum['peaks']))
+
+    Args:
+        msp_pth (str): path to msp file or directory [required]
+        schema (str): MSP schema either 'mona' or 'massbank' [default 'mona']
+        page_size (int): Number of spectra read at a time [default 1000]
+        **kwargs: other Importer arguments (e.g. user_meta_regex)
+
+    Returns:
+       generator of the spectra (dictionaries of the library_spectra_meta columns and a n x 2 array of 'peaks')
+    """
+    conn = sqlite3.connect(':memory:')
+    create_db(conn=conn)
+    with Importer(conn=conn, schema=schema, compound_lookup=False, structure_lookup=False, checkpoint=False,
+                  **kwargs) as importer:
+        importer.import_path(msp_pth, source='query')
+
+    try:
+        for page in iter_spectra(conn, page_size=page_size, peaks_output='numpy'):
+            for spectrum in page:
+                yield spectrum
+    finally:
+        conn.close()
+
+
+def search_batch(library, queries, workers=1, chunk_size=100, **kwargs):
+    """ Search the library for each of a batch of query spectra (e.g. all the MS/MS spectra of a LC-MS run) with a
+    pool of worker processes
+
+    The library arrays are saved to a temporary directory (or for a library loaded from a snapshot, the snapshot file
+    is used) and memory mapped by each worker, so the library is shared by the workers rather than copied to each
+    one. The results are yielded in the order of the queries as
+    they are completed.
+
+    Example:
+        >>> from msp2db.search import SpectralLibrary, read_msp_spectra, search_batch
+        >>> library = SpectralLibrary.from_db(conn)
+        >>> for query, hits in search_batch(library, read_msp_spectra('queries.msp'), workers=4, top_k=5):
+        >>>     print(query['name'], hits[:1])
+
+    Args:
+        library (SpectralLibrary): The library to search
+        queries (iterable): Query spectra, dictionaries with the 'peaks' and (optionally) the 'precursor_mz'
+        workers (int): Number of worker processes [default 1]
+        chunk_size (int): Number of queries sent to a worker at a time [default 100]
+        **kwargs: Arguments of SpectralLibrary.search (e.g. tolerance, top_k, method and precursor_ppm)
+
+    Returns:
+       generator of tuples of each query and its list of hits
+    """
+    chunks = _query_chunks(queries, chunk_size)
+
+    if workers == 1:
+        for chunk in chunks:
+            for query in chunk:
+                yield query, library.search(query['peaks'], precursor_mz=_to_float(query.get('precursor_mz')),
+                                            **kwargs)
+        return
+
+    snapshot_pth = getattr(library, 'snapshot_pth', None)
+    lib_dir = None if snapshot_pth else tempfile.mkdtemp()
+    pool = None
+    try:
+        if snapshot_pth:
+            pool = multiprocessing.Pool(processes=workers, initializer=_init_snapshot_worker, initargs=(snapshot_pth,))
+        else:
+            library.save(lib_dir)
+            pool = multiprocessing.Pool(processes=workers, initializer=_init_worker, initargs=(lib_dir,))
+
+        # only the peaks and the precursor of each query are sent to the workers
+        pending = []
+        tasks = ((kwargs, [(q['peaks'], _to_float(q.get('precursor_mz'))) for q in chunk])
+                 for chunk in _remember(chunks, pending))
+        for hits in pool.imap(_search_chunk, tasks):
+            chunk = pending.pop(0)
+            for query, query_hits in zip(chunk, hits):
+                yield query, query_hits
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if lib_dir:
+            shutil.rmtree(lib_dir, ignore_errors=True)
+
+
+def write_hits(results, out_pth):
+    """ Write the hits of search_batch to a CSV file or a SQLite database (a search_hits table) as they are yielded
+
+    Args:
+        results (iterable): Tuples of each query and its list of hits (see search_batch)
+        out_pth (str): Path of the output, a SQLite database if it ends with .db or .sqlite otherwise a CSV file
+
+    Returns:
+       Number of queries written
+    """
+    n = 0
+    if out_pth.lower().endswith(('.db', '.sqlite')):
+        conn = sqlite3.connect(out_pth)
+        conn.execute('DROP TABLE IF EXISTS search_hits')
+        conn.execute('CREATE TABLE search_hits (query_id integer, query_name text, query_accession text, '
+                     'query_precursor_mz real, rank integer, library_spectra_meta_id integer, score real, '
+                     'matched_peaks integer)')
+        for query, hits in results:
+            conn.executemany('INSERT INTO search_hits VALUES (?, ?, ?, ?, ?, ?, ?, ?)', _hit_rows(query, hits))
+            n += 1
+            if n % 1000 == 0:
+                conn.commit()
+        conn.commit()
+        conn.close()
+        return n
+
+    with open(out_pth, 'w') if six.PY3 else open(out_pth, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(HIT_COLUMNS)
+        for query, hits in results:
+            writer.writerows(_hit_rows(query, hits))
+            n += 1
+    return n
+
+
+def _hit_rows(query, hits):
+    return [(query.get('id'), query.get('name'), query.get('accession'), query.get('precursor_mz'),
+             rank + 1, hit['id'], hit['score'], hit['matched_peaks']) for rank, hit in enumerate(hits)]
+
+
+def _query_chunks(queries, chunk_size):
+    chunk = []
+    for query in queries:
+        chunk.append(query)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _remember(chunks, pending):
+    """ Keep the chunks sent to the pool (in order) to match them with the results
+    """
+    for chunk in chunks:
+        pending.append(chunk)
+        yield chunk
+
+
+def _init_worker(lib_dir):
+    global _worker_library
+    _worker_library = SpectralLibrary.load(lib_dir, mmap_mode='r')
+
+
+def _init_snapshot_worker(snapshot_pth):
+    global _worker_library
+    from .snapshot import Snapshot
+    _worker_library = Snapshot(snapshot_pth).library()
+
+
+def _search_chunk(task):
+    kwargs, queries = task
+    return [_worker_library.search(peaks, precursor_mz=precursor_mz, **kwargs) for peaks, precursor_mz in queries]
+
+
+def _ranges(starts, lengths):
+    """ Concatenated ranges starts[k]:starts[k] + lengths[k]
+    """
+    return np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(starts, lengths)
+
+
+def _clean_peaks(peaks):
+    """ Peaks as a n x 2 array sorted by m/z without peaks of zero intensity
+    """
+    peaks = np.asarray(peaks, dtype=np.float64).reshape(-1, 2)
+    peaks = peaks[peaks[:, 1] > 0]
+    return peaks[np.argsort(peaks[:, 0], kind='stable')]
+
+
+def _normalise_cosine(mz, intensity, peak_spectrum, n, mz_power, intensity_power):
+    """ Weight the intensities (m/z ** mz_power * intensity ** intensity_power) and scale each spectrum to a unit norm
+    """
+    weighted = np.power(intensity, intensity_power)
+    if mz_power:
+        weighted = weighted * np.power(mz, mz_power)
+    norm = np.sqrt(np.bincount(peak_spectrum, weights=weighted ** 2, minlength=n))
+    norm[norm == 0] = 1
+    return weighted / norm[peak_spectrum]
+
+
+def _normalise_entropy(intensity, peak_spectrum, n):
+    """ Entropy weight the intensities of the spectra with a spectral entropy below 3 and scale each spectrum to a
+    sum of 1 (Li et al. 2021 https://doi.org/10.1038/s41592-021-01331-z)
+    """
+    total = np.bincount(peak_spectrum, weights=intensity, minlength=n)
+    total[total == 0] = 1
+    p = intensity / total[peak_spectrum]
+    entropy = -np.bincount(peak_spectrum, weights=_xlogx(p), minlength=n)
+
+    weight = np.where(entropy < 3, 0.25 + 0.25 * entropy, 1.0)
+    weighted = np.power(p, weight[peak_spectrum])
+    total = np.bincount(peak_spectrum, weights=weighted, minlength=n)
+    total[total == 0] = 1
+    return weighted / total[peak_spectrum]
+
+
+def _xlogx(x):
+    return np.where(x > 0, x * np.log(np.where(x > 0, x, 1)), 0)
+
+
+def _xlog2x(x):
+    return np.where(x > 0, x * np.log2(np.where(x > 0, x, 1)), 0)
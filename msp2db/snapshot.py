@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+from __future__ import absolute_import, unicode_literals, print_function
+import json
+import mmap
+import struct
+import numpy as np
+import six
+from .db import iter_table
+from .query import PrecursorIndex, _to_float
+from .search import SpectralLibrary, LIBRARY_ARRAYS
+
+# file layout: magic, version (uint32), length of the JSON header (uint64), JSON header and then the arrays (each
+# aligned to ALIGNMENT bytes from the start of the data)
+MAGIC = b'MSP2DBSN'
+VERSION = 1
+ALIGNMENT = 64
+_PREAMBLE = struct.Struct('<8sIQ')
+
+# the text columns of library_spectra_meta stored in the metadata table of a snapshot
+TEXT_COLUMNS = ('name', 'accession', 'inchikey_id')
+
+
+class Snapshot(object):
+    """Read-only snapshot of a library (a single binary file memory mapped when it is opened)
+
+    The arrays of the snapshot are views of the memory map (nothing is read or copied when the snapshot is opened),
+    so opening a snapshot takes milliseconds whatever the size of the library and any number of processes that open
+    the same snapshot share one copy of it in the page cache. The snapshot holds the peaks of the spectra (contiguous
+    m/z and intensity arrays and the offset of the first peak of each spectrum), the normalised intensities and m/z
+    order used by the spectral similarity search, the spectra sorted by precursor m/z and a compact metadata table
+    (id, precursor m/z, polarity, ms level, retention time, name, accession and inchikey of each spectrum).
+
+    Example:
+        >>> from msp2db.db import get_connection
+        >>> from msp2db.snapshot import create_snapshot, Snapshot
+        >>> conn = get_connection('sqlite', 'library.db')
+        >>> create_snapshot(conn, 'library.snapshot')
+        >>> snapshot = Snapshot('library.snapshot')
+        >>> snapshot.spectrum(57)['name']
+        'Glucose'
+        >>> snapshot.library().search([(85.0284, 12.0), (179.0697, 100.0)], precursor_mz=179.0697)
+        [{'id': 57, 'score': 0.998, 'matched_peaks': 2}, ...]
+
+    Args:
+        snapshot_pth (str): Path of the snapshot file (see create_snapshot)
+
+    Returns:
+        Snapshot object
+    """
+    def __init__(self, snapshot_pth):
+        self.snapshot_pth = snapshot_pth
+        with open(snapshot_pth, 'rb') as f:
+            # the map stays valid after the file is closed
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, header_size = _PREAMBLE.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError('{} is not a msp2db snapshot'.format(snapshot_pth))
+        if version != VERSION:
+            raise ValueError('{} is a version {} snapshot (version {} is supported)'.format(snapshot_pth, version,
+                                                                                             VERSION))
+        self.header = json.loads(self._mmap[_PREAMBLE.size:_PREAMBLE.size + header_size].decode('utf-8'))
+
+        data_start = _align(_PREAMBLE.size + header_size)
+        self.arrays = {}
+        for name, spec in six.iteritems(self.header['arrays']):
+            count = int(np.prod(spec['shape']))
+            self.arrays[name] = np.frombuffer(self._mmap, dtype=np.dtype(spec['dtype']), count=count,
+                                              offset=data_start + spec['offset']).reshape(spec['shape'])
+
+    def __len__(self):
+        return self.header['n_spectra']
+
+    def library(self):
+        """ Get the SpectralLibrary of the snapshot (the arrays of the library are views of the memory map)
+
+        Returns:
+           SpectralLibrary object
+        """
+        library = SpectralLibrary.__new__(SpectralLibrary)
+        for name in LIBRARY_ARRAYS:
+            setattr(library, name, self.arrays[name])
+        library.mz_power = self.header['mz_power']
+        library.intensity_power = self.header['intensity_power']
+        library.precursor_index = PrecursorIndex.from_sorted(self.arrays['precursor_order'],
+                                                             self.arrays['precursor_sorted_mz'],
+                                                             self.arrays['precursor_sorted_polarity'],
+                                                             self.arrays['precursor_sorted_ms_level'],
+                                                             self.arrays['precursor_sorted_retention_time'])
+        # the workers of search_batch open the snapshot rather than a temporary copy of the library
+        library.snapshot_pth = self.snapshot_pth
+        return library
+
+    def position(self, meta_id):
+        """ Get the position of a spectrum in the arrays of the snapshot
+
+        Args:
+            meta_id (int): The library_spectra_meta id of the spectrum
+
+        Returns:
+           position (int) or None if the spectrum is not in the snapshot
+        """
+        meta_ids, id_order = self.arrays['meta_ids'], self.arrays['id_order']
+        pos = int(np.searchsorted(meta_ids, meta_id, sorter=id_order))
+        if pos < len(id_order) and meta_ids[id_order[pos]] == meta_id:
+            return int(id_order[pos])
+        return None
+
+    def text(self, column, j):
+        """ Get the value of a text column (see TEXT_COLUMNS) of the spectrum at position j
+
+        Returns:
+           str (None if the value is missing)
+        """
+        offsets = self.arrays[column + '_offsets']
+        start, end = int(offsets[j]), int(offsets[j + 1])
+        if start == end and self.arrays[column + '_missing'][j]:
+            return None
+        return self.arrays[column + '_bytes'][start:end].tobytes().decode('utf-8')
+
+    def spectrum(self, meta_id):
+        """ Get the metadata and peaks of a spectrum
+
+        Args:
+            meta_id (int): The library_spectra_meta id of the spectrum
+
+        Returns:
+           dictionary of the metadata and a n x 2 array of 'peaks' (or None if the spectrum is not in the snapshot)
+        """
+        j = self.position(meta_id)
+        if j is None:
+            return None
+        a = self.arrays
+        start, end = a['offsets'][j], a['offsets'][j + 1]
+        spectrum = {'id': int(a['meta_ids'][j]),
+                    'precursor_mz': _optional(a['precursor_mz'][j]),
+                    'polarity': int(a['polarity'][j]),
+                    'ms_level': _optional(a['ms_level'][j]),
+                    'retention_time': _optional(a['retention_time'][j]),
+                    'peaks': np.column_stack((a['mz'][start:end], a['intensity'][start:end]))}
+        for column in self.header['text_columns']:
+            spectrum[column] = self.text(column, j)
+        return spectrum
+
+
+def create_snapshot(conn, snapshot_pth, db_type='sqlite', page_size=100000, **kwargs):
+    """ Write a snapshot of the spectra of a database (see Snapshot)
+
+    Example:
+        >>> from msp2db.db import get_connection
+        >>> from msp2db.snapshot import create_snapshot
+        >>> conn = get_connection('sqlite', 'library.db')
+        >>> create_snapshot(conn, 'library.snapshot', intensity_power=0.5)
+
+    Args:
+        conn (connection object): Database connection object
+        snapshot_pth (str): Path of the snapshot file
+        db_type (str): Type of database (sqlite, mysql, postgres or django_mysql) [default "sqlite"]
+        page_size (int): Number of rows fetched at a time [default 100000]
+        **kwargs: mz_power and intensity_power of the SpectralLibrary
+
+    Returns:
+       Number of spectra in the snapshot
+    """
+    library = SpectralLibrary.from_db(conn, db_type=db_type, page_size=page_size, **kwargs)
+    # ordered by id (the same order as the library)
+    meta = [row for page in iter_table(conn, 'library_spectra_meta', page_size=page_size, db_type=db_type,
+                                       columns=('id', 'retention_time') + TEXT_COLUMNS, order_by='id')
+            for row in page]
+    text = {column: [row[2 + k] for row in meta] for k, column in enumerate(TEXT_COLUMNS)}
+    write_snapshot(library, snapshot_pth, retention_time=[_to_float(row[1]) for row in meta], text=text)
+    return len(library)
+
+
+def write_snapshot(library, snapshot_pth, retention_time=None, text=None):
+    """ Write a SpectralLibrary (and the metadata of its spectra) to a snapshot file
+
+    Args:
+        library (SpectralLibrary): The library
+        snapshot_pth (str): Path of the snapshot file
+        retention_time (list): Retention time of each spectrum [default None]
+        text (dict): Text metadata of the spectra (column name to the list of the value of each spectrum)
+                     [default None]
+    """
+    n = len(library)
+    arrays = [(name, getattr(library, name)) for name in LIBRARY_ARRAYS]
+
+    rt = np.array(retention_time if retention_time is not None else np.full(n, np.nan), dtype=np.float64)
+    arrays.append(('retention_time', rt))
+    arrays.append(('id_order', np.argsort(library.meta_ids, kind='stable')))
+
+    # the positions of the spectra with a precursor m/z sorted by precursor m/z (the arrays of the PrecursorIndex)
+    order = np.asarray(library.precursor_index.meta_ids, dtype=np.int64)
+    arrays.extend([('precursor_order', order),
+                   ('precursor_sorted_mz', library.precursor_mz[order]),
+                   ('precursor_sorted_polarity', library.polarity[order]),
+                   ('precursor_sorted_ms_level', library.ms_level[order]),
+                   ('precursor_sorted_retention_time', rt[order])])
+
+    text = text or {}
+    for column in TEXT_COLUMNS:
+        values = text.get(column, [None] * n)
+        encoded = [b'' if v is None else six.text_type(v).encode('utf-8') for v in values]
+        arrays.extend([(column + '_offsets', np.r_[0, np.cumsum([len(v) for v in encoded])].astype(np.int64)),
+                       (column + '_bytes', np.frombuffer(b''.join(encoded), dtype=np.uint8)),
+                       (column + '_missing', np.array([v is None for v in values], dtype=bool))])
+
+    header = {'n_spectra': n, 'n_peaks': len(library.mz), 'mz_power': library.mz_power,
+              'intensity_power': library.intensity_power, 'text_columns': list(TEXT_COLUMNS), 'arrays': {}}
+    offset = 0
+    for name, array in arrays:
+        array = np.ascontiguousarray(array)
+        header['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset = _align(offset + array.nbytes)
+    header_bytes = json.dumps(header, sort_keys=True).encode('utf-8')
+
+    with open(snapshot_pth, 'wb') as f:
+        f.write(_PREAMBLE.pack(MAGIC, VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        _pad(f, _align(f.tell()))
+        data_start = f.tell()
+        for name, array in arrays:
+            _pad(f, data_start + header['arrays'][name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+        # so the offset of an empty array at the end is within the file
+        _pad(f, data_start + offset)
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _pad(f, position):
+    f.write(b'\0' * (position - f.tell()))
+
+
+def _optional(value):
+    value = float(value)
+    return None if np.isnan(value) else value
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+from __future__ import absolute_import, unicode_literals, print_function
+import hashlib
+import multiprocessing
+import numpy as np
+
+# SPLASH (SPectraL hASH) version 1 of MS spectra, see Wohlgemuth et al. 2016 https://doi.org/10.1038/nbt.3689
+PREFIX = 'splash10'
+EPS_CORRECTION = 1.0e-7
+RELATIVE_INTENSITY_SCALE = 100.0
+MZ_PRECISION_FACTOR = 1000000
+MAX_HASH_CHARACTERS = 20
+
+PREFILTER_BASE = 3
+PREFILTER_LENGTH = 10
+PREFILTER_BIN_SIZE = 5
+PREFILTER_TOP_IONS = 10
+PREFILTER_BASE_PEAK_PERCENTAGE = 0.1
+
+SIMILARITY_BASE = 10
+SIMILARITY_LENGTH = 10
+SIMILARITY_BIN_SIZE = 100
+
+_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+def splash(mz, intensity):
+    """ Calculate the SPLASH identifier of a MS spectrum
+
+    Example:
+        >>> from msp2db.splash import splash
+        >>> splash([133.0648, 151.0754, 155.9743, 161.0597, 179.0703],
+        >>>        [21905.33, 9239.90, 10980.89, 96508.44, 72563.88])
+        'splash10-03fr-0900000000-035ec76d23650a15673b'
+
+    Args:
+        mz (list): m/z values of the peaks (list or numpy array)
+        intensity (list): intensities of the peaks (list or numpy array)
+
+    Returns:
+       SPLASH identifier (str) or None if the spectrum has no peaks with a positive intensity
+
+    """
+    mz = np.asarray(mz, dtype=float)
+    intensity = np.asarray(intensity, dtype=float)
+
+    if not len(mz) or intensity.max() <= 0:
+        return None
+
+    relative = intensity / intensity.max() * RELATIVE_INTENSITY_SCALE
+
+    # the prefilter block only uses the top ions above a percentage of the base peak
+    keep = np.flatnonzero(relative >= PREFILTER_BASE_PEAK_PERCENTAGE * RELATIVE_INTENSITY_SCALE)
+    keep = keep[np.argsort(-relative[keep], kind='stable')][:PREFILTER_TOP_IONS]
+    prefilter = _histogram(mz[keep], relative[keep], PREFILTER_BASE, PREFILTER_LENGTH, PREFILTER_BIN_SIZE)
+
+    return '-'.join([PREFIX,
+                     _translate_base(prefilter, PREFILTER_BASE, 36, 4),
+                     _histogram(mz, relative, SIMILARITY_BASE, SIMILARITY_LENGTH, SIMILARITY_BIN_SIZE),
+                     _hash_block(mz, relative)])
+
+
+def splash_batch(spectra, processes=1, pool=None):
+    """ Calculate the SPLASH identifiers of a batch of spectra (in a pool of worker processes)
+
+    Example:
+        >>> from msp2db.splash import splash_batch
+        >>> splash_batch([([100.0, 200.0], [10.0, 100.0]), ([150.0], [5.0])], processes=2)
+
+    Args:
+        spectra (list): List of tuples of the m/z values and intensities of each spectrum
+        processes (int): Number of worker processes (ignored if a pool is provided) [default 1]
+        pool (multiprocessing.Pool): Pool of worker processes to use (e.g. shared between batches) [default None]
+
+    Returns:
+       list of SPLASH identifiers in the same order as the spectra
+
+    """
+    if pool is not None:
+        return pool.map(_splash_star, spectra)
+
+    if processes == 1 or len(spectra) < 2:
+        return [splash(mz, intensity) for mz, intensity in spectra]
+
+    pool = multiprocessing.Pool(processes=processes)
+    try:
+        return pool.map(_splash_star, spectra)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def group_peaks(peak_rows, meta_id_col=4, mz_col=1, intensity_col=2):
+    """ Group peak rows (e.g. the library_spectra rows) by spectrum
+
+    Args:
+        peak_rows (list): List of tuples of the peak rows
+        meta_id_col (int): Index of the library_spectra_meta id [default 4]
+        mz_col (int): Index of the m/z [default 1]
+        intensity_col (int): Index of the intensity [default 2]
+
+    Returns:
+       dictionary of the library_spectra_meta id to a tuple of the m/z and intensity arrays
+
+    """
+    if not peak_rows:
+        return {}
+
+    meta_ids = np.array([row[meta_id_col] for row in peak_rows], dtype=np.int64)
+    mz = np.array([row[mz_col] for row in peak_rows], dtype=float)
+    intensity = np.array([row[intensity_col] for row in peak_rows], dtype=float)
+
+    order = np.argsort(meta_ids, kind='stable')
+    meta_ids, mz, intensity = meta_ids[order], mz[order], intensity[order]
+    starts = np.flatnonzero(np.r_[True, meta_ids[1:] != meta_ids[:-1]])
+    ends = np.r_[starts[1:], len(meta_ids)]
+
+    return {int(meta_ids[s]): (mz[s:e], intensity[s:e]) for s, e in zip(starts, ends)}
+
+
+def backfill_splash(conn, db_type='sqlite', overwrite=False, page_size=1000, processes=1):
+    """ Calculate the SPLASH identifiers of the spectra in an existing database
+
+    The spectra are read (and updated) a page at a time so the memory use does not depend on the size of the
+    database.
+
+    Example:
+        >>> from msp2db.db import get_connection
+        >>> from msp2db.splash import backfill_splash
+        >>> conn = get_connection('sqlite', 'library.db')
+        >>> backfill_splash(conn, processes=4)
+
+    Args:
+        conn (connection object): Database connection object
+        db_type (str): Type of database either "sqlite", "mysql", "postgres" or "django_mysql" [default "sqlite"]
+        overwrite (boolean): Replace the SPLASH of spectra that already have one [default False]
+        page_size (int): Number of spectra in each page [default 1000]
+        processes (int): Number of worker processes [default 1]
+
+    Returns:
+       Number of spectra updated
+
+    """
+    type_sign = '?' if db_type == 'sqlite' else '%s'
+    missing = '' if overwrite else " AND (splash IS NULL OR splash = '')"
+
+    pool = multiprocessing.Pool(processes=processes) if processes != 1 else None
+    c = conn.cursor()
+    last_id = 0
+    updated = 0
+    try:
+        while True:
+            # keyset pagination (the previous page is finished before the updates so works for any database)
+            c.execute('SELECT id FROM library_spectra_meta WHERE id > {}{} ORDER BY id LIMIT {}'.format(
+                type_sign, missing, int(page_size)), (last_id,))
+            meta_ids = [row[0] for row in c.fetchall()]
+            if not meta_ids:
+                break
+            last_id = meta_ids[-1]
+
+            c.execute('SELECT id, mz, i, other, library_spectra_meta_id FROM library_spectra '
+                      'WHERE library_spectra_meta_id IN ({})'.format(', '.join([type_sign] * len(meta_ids))),
+                      meta_ids)
+            peaks = group_peaks(c.fetchall())
+
+            ids = [meta_id for meta_id in meta_ids if meta_id in peaks]
+            splashes = splash_batch([peaks[meta_id] for meta_id in ids], processes=processes, pool=pool)
+            rows = [(s, meta_id) for s, meta_id in zip(splashes, ids) if s]
+
+            c.executemany('UPDATE library_spectra_meta SET splash = {t} WHERE id = {t}'.format(t=type_sign), rows)
+            conn.commit()
+            updated += len(rows)
+            print('{} spectra updated'.format(updated))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return updated
+
+
+def _splash_star(spectrum):
+    return splash(*spectrum)
+
+
+def _histogram(mz, relative, base, length, bin_size):
+    """ Histogram of the intensities (wrapped into a fixed number of m/z bins) scaled to a single digit of base
+    """
+    histogram = np.bincount((mz / bin_size).astype(np.int64) % length, weights=relative, minlength=length)
+    if histogram.max() > 0:
+        histogram = histogram / histogram.max()
+    scaled = (EPS_CORRECTION + (base - 1) * histogram).astype(np.int64)
+    return ''.join(_DIGITS[x] for x in scaled)
+
+
+def _translate_base(number, initial_base, final_base, fill):
+    n = int(number, initial_base)
+    digits = ''
+    while n > 0:
+        n, r = divmod(n, final_base)
+        digits = _DIGITS[r] + digits
+    return digits.rjust(fill, '0')
+
+
+def _hash_block(mz, relative):
+    """ Truncated SHA-256 of the peaks (sorted by m/z and then by decreasing intensity)
+    """
+    order = np.lexsort((-relative, mz))
+    mz_int = (mz[order] * MZ_PRECISION_FACTOR + EPS_CORRECTION).astype(np.int64)
+    intensity_int = (relative[order] + EPS_CORRECTION).astype(np.int64)
+    peaks = ' '.join('{}:{}'.format(m, i) for m, i in zip(mz_int.tolist(), intensity_int.tolist()))
+    return hashlib.sha256(peaks.encode('utf-8')).hexdigest()[:MAX_HASH_CHARACTERS]
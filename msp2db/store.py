@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+from __future__ import absolute_import, unicode_literals, print_function
+import collections
+import numpy as np
+
+# approximate memory of a cached spectrum in addition to its arrays (the dictionary, arrays and cache entry)
+_ENTRY_OVERHEAD = 512
+
+
+class SpectrumStore(object):
+    """Read API for the peaks (and annotations) of spectra by library_spectra_meta id with a LRU cache
+
+    The spectra that are not cached are fetched with one query per batch of ids (rather than one query per spectrum)
+    and the peaks are returned as numpy arrays. The cache is bounded by the (approximate) memory of the cached
+    arrays, the least recently used spectra are evicted first. The cache is not updated when spectra are changed
+    (e.g. by an incremental import), use clear or invalidate.
+
+    Example:
+        >>> from msp2db.db import get_connection
+        >>> from msp2db.store import SpectrumStore
+        >>> conn = get_connection('sqlite', 'library.db')
+        >>> store = SpectrumStore(conn, cache_bytes=256 * 1024 ** 2)
+        >>> spectra = store.get_spectra([1, 57, 103])
+        >>> spectra[57]['mz'], spectra[57]['intensity']
+        (array([ 85.0284, 179.0697]), array([ 12., 100.]))
+        >>> store.stats()
+        {'hits': 0, 'misses': 3, 'hit_rate': 0.0, 'evictions': 0, 'entries': 3, 'bytes': 1632, ...}
+
+    Args:
+        conn (connection object): Database connection object
+        db_type (str): Type of database either "sqlite", "mysql", "postgres" or "django_mysql" [default "sqlite"]
+        cache_bytes (int): Maximum memory of the cached spectra in bytes (0 to disable the cache)
+                           [default 64 MiB]
+        batch_size (int): Maximum number of ids in each query [default 500]
+
+    Returns:
+        SpectrumStore object
+    """
+    def __init__(self, conn, db_type='sqlite', cache_bytes=64 * 1024 ** 2, batch_size=500):
+        self.conn = conn
+        self.db_type = db_type
+        self.cache_bytes = cache_bytes
+        self.batch_size = batch_size
+        self._cache = collections.OrderedDict()
+        self._bytes = 0
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get_spectrum(self, meta_id, annotations=False):
+        """ Get the peaks of a single spectrum (see get_spectra)
+        """
+        return self.get_spectra([meta_id], annotations=annotations)[meta_id]
+
+    def get_spectra(self, meta_ids, annotations=False):
+        """ Get the peaks (and optionally the annotations) of spectra
+
+        Args:
+            meta_ids (list): The library_spectra_meta ids of the spectra
+            annotations (boolean): Include the library_spectra_annotation rows of each spectrum [default False]
+
+        Returns:
+           ordered dictionary (in the order of meta_ids) of each id to a dictionary of the 'mz' and 'intensity' numpy
+           arrays of the peaks (sorted by m/z) and the 'annotations' (a dictionary of the 'mz', 'tentative_formula'
+           and 'mass_error' of the annotations) if requested. Ids without peaks have empty arrays.
+        """
+        meta_ids = [int(meta_id) for meta_id in meta_ids]
+        kinds = ['peaks', 'annotations'] if annotations else ['peaks']
+
+        found = {}
+        for kind in kinds:
+            missing = []
+            for meta_id in meta_ids:
+                value = self._get((kind, meta_id))
+                if value is None:
+                    missing.append(meta_id)
+                else:
+                    found[(kind, meta_id)] = value
+
+            fetch = self._fetch_peaks if kind == 'peaks' else self._fetch_annotations
+            for meta_id, value in fetch(sorted(set(missing))).items():
+                self._put((kind, meta_id), value)
+                found[(kind, meta_id)] = value
+
+        spectra = collections.OrderedDict()
+        for meta_id in meta_ids:
+            spectrum = dict(found[('peaks', meta_id)])
+            if annotations:
+                spectrum['annotations'] = found[('annotations', meta_id)]
+            spectra[meta_id] = spectrum
+        return spectra
+
+    def stats(self):
+        """ Get the cache statistics (e.g. to choose the cache size)
+
+        Returns:
+           dictionary of the number of cache hits, misses and evictions, the hit rate, the number of cached entries
+           (the peaks and annotations of each spectrum are separate entries) and the bytes used
+        """
+        stats = dict(self._stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = float(stats['hits']) / lookups if lookups else 0.0
+        stats['entries'] = len(self._cache)
+        stats['bytes'] = self._bytes
+        stats['max_bytes'] = self.cache_bytes
+        return stats
+
+    def invalidate(self, meta_ids):
+        """ Remove spectra from the cache (e.g. spectra that have been changed or deleted)
+
+        Args:
+            meta_ids (list): The library_spectra_meta ids of the spectra
+        """
+        for meta_id in meta_ids:
+            for kind in ('peaks', 'annotations'):
+                self._remove((kind, int(meta_id)))
+
+    def clear(self):
+        """ Remove all the spectra from the cache (the statistics are kept)
+        """
+        self._cache.clear()
+        self._bytes = 0
+
+    def _get(self, key):
+        value = self._cache.get(key)
+        if value is None:
+            self._stats['misses'] += 1
+            return None
+        self._stats['hits'] += 1
+        # most recently used last (re-inserted as python 2 has no move_to_end)
+        self._cache[key] = self._cache.pop(key)
+        return value[0]
+
+    def _put(self, key, value):
+        size = _ENTRY_OVERHEAD + sum(v.nbytes for v in value.values() if isinstance(v, np.ndarray))
+        if size > self.cache_bytes:
+            return
+        self._remove(key)
+        self._cache[key] = (value, size)
+        self._bytes += size
+        while self._bytes > self.cache_bytes:
+            _, (_, evicted) = self._cache.popitem(last=False)
+            self._bytes -= evicted
+            self._stats['evictions'] += 1
+
+    def _remove(self, key):
+        if key in self._cache:
+            self._bytes -= self._cache.pop(key)[1]
+
+    def _batches(self, meta_ids):
+        for i in range(0, len(meta_ids), self.batch_size):
+            yield meta_ids[i:i + self.batch_size]
+
+    def _query(self, sql, batch):
+        type_sign = '?' if self.db_type == 'sqlite' else '%s'
+        c = self.conn.cursor()
+        c.execute(sql.format(', '.join([type_sign] * len(batch))), batch)
+        rows = c.fetchall()
+        c.close()
+        return rows
+
+    def _fetch_peaks(self, meta_ids):
+        """ The peaks of the spectra (one query per batch of ids)
+        """
+        peaks = {meta_id: {'mz': np.empty(0), 'intensity': np.empty(0)} for meta_id in meta_ids}
+        for batch in self._batches(meta_ids):
+            rows = self._query('SELECT library_spectra_meta_id, mz, i FROM library_spectra '
+                               'WHERE library_spectra_meta_id IN ({})', batch)
+            if not rows:
+                continue
+            rows = np.array(rows, dtype=np.float64)
+            rows = rows[np.lexsort((rows[:, 1], rows[:, 0]))]
+            ids = rows[:, 0].astype(np.int64)
+            starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+            ends = np.r_[starts[1:], len(ids)]
+            for start, end in zip(starts, ends):
+                # copies so each cached spectrum only holds its own peaks
+                peaks[int(ids[start])] = {'mz': rows[start:end, 1].copy(), 'intensity': rows[start:end, 2].copy()}
+        return peaks
+
+    def _fetch_annotations(self, meta_ids):
+        """ The annotations of the spectra (one query per batch of ids)
+        """
+        grouped = {meta_id: [] for meta_id in meta_ids}
+        for batch in self._batches(meta_ids):
+            for row in self._query('SELECT library_spectra_meta_id, mz, tentative_formula, mass_error '
+                                   'FROM library_spectra_annotation WHERE library_spectra_meta_id IN ({}) '
+                                   'ORDER BY library_spectra_meta_id, mz', batch):
+                grouped[row[0]].append(row[1:])
+
+        annotations = {}
+        for meta_id, rows in grouped.items():
+            annotations[meta_id] = {'mz': np.array([r[0] for r in rows], dtype=np.float64),
+                                    'tentative_formula': [r[1] for r in rows],
+                                    'mass_error': np.array([r[2] for r in rows], dtype=np.float64)}
+        return annotations
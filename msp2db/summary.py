@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+from __future__ import absolute_import, unicode_literals, print_function
+import numpy as np
+from .db import create_table, insert_query_m
+
+# the columns of the library_spectra_summary table (after the library_spectra_meta_id)
+SUMMARY_COLUMNS = ['num_peaks', 'base_peak_mz', 'base_peak_intensity', 'tic', 'min_mz', 'max_mz', 'norm_factor']
+
+# relative intensities are scaled so the base peak is 100 (norm_factor = RELATIVE_SCALE / base_peak_intensity)
+RELATIVE_SCALE = 100.0
+
+
+def summarise_peaks(meta_ids, peak_meta_ids, mz, intensity):
+    """ Calculate the summary of each spectrum (the library_spectra_summary rows) from its peaks
+
+    All the peaks are summarised at once (the base peak is the most intense peak, the lowest m/z if there is a tie).
+
+    Example:
+        >>> from msp2db.summary import summarise_peaks
+        >>> summarise_peaks([1, 2], [1, 1, 1], [100.0, 150.0, 200.0], [10.0, 50.0, 20.0])
+        [(1, 3, 150.0, 50.0, 80.0, 100.0, 200.0, 2.0), (2, 0, None, None, None, None, None, None)]
+
+    Args:
+        meta_ids (list): The library_spectra_meta ids of the spectra (spectra without peaks have a num_peaks of 0)
+        peak_meta_ids (list): library_spectra_meta id of each peak
+        mz (list): m/z of each peak
+        intensity (list): Intensity of each peak
+
+    Returns:
+       list of tuples of the library_spectra_meta id and the SUMMARY_COLUMNS of each spectrum
+    """
+    meta_ids = np.asarray(meta_ids, dtype=np.int64)
+    peak_meta_ids = np.asarray(peak_meta_ids, dtype=np.int64)
+    mz = np.asarray(mz, dtype=np.float64)
+    intensity = np.asarray(intensity, dtype=np.float64)
+
+    # peaks grouped by spectrum, the base peak first in each group
+    order = np.lexsort((mz, -intensity, peak_meta_ids))
+    peak_meta_ids, mz, intensity = peak_meta_ids[order], mz[order], intensity[order]
+    starts = np.flatnonzero(np.r_[True, peak_meta_ids[1:] != peak_meta_ids[:-1]]) if len(order) else order
+
+    counts = np.diff(np.r_[starts, len(order)])
+    tic = np.add.reduceat(intensity, starts) if len(order) else intensity
+    min_mz = np.minimum.reduceat(mz, starts) if len(order) else mz
+    max_mz = np.maximum.reduceat(mz, starts) if len(order) else mz
+    base_mz, base_i = mz[starts], intensity[starts]
+    with np.errstate(divide='ignore'):
+        norm_factor = np.where(base_i > 0, RELATIVE_SCALE / base_i, np.nan)
+
+    summaries = {}
+    for k, meta_id in enumerate(peak_meta_ids[starts].tolist()):
+        summaries[meta_id] = (int(counts[k]), float(base_mz[k]), float(base_i[k]), float(tic[k]), float(min_mz[k]),
+                              float(max_mz[k]), None if np.isnan(norm_factor[k]) else float(norm_factor[k]))
+    empty = (0, None, None, None, None, None, None)
+    return [(meta_id,) + summaries.get(meta_id, empty) for meta_id in meta_ids.tolist()]
+
+
+def summarise_peak_rows(meta_ids, peak_rows):
+    """ Calculate the summary of each spectrum from the library_spectra rows (id, mz, i, other,
+    library_spectra_meta_id) of the spectra, see summarise_peaks
+    """
+    return summarise_peaks(meta_ids, [row[4] for row in peak_rows], [row[1] for row in peak_rows],
+                           [row[2] for row in peak_rows])
+
+
+def backfill_summary(conn, db_type='sqlite', overwrite=False, page_size=1000):
+    """ Calculate the library_spectra_summary rows of the spectra in an existing database
+
+    The summaries are calculated by the database (an aggregate query of the peaks of a page of spectra at a time),
+    so the peaks are not transferred to the client.
+
+    Example:
+        >>> from msp2db.db import get_connection
+        >>> from msp2db.summary import backfill_summary
+        >>> conn = get_connection('sqlite', 'library.db')
+        >>> backfill_summary(conn)
+
+    Args:
+        conn (connection object): Database connection object
+        db_type (str): Type of database either "sqlite", "mysql", "postgres" or "django_mysql" [default "sqlite"]
+        overwrite (boolean): Recalculate the summaries of spectra that already have one [default False]
+        page_size (int): Number of spectra in each page [default 1000]
+
+    Returns:
+       Number of spectra summarised
+    """
+    create_table(conn, 'library_spectra_summary', db_type)
+    type_sign = '?' if db_type == 'sqlite' else '%s'
+    missing = '' if overwrite else (' AND NOT EXISTS (SELECT 1 FROM library_spectra_summary s '
+                                    'WHERE s.library_spectra_meta_id = m.id)')
+
+    c = conn.cursor()
+    last_id = 0
+    updated = 0
+    while True:
+        # keyset pagination (the previous page is finished before the inserts so works for any database)
+        c.execute('SELECT id FROM library_spectra_meta m WHERE id > {}{} ORDER BY id LIMIT {}'.format(
+            type_sign, missing, int(page_size)), (last_id,))
+        meta_ids = [row[0] for row in c.fetchall()]
+        if not meta_ids:
+            break
+        last_id = meta_ids[-1]
+
+        in_ids = ', '.join([type_sign] * len(meta_ids))
+        c.execute('SELECT a.library_spectra_meta_id, a.num_peaks, min(p.mz), a.base_peak_intensity, a.tic, a.min_mz, '
+                  'a.max_mz FROM (SELECT library_spectra_meta_id, count(*) AS num_peaks, '
+                  'max(i) AS base_peak_intensity, sum(i) AS tic, min(mz) AS min_mz, max(mz) AS max_mz '
+                  'FROM library_spectra WHERE library_spectra_meta_id IN ({}) '
+                  'GROUP BY library_spectra_meta_id) a '
+                  'JOIN library_spectra p ON p.library_spectra_meta_id = a.library_spectra_meta_id '
+                  'AND p.i = a.base_peak_intensity '
+                  'GROUP BY a.library_spectra_meta_id, a.num_peaks, a.base_peak_intensity, a.tic, a.min_mz, '
+                  'a.max_mz'.format(in_ids), meta_ids)
+        summaries = {}
+        for row in c.fetchall():
+            base_i = float(row[3])
+            summaries[row[0]] = (int(row[1]), float(row[2]), base_i, float(row[4]), float(row[5]), float(row[6]),
+                                 RELATIVE_SCALE / base_i if base_i > 0 else None)
+        empty = (0, None, None, None, None, None, None)
+        rows = [(meta_id,) + summaries.get(meta_id, empty) for meta_id in meta_ids]
+
+        if overwrite:
+            c.execute('DELETE FROM library_spectra_summary WHERE library_spectra_meta_id IN ({})'.format(in_ids),
+                      meta_ids)
+        insert_query_m(rows, 'library_spectra_summary', conn,
+                       columns='library_spectra_meta_id, ' + ', '.join(SUMMARY_COLUMNS), db_type=db_type)
+        conn.commit()
+        updated += len(rows)
+        print('{} spectra summarised'.format(updated))
+
+    return updated
+
+
+def query_summary(conn, db_type='sqlite', **bounds):
+    """ Find the spectra by their summary (an indexed query of the library_spectra_summary table rather than a scan
+    of the peaks)
+
+    Example:
+        >>> from msp2db.db import get_connection
+        >>> from msp2db.summary import query_summary
+        >>> conn = get_connection('sqlite', 'library.db')
+        >>> query_summary(conn, min_num_peaks=5, min_base_peak_intensity=1e4)
+        [3, 12, 57]
+
+    Args:
+        conn (connection object): Database connection object
+        db_type (str): Type of database either "sqlite", "mysql", "postgres" or "django_mysql" [default "sqlite"]
+        **bounds: Inclusive bounds of the SUMMARY_COLUMNS as min_<column> or max_<column> (e.g. min_num_peaks=5)
+
+    Returns:
+       sorted list of the library_spectra_meta ids
+    """
+    type_sign = '?' if db_type == 'sqlite' else '%s'
+    where, params = [], []
+    for key, value in sorted(bounds.items()):
+        bound, _, column = key.partition('_')
+        if bound not in ('min', 'max') or column not in SUMMARY_COLUMNS:
+            raise ValueError('unknown bound {} (use min_<column> or max_<column> of {})'.format(
+                key, ', '.join(SUMMARY_COLUMNS)))
+        where.append('{} {} {}'.format(column, '>=' if bound == 'min' else '<=', type_sign))
+        params.append(value)
+
+    sql = 'SELECT library_spectra_meta_id FROM library_spectra_summary'
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    c = conn.cursor()
+    c.execute(sql + ' ORDER BY library_spectra_meta_id', params)
+    return [row[0] for row in c.fetchall()]
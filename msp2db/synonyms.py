@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+from __future__ import absolute_import, unicode_literals, print_function
+import re
+import six
+from .db import create_table, insert_query_m, SYNONYM_FTS_TABLE
+
+# the separator of the names in the other_names column of metab_compound
+OTHER_NAMES_SEPARATOR = ' <#> '
+
+SYNONYM_COLUMNS = 'inchikey_id, synonym, synonym_key, is_name'
+
+MODES = ('token', 'prefix')
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def synonym_key(name):
+    """ Normalise a name for the case insensitive (prefix) search of the names and synonyms
+
+    Example:
+        >>> from msp2db.synonyms import synonym_key
+        >>> synonym_key('  D-Glucose  6-Phosphate ')
+        'd-glucose 6-phosphate'
+
+    Args:
+        name (str): Compound name or synonym
+
+    Returns:
+       lower case name (str) with the whitespace collapsed
+    """
+    return ' '.join(six.text_type(name).lower().split())
+
+
+def synonym_rows(inchikey_id, name, other_names):
+    """ Get the metab_compound_synonym rows of a compound (the name and each of the other names)
+
+    Args:
+        inchikey_id (str): The inchikey_id of the compound
+        name (str): Name of the compound
+        other_names (str): Other names of the compound (either a list or joined with ' <#> ' as in metab_compound)
+
+    Returns:
+       list of tuples of the SYNONYM_COLUMNS (a name is only included once)
+    """
+    if isinstance(other_names, six.string_types):
+        other_names = other_names.split(OTHER_NAMES_SEPARATOR)
+
+    rows = []
+    seen = set()
+    for is_name, synonym in [(1, name)] + [(0, n) for n in other_names or []]:
+        if not synonym or not synonym.strip():
+            continue
+        key = synonym_key(synonym)
+        if key in seen:
+            continue
+        seen.add(key)
+        rows.append((inchikey_id, synonym.strip(), key, is_name))
+    return rows
+
+
+def insert_synonyms(conn, rows, db_type='sqlite'):
+    """ Insert metab_compound_synonym rows (and add them to the SQLite full-text index)
+
+    Args:
+        conn (connection object): Database connection object
+        rows (list): Tuples of the SYNONYM_COLUMNS (see synonym_rows)
+        db_type (str): Type of database either "sqlite", "mysql", "postgres" or "django_mysql" [default "sqlite"]
+    """
+    if not rows:
+        return
+    insert_query_m(rows, 'metab_compound_synonym', conn, columns=SYNONYM_COLUMNS, db_type=db_type)
+    if db_type == 'sqlite' and _fts_exists(conn.cursor()):
+        conn.cursor().executemany('INSERT INTO {} (synonym, inchikey_id) VALUES (?, ?)'.format(SYNONYM_FTS_TABLE),
+                                  [(row[1], row[0]) for row in rows])
+
+
+def backfill_synonyms(conn, db_type='sqlite', page_size=10000):
+    """ Rebuild the metab_compound_synonym table (and full-text index) from the name and other_names of the compounds
+    in an existing database
+
+    Example:
+        >>> from msp2db.db import get_connection
+        >>> from msp2db.synonyms import backfill_synonyms
+        >>> conn = get_connection('sqlite', 'library.db')
+        >>> backfill_synonyms(conn)
+
+    Args:
+        conn (connection object): Database connection object
+        db_type (str): Type of database either "sqlite", "mysql", "postgres" or "django_mysql" [default "sqlite"]
+        page_size (int): Number of compounds in each page [default 10000]
+
+    Returns:
+       Number of names and synonyms stored
+    """
+    create_table(conn, 'metab_compound_synonym', db_type)
+    type_sign = '?' if db_type == 'sqlite' else '%s'
+    c = conn.cursor()
+    c.execute('DELETE FROM metab_compound_synonym')
+    if db_type == 'sqlite' and _fts_exists(c):
+        c.execute('DELETE FROM {}'.format(SYNONYM_FTS_TABLE))
+    conn.commit()
+
+    last_id = ''
+    stored = 0
+    while True:
+        # keyset pagination (the previous page is finished before the inserts so works for any database)
+        c.execute('SELECT inchikey_id, name, other_names FROM metab_compound WHERE inchikey_id > {} '
+                  'ORDER BY inchikey_id LIMIT {}'.format(type_sign, int(page_size)), (last_id,))
+        compounds = c.fetchall()
+        if not compounds:
+            break
+        last_id = compounds[-1][0]
+
+        rows = [row for compound in compounds for row in synonym_rows(*compound)]
+        insert_synonyms(conn, rows, db_type)
+        conn.commit()
+        stored += len(rows)
+        print('{} names and synonyms stored'.format(stored))
+
+    return stored
+
+
+def search_compounds(conn, query, db_type='sqlite', mode='token', limit=20):
+    """ Search the compounds by name and synonym
+
+    A "token" search finds the names where each word of the query is the start of a word of the name (with the
+    full-text index, e.g. "gluc phos" finds "glucose 6-phosphate"). A "prefix" search finds the names that start with
+    the query (with the index of the normalised names, see synonym_key). Both are case insensitive.
+
+    Example:
+        >>> from msp2db.db import get_connection
+        >>> from msp2db.synonyms import search_compounds
+        >>> conn = get_connection('sqlite', 'library.db')
+        >>> search_compounds(conn, 'glucose phos', limit=2)
+        [{'inchikey_id': 'NBSCHQHZLSJFNQ-GASJEMHNSA-N', 'name': 'Glucose 6-phosphate',
+          'synonym': 'D-Glucose 6-phosphate'}, ...]
+
+    Args:
+        conn (connection object): Database connection object
+        query (str): Name (or the start of the words of a name) to search for
+        db_type (str): Type of database either "sqlite", "mysql", "postgres" or "django_mysql" [default "sqlite"]
+        mode (str): Either "token" or "prefix" [default "token"]
+        limit (int): Maximum number of compounds [default 20]
+
+    Returns:
+       list of dictionaries of the inchikey_id, name (of the compound) and the matched synonym of each compound
+    """
+    if mode not in MODES:
+        raise ValueError('mode must be one of {}'.format(', '.join(MODES)))
+    type_sign = '?' if db_type == 'sqlite' else '%s'
+    c = conn.cursor()
+    # more rows than compounds are fetched as a compound can match with several of its names
+    n_rows = int(limit) * 10
+
+    if mode == 'prefix':
+        key = synonym_key(query)
+        if not key:
+            return []
+        # the range of the keys starting with the prefix (so the index is used whatever the collation of LIKE)
+        upper = key[:-1] + six.unichr(ord(key[-1]) + 1)
+        c.execute('SELECT inchikey_id, synonym, synonym_key FROM metab_compound_synonym WHERE synonym_key >= {t} '
+                  'AND synonym_key < {t} ORDER BY synonym_key LIMIT {n}'.format(t=type_sign, n=n_rows), (key, upper))
+        matches = [(row[0], row[1]) for row in c.fetchall() if row[2].startswith(key)]
+    else:
+        tokens = _TOKEN_RE.findall(six.text_type(query).lower())
+        if not tokens:
+            return []
+        if db_type == 'sqlite' and _fts_exists(c):
+            c.execute('SELECT inchikey_id, synonym FROM {} WHERE {} MATCH ? ORDER BY rank LIMIT {}'.format(
+                SYNONYM_FTS_TABLE, SYNONYM_FTS_TABLE, n_rows), (' AND '.join('"{}"*'.format(t) for t in tokens),))
+        elif db_type in ('mysql', 'django_mysql'):
+            c.execute('SELECT inchikey_id, synonym FROM metab_compound_synonym WHERE MATCH (synonym) AGAINST '
+                      '(%s IN BOOLEAN MODE) LIMIT {}'.format(n_rows), (' '.join('+{}*'.format(t) for t in tokens),))
+        elif db_type == 'postgres':
+            c.execute("SELECT inchikey_id, synonym FROM metab_compound_synonym WHERE to_tsvector('simple', synonym) "
+                      "@@ to_tsquery('simple', %s) ORDER BY length(synonym) LIMIT {}".format(n_rows),
+                      (' & '.join('{}:*'.format(t) for t in tokens),))
+        else:
+            # without a full-text index the names are scanned
+            c.execute('SELECT inchikey_id, synonym FROM metab_compound_synonym WHERE {} LIMIT {}'.format(
+                ' AND '.join(['synonym_key LIKE {}'.format(type_sign)] * len(tokens)), n_rows),
+                ['%{}%'.format(t) for t in tokens])
+        matches = [(row[0], row[1]) for row in c.fetchall()]
+
+    # the first (best) match of each compound
+    hits = []
+    seen = set()
+    for inchikey_id, synonym in matches:
+        if inchikey_id not in seen:
+            seen.add(inchikey_id)
+            hits.append({'inchikey_id': inchikey_id, 'synonym': synonym})
+    hits = hits[:limit]
+
+    if hits:
+        c.execute('SELECT inchikey_id, name FROM metab_compound WHERE inchikey_id IN ({})'.format(
+            ', '.join([type_sign] * len(hits))), [hit['inchikey_id'] for hit in hits])
+        names = dict(c.fetchall())
+        for hit in hits:
+            hit['name'] = names.get(hit['inchikey_id'])
+    return hits
+
+
+def _fts_exists(c):
+    c.execute("SELECT count(*) FROM sqlite_master WHERE name = ?", (SYNONYM_FTS_TABLE,))
+    return bool(c.fetchone()[0])
@@ -1,3 +1,6 @@
+import hashlib
+
+
 def removekey(d, key):
     r = dict(d)
     del r[key]
@@ -53,4 +56,21 @@ def get_blank_dict(d):
     Return:
           dictionary with blank values
     """
-    return {k: '' for k in d.keys()}
\ No newline at end of file
+    return {k: '' for k in d.keys()}
+
+
+def record_hash(lines):
+    """ Get a stable hash of the content of a MSP record
+
+    Each line is normalised (surrounding and repeated whitespace removed) and blank lines and record separators
+    ("//") are ignored, so only changes to the meta data or the peaks change the hash
+
+    Args:
+        lines (list): The lines of the record
+
+    Return:
+          SHA-1 hex digest of the record (str)
+    """
+    normalised = [' '.join(line.split()) for line in lines]
+    content = '\n'.join(line for line in normalised if line and line != '//')
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
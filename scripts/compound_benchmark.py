@@ -0,0 +1,54 @@
+# coding: utf-8
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from __future__ import print_function
+import argparse
+import csv
+import os
+import sqlite3
+import tempfile
+from msp2db.benchmark import run_compound_benchmark, resample_msp, load_fixtures, fixtures_from_db
+
+#############################################################
+# Benchmark the compound resolution against a local PubChem stand-in
+#############################################################
+p = argparse.ArgumentParser(description='Benchmark compound resolution of an msp file against a local PubChem '
+                                         'stand-in')
+p.add_argument('-m', '--msp_pth', required=True, help='MSP file to parse')
+p.add_argument('-f', '--fixtures', required=True, help='JSON compound fixtures or an existing msp2db SQLite database')
+p.add_argument('-x', '--schema', default='mona')
+p.add_argument('-n', '--n_records', type=int, default=0, help='Resample the msp file to this many records')
+p.add_argument('--skew', type=float, default=1.1, help='Skew of the compound duplicate distribution')
+p.add_argument('--latency', type=float, default=0.2)
+p.add_argument('--latency_jitter', type=float, default=0.1)
+p.add_argument('--error_rate', type=float, default=0.01)
+p.add_argument('--rate_limit', type=float, default=5)
+p.add_argument('--structure_lookup', action='store_true')
+p.add_argument('-o', '--out_pth', help='CSV file to append the results to')
+args = p.parse_args()
+
+if args.fixtures.endswith('.db'):
+    fixtures = fixtures_from_db(sqlite3.connect(args.fixtures))
+else:
+    fixtures = load_fixtures(args.fixtures)
+
+msp_pth = args.msp_pth
+if args.n_records:
+    msp_pth = resample_msp(msp_pth, os.path.join(tempfile.mkdtemp(), 'resampled.msp'), args.n_records,
+                           skew=args.skew, seed=0)
+
+results = run_compound_benchmark(msp_pth, fixtures, schema=args.schema, latency=args.latency,
+                                 latency_jitter=args.latency_jitter, error_rate=args.error_rate,
+                                 rate_limit=args.rate_limit, structure_lookup=args.structure_lookup, seed=0)
+
+for k, v in results.items():
+    print('{}: {}'.format(k, v))
+
+if args.out_pth:
+    new_file = not os.path.exists(args.out_pth)
+    with open(args.out_pth, 'a') as f:
+        dw = csv.DictWriter(f, fieldnames=['msp_pth'] + sorted(results.keys()))
+        if new_file:
+            dw.writeheader()
+        results['msp_pth'] = args.msp_pth
+        dw.writerow(results)
@@ -0,0 +1,14 @@
+# coding: utf-8
+# Minimal SQLite backed Django settings used to test the Django database backend of msp2db
+import os
+import tempfile
+
+SECRET_KEY = 'msp2db-tests'
+INSTALLED_APPS = []
+USE_TZ = False
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(tempfile.mkdtemp(), 'django_library.db'),
+    }
+}
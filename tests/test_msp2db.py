@@ -2,16 +2,41 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import gzip
+import io
 import re
 import os
 import unittest
 import sqlite3
-from msp2db.parse import LibraryData
-from msp2db.db import create_db, db_dict
+from msp2db.parse import LibraryData, Importer, add_splash_ids
+from msp2db.db import create_db, create_table, db_dict, get_connection, insert_query_m, _tsv_line, \
+    _multirow_batches, _convert_ddl, _IMPORT_TABLES, iter_table, iter_spectra
+from msp2db import chem
+from msp2db.splash import splash, group_peaks, backfill_splash
+from msp2db.build import build_sqlite, split_msp
+from msp2db.query import PrecursorIndex, query_precursor_sql, create_precursor_index, polarity_code
+from msp2db.search import SpectralLibrary, read_msp_spectra, search_batch, write_hits
+from msp2db.index import FragmentIndex, NeutralLossIndex
+from msp2db.snapshot import Snapshot, create_snapshot
+from msp2db.summary import summarise_peaks, backfill_summary, query_summary
+from msp2db.synonyms import synonym_rows, backfill_synonyms, search_compounds
+from msp2db.store import SpectrumStore
+from msp2db.export import export_msp, export_where, iter_records, export_arrow
+from msp2db.mona import iter_json_records, parse_spectrum_string, record_info
+from msp2db.__main__ import main
+from msp2db.benchmark import PubChemStandIn, fixtures_from_db, resample_msp, run_compound_benchmark
+import pubchempy as pcp
 
 from sqlite3 import OperationalError
 import tempfile
 import shutil
+import csv
+import json
+import importlib.util
+from six.moves import zip_longest
+
+PANDAS_AVAILABLE = importlib.util.find_spec('pandas') is not None
+PYARROW_AVAILABLE = importlib.util.find_spec('pyarrow') is not None
 
 
 def check_table_exists_sqlite(cursor, tablename):
@@ -328,6 +353,1172 @@ class TestSqlite(unittest.TestCase):
         self.compare_db_d(db_new, db_original)
 
 
+@unittest.skipUnless(chem.RDKIT_AVAILABLE, 'RDKit is not installed')
+class TestChem(unittest.TestCase):
+
+    def test_structure_info(self):
+        chem.clear_structure_cache()
+        info = chem.structure_info(smiles='CC1CC2=C(C(=CC=C2)O)C(=O)O1')
+        self.assertEqual(info['inchikey_id'], 'KWILGNNWGSNMPA-UHFFFAOYSA-N')
+        self.assertEqual(info['molecular_formula'], 'C10H10O3')
+        self.assertAlmostEqual(info['exact_mass'], 178.06299, places=4)
+
+        self.assertIsNone(chem.structure_info(smiles='not a smiles'))
+        self.assertIsNone(chem.structure_info())
+
+    def test_structure_info_batch(self):
+        chem.clear_structure_cache()
+        structures = [('inchi', 'InChI=1S/C10H10O3/c1-6-5-7-3-2-4-8(11)9(7)10(12)13-6/h2-4,6,11H,5H2,1H3'),
+                      ('smiles', 'CC1CC2=C(C(=CC=C2)O)C(=O)O1'),
+                      ('smiles', 'CC1CC2=C(C(=CC=C2)O)C(=O)O1')]
+        results = chem.structure_info_batch(structures, processes=2)
+        self.assertEqual([r['inchikey_id'] for r in results], ['KWILGNNWGSNMPA-UHFFFAOYSA-N'] * 3)
+        self.assertIn(('smiles', 'CC1CC2=C(C(=CC=C2)O)C(=O)O1'), chem._structure_cache)
+
+    def test_local_inchikey_derivation(self):
+        dirpath = tempfile.mkdtemp()
+        msp_pth = os.path.join(dirpath, 'AC000001_no_inchikey.txt')
+        with open(os.path.join(os.path.dirname(__file__), "msp_files", "massbank", "AC000001.txt")) as f:
+            lines = [l for l in f if not l.startswith('CH$LINK: INCHIKEY')]
+        with open(msp_pth, 'w') as f:
+            f.writelines(lines)
+
+        db_pth = os.path.join(dirpath, 'local.db')
+        create_db(file_pth=db_pth)
+        libdata = LibraryData(msp_pth=msp_pth, db_pth=db_pth, db_type='sqlite', schema='massbank',
+                              source='test', chunk=200, structure_processes=2)
+
+        d = libdata.get_db_dict()
+        self.assertEqual(d['metab_compound'][0][0], 'KWILGNNWGSNMPA-UHFFFAOYSA-N')
+        self.assertEqual(d['library_spectra_meta'][0][-1], 'KWILGNNWGSNMPA-UHFFFAOYSA-N')
+
+
+class TestPubChemStandIn(unittest.TestCase):
+
+    def setUp(self):
+        conn = sqlite3.connect(os.path.join(os.path.dirname(__file__), 'original_results', 'test_msp_mona.db'))
+        self.fixtures = fixtures_from_db(conn)
+
+    def test_standin_lookup(self):
+        with PubChemStandIn(self.fixtures) as server:
+            pccs = pcp.get_compounds(self.fixtures[0]['inchikey'], 'inchikey')
+            self.assertEqual(pccs[0].inchikey, self.fixtures[0]['inchikey'])
+            self.assertEqual(pccs[0].cid, self.fixtures[0]['cid'])
+            self.assertEqual(pcp.get_compounds('not a compound', 'name'), [])
+
+        self.assertEqual(server.stats['found'], 1)
+        self.assertEqual(server.stats['not_found'], 1)
+        self.assertTrue(pcp.API_BASE.startswith('https://pubchem'))
+
+    def test_standin_errors(self):
+        with PubChemStandIn(self.fixtures, error_rate=1.0):
+            self.assertRaises(pcp.ServerError, pcp.get_compounds, self.fixtures[0]['inchikey'], 'inchikey')
+
+        with PubChemStandIn(self.fixtures, rate_limit=1) as server:
+            for i in range(3):
+                try:
+                    pcp.get_compounds(self.fixtures[0]['inchikey'], 'inchikey')
+                except pcp.PubChemHTTPError:
+                    pass
+        self.assertGreater(server.stats['throttled'], 0)
+
+    def test_compound_benchmark(self):
+        dirpath = tempfile.mkdtemp()
+        msp_pth = resample_msp(os.path.join(os.path.dirname(__file__), 'msp_files', 'mona',
+                                            'MoNA-export-MassBank-small.msp'),
+                               os.path.join(dirpath, 'resampled.msp'), 50, seed=1)
+
+        results = run_compound_benchmark(msp_pth, self.fixtures, schema='mona', error_rate=0.1, seed=1)
+
+        self.assertEqual(results['records'], 50)
+        self.assertEqual(results['cache_misses'], results['requests'])
+        self.assertGreater(results['cache_hit_ratio'], 0.5)
+        self.assertGreater(results['compounds_per_second'], 0)
+
+        shutil.rmtree(dirpath)
+
+
+class TestBulkInsert(unittest.TestCase):
+
+    def test_tsv_line(self):
+        self.assertEqual(_tsv_line((1, 133.0648, None, 'a\tb\\c\nd')), '1\t133.0648\t\\N\ta\\tb\\\\c\\nd\n')
+
+    def test_multirow_batches(self):
+        rows = [(i, 'x' * 10) for i in range(100)]
+        batches = list(_multirow_batches(rows, 200))
+        self.assertEqual([r for b in batches for r in b], rows)
+        self.assertTrue(all(len(b) < 100 for b in batches))
+
+    def test_convert_ddl(self):
+        stmt = _convert_ddl('CREATE TABLE t (inchikey_id text PRIMARY KEY, column text, mz real)', 'mysql')
+        self.assertEqual(stmt, 'CREATE TABLE t (inchikey_id varchar(255) PRIMARY KEY, `column` text, mz double)')
+        self.assertEqual(_convert_ddl('CREATE TABLE t (inchikey_id text PRIMARY KEY)', 'django_mysql'),
+                         'CREATE TABLE t (inchikey_id varchar(255) PRIMARY KEY)')
+
+        self.assertEqual(_convert_ddl('CREATE TABLE t (id integer PRIMARY KEY, mz real)', 'postgres'),
+                         'CREATE TABLE t (id integer GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY, mz double precision)')
+        for table in ('library_spectra_summary', 'library_spectra_hash'):
+            self.assertNotIn('IDENTITY', _convert_ddl(dict(_IMPORT_TABLES)[table], 'postgres'))
+
+    def test_create_table_django_mysql(self):
+        class Cursor(object):
+            def __init__(self, statements):
+                self.statements = statements
+
+            def execute(self, stmt, params=None):
+                self.statements.append(stmt)
+
+            def fetchall(self):
+                # no indexes exist yet
+                return [(0,)]
+
+        class Connection(object):
+            vendor = 'mysql'
+
+            def __init__(self):
+                self.statements = []
+
+            def cursor(self):
+                return Cursor(self.statements)
+
+            def commit(self):
+                pass
+
+        for db_type in ('django_mysql', 'django'):
+            conn = Connection()
+            create_table(conn, 'metab_compound_synonym', db_type)
+            self.assertIn('inchikey_id varchar(255)', conn.statements[0])
+            self.assertIn('CREATE INDEX metab_compound_synonym_key_idx ON metab_compound_synonym (synonym_key(191))',
+                          conn.statements)
+            self.assertIn('CREATE FULLTEXT INDEX metab_compound_synonym_fulltext_idx ON metab_compound_synonym '
+                          '(synonym)', conn.statements)
+
+        conn = Connection()
+        conn.vendor = 'postgresql'
+        create_table(conn, 'library_spectra_summary', 'django')
+        self.assertIn('base_peak_mz double precision', conn.statements[0])
+
+    def test_chunked_insert(self):
+        conn = sqlite3.connect(':memory:')
+        conn.execute('CREATE TABLE t (id integer PRIMARY KEY, mz real)')
+        rows = [(i, i * 1.5) for i in range(1, 2502)]
+        rate = insert_query_m(rows, 't', conn, columns='id, mz', db_type='sqlite', chunk_size=1000)
+        self.assertGreater(rate, 0)
+        self.assertEqual(conn.execute('SELECT * FROM t').fetchall(), rows)
+
+
+class TestImporter(unittest.TestCase):
+
+    def test_importer(self):
+        dirpath = tempfile.mkdtemp()
+        mona_dir = os.path.join(os.path.dirname(__file__), 'msp_files', 'mona')
+        metabobase_pth = os.path.join(mona_dir, 'MoNA-export-MetaboBASE-small.msp')
+        pathogen_pth = os.path.join(mona_dir, 'MoNA-export-Pathogen_Box-small.msp')
+        kwargs = {'db_type': 'sqlite', 'schema': 'mona', 'chunk': 3, 'compound_lookup': False,
+                  'structure_lookup': False}
+
+        # separate LibraryData imports
+        libdata_pth = os.path.join(dirpath, 'libdata.db')
+        create_db(libdata_pth)
+        for source, msp_pth in (('metabobase', metabobase_pth), ('pathogen_box', pathogen_pth)):
+            LibraryData(msp_pth=msp_pth, db_pth=libdata_pth, source=source, **kwargs).close()
+
+        # the same imports with a single Importer (the second from a binary stream)
+        importer_pth = os.path.join(dirpath, 'importer.db')
+        create_db(importer_pth)
+        with Importer(db_pth=importer_pth, **kwargs) as importer:
+            n = importer.import_path(metabobase_pth, source='metabobase')
+            with io.open(pathogen_pth, 'rb') as f:
+                n += importer.import_stream(f, source='pathogen_box')
+        self.assertIsNone(importer.conn)
+
+        d_libdata = db_dict(sqlite3.connect(libdata_pth).cursor())
+        d_importer = db_dict(sqlite3.connect(importer_pth).cursor())
+        self.assertEqual(n, len(d_libdata['library_spectra_meta']))
+        self.assertEqual(d_importer['library_spectra'], d_libdata['library_spectra'])
+        # the compounds are random UNKNOWN inchikeys without the compound lookup
+        self.assertEqual([r[:-1] for r in d_importer['library_spectra_meta']],
+                         [r[:-1] for r in d_libdata['library_spectra_meta']])
+        self.assertEqual([r[:2] for r in d_importer['library_spectra_source']],
+                         [r[:2] for r in d_libdata['library_spectra_source']])
+
+        shutil.rmtree(dirpath)
+
+
+class TestQuery(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(os.path.join(os.path.dirname(__file__), 'original_results', 'test_msp_mona.db'))
+        self.rows = self.conn.execute('SELECT id, precursor_mz, polarity, ms_level, retention_time '
+                                      'FROM library_spectra_meta').fetchall()
+
+    def _brute_force(self, mz, ppm, polarity=None):
+        return sorted([r for r in self.rows if r[1] is not None and abs(r[1] - mz) <= mz * ppm * 1e-6 and
+                       (polarity is None or polarity_code(r[2]) == polarity_code(polarity))],
+                      key=lambda r: (r[1], r[0]))
+
+    def test_precursor_index(self):
+        index = PrecursorIndex.from_db(self.conn)
+        self.assertEqual(len(index), len([r for r in self.rows if r[1] is not None]))
+
+        mzs = [r[1] for r in self.rows if r[1] is not None]
+        batch = index.query_batch(mzs, ppm=20, polarity='positive')
+        for mz, ids in zip(mzs, batch):
+            expected = [r[0] for r in self._brute_force(mz, 20, 'positive')]
+            self.assertEqual(list(ids), expected)
+            self.assertEqual(list(index.query(mz, ppm=20, polarity='positive')), expected)
+            self.assertEqual(query_precursor_sql(self.conn, mz, ppm=20, polarity='positive'), expected)
+
+        # absolute tolerance and ms level
+        self.assertEqual(len(index.query(300, ppm=0, mz_tol=1000, ms_level=2)), len(index))
+        self.assertEqual(len(index.query(300, ppm=0, mz_tol=1000, ms_level=3)), 0)
+
+    def test_retention_time(self):
+        index = PrecursorIndex([1, 2, 3, 4], [100.0, 100.0005, 100.0, None], ['positive', 'POSITIVE', 'negative', '+'],
+                               [2, 2, 2, 2], [5.0, None, 5.4, 5.0])
+        self.assertEqual(list(index.query(100.0, ppm=10)), [1, 3, 2])
+        self.assertEqual(list(index.query(100.0, ppm=10, rt=5.1, rt_tol=0.2)), [1])
+        self.assertEqual([list(ids) for ids in index.query_batch([100.0, 100.0], ppm=10, rt=[5.1, 5.5], rt_tol=0.2)],
+                         [[1], [3]])
+        with self.assertRaises(ValueError):
+            index.query(100.0, rt=5.1)
+
+    def test_polarity_filter(self):
+        conn = sqlite3.connect(':memory:')
+        conn.execute('CREATE TABLE library_spectra_meta (id integer, precursor_mz real, polarity text, ms_level real, '
+                     'retention_time real)')
+        polarities = ['positive', 'NEGATIVE', None, 'unknown', ' pos ', '']
+        conn.executemany('INSERT INTO library_spectra_meta VALUES (?, 100.0, ?, 2, NULL)', enumerate(polarities, 1))
+        index = PrecursorIndex.from_db(conn)
+        for polarity, expected in (('positive', [1, 5]), ('negative', [2]), ('unknown', [3, 4, 6]), (0, [3, 4, 6]),
+                                   (None, [1, 2, 3, 4, 5, 6])):
+            self.assertEqual(list(index.query(100.0, polarity=polarity)), expected)
+            self.assertEqual(query_precursor_sql(conn, 100.0, polarity=polarity), expected)
+
+    def test_create_precursor_index(self):
+        conn = sqlite3.connect(':memory:')
+        conn.execute('CREATE TABLE library_spectra_meta (id integer, precursor_mz real, retention_time real)')
+        create_precursor_index(conn)
+        create_precursor_index(conn)
+        self.assertEqual(conn.execute("SELECT count(*) FROM sqlite_master WHERE type = 'index'").fetchone()[0], 1)
+
+
+class TestSearch(unittest.TestCase):
+
+    def test_scores(self):
+        library = SpectralLibrary.from_peaks([1, 2, 3], [[(100.0, 1.0), (300.0, 1.0)], [(200.0, 5.0)], []],
+                                             precursor_mz=[350.0, 250.0, None])
+        query = [(200.005, 1.0), (100.0, 1.0), (150.0, 0.0)]
+
+        hits = library.search(query, tolerance=0.01)
+        self.assertEqual([h['id'] for h in hits], [2, 1])
+        self.assertAlmostEqual(hits[0]['score'], 2 ** -0.5)
+        self.assertAlmostEqual(hits[1]['score'], 0.5)
+        self.assertAlmostEqual(library.search(query, method='entropy')[1]['score'], 0.5)
+        self.assertEqual(library.search(query, tolerance=0.001, top_k=1)[0]['id'], 1)
+        self.assertEqual([h['id'] for h in library.search(query, precursor_mz=350.001, precursor_ppm=10)], [1])
+
+        weighted = SpectralLibrary.from_peaks([1], [[(100.0, 1.0), (300.0, 1.0)]], mz_power=1)
+        self.assertAlmostEqual(weighted.search([(100.0, 1.0), (200.0, 1.0)])[0]['score'],
+                               10000 / (50000 ** 0.5 * 100000 ** 0.5))
+
+    def test_library_search(self):
+        conn = sqlite3.connect(os.path.join(os.path.dirname(__file__), 'original_results', 'test_msp_mona.db'))
+        library = SpectralLibrary.from_db(conn)
+        self.assertEqual(len(library), conn.execute('SELECT count(*) FROM library_spectra_meta').fetchone()[0])
+
+        for meta_id, precursor_mz in conn.execute('SELECT id, precursor_mz FROM library_spectra_meta'):
+            peaks = conn.execute('SELECT mz, i FROM library_spectra WHERE library_spectra_meta_id = ?',
+                                 (meta_id,)).fetchall()
+            for method in ('cosine', 'entropy'):
+                hits = library.search(peaks, precursor_mz=precursor_mz, method=method, top_k=50)
+                self.assertAlmostEqual(max(h['score'] for h in hits), 1.0)
+                self.assertIn(meta_id, [h['id'] for h in hits if h['score'] > 1 - 1e-9])
+
+
+class TestSearchBatch(unittest.TestCase):
+
+    def test_search_batch(self):
+        conn = sqlite3.connect(os.path.join(os.path.dirname(__file__), 'original_results', 'test_msp_mona.db'))
+        library = SpectralLibrary.from_db(conn, intensity_power=0.5)
+        msp_pth = os.path.join(os.path.dirname(__file__), 'msp_files', 'mona', 'MoNA-export-MetaboBASE-small.msp')
+        queries = list(read_msp_spectra(msp_pth))
+        self.assertEqual(len(queries), 15)
+        self.assertEqual(queries[0]['accession'], 'MetaboBASE0001')
+
+        dirpath = tempfile.mkdtemp()
+        library.save(os.path.join(dirpath, 'library'))
+        loaded = SpectralLibrary.load(os.path.join(dirpath, 'library'))
+
+        serial = [hits for _, hits in search_batch(library, queries, top_k=3)]
+        parallel = [hits for _, hits in search_batch(library, queries, workers=2, chunk_size=4, top_k=3)]
+        self.assertEqual(serial, parallel)
+        self.assertEqual(serial, [loaded.search(q['peaks'], precursor_mz=q['precursor_mz'], top_k=3) for q in queries])
+        self.assertTrue(all(hits[0]['score'] > 0.99 for hits in serial))
+
+        for name in ('hits.csv', 'hits.db'):
+            n = write_hits(search_batch(library, queries, top_k=3), os.path.join(dirpath, name))
+            self.assertEqual(n, 15)
+        with open(os.path.join(dirpath, 'hits.csv')) as f:
+            rows = list(csv.DictReader(f))
+        hits_db = sqlite3.connect(os.path.join(dirpath, 'hits.db'))
+        self.assertEqual(len(rows), sum(len(hits) for hits in serial))
+        self.assertEqual(hits_db.execute('SELECT count(*) FROM search_hits').fetchone()[0], len(rows))
+        self.assertEqual(int(rows[0]['library_spectra_meta_id']), serial[0][0]['id'])
+        shutil.rmtree(dirpath)
+
+
+class TestSummary(unittest.TestCase):
+
+    def test_summarise_peaks(self):
+        rows = summarise_peaks([1, 2, 3], [3, 1, 1, 1, 3], [50.0, 100.0, 150.0, 200.0, 60.0],
+                               [7.0, 10.0, 50.0, 50.0, 0.0])
+        self.assertEqual(rows, [(1, 3, 150.0, 50.0, 110.0, 100.0, 200.0, 2.0),
+                                (2, 0, None, None, None, None, None, None),
+                                (3, 2, 50.0, 7.0, 7.0, 50.0, 60.0, 100.0 / 7.0)])
+
+    def test_import_and_backfill(self):
+        dirpath = tempfile.mkdtemp()
+        db_pth = os.path.join(dirpath, 'library.db')
+        create_db(db_pth)
+        msp_pth = os.path.join(os.path.dirname(__file__), 'msp_files', 'mona', 'MoNA-export-MetaboBASE-small.msp')
+        LibraryData(msp_pth=msp_pth, db_pth=db_pth, source='test', chunk=4, compound_lookup=False).close()
+
+        conn = sqlite3.connect(db_pth)
+        imported = conn.execute('SELECT * FROM library_spectra_summary ORDER BY library_spectra_meta_id').fetchall()
+        self.assertEqual(len(imported), 15)
+        expected = conn.execute('SELECT library_spectra_meta_id, count(*), max(i), min(mz), max(mz) '
+                                'FROM library_spectra GROUP BY library_spectra_meta_id').fetchall()
+        self.assertEqual([(r[0], r[1], r[3], r[5], r[6]) for r in imported], expected)
+
+        conn.execute('DELETE FROM library_spectra_summary WHERE library_spectra_meta_id > 10')
+        conn.commit()
+        self.assertEqual(backfill_summary(conn, page_size=2), 5)
+        backfilled = conn.execute('SELECT * FROM library_spectra_summary ORDER BY library_spectra_meta_id').fetchall()
+        for row, expected_row in zip(backfilled, imported):
+            self.assertEqual(row[:4], expected_row[:4])
+            self.assertAlmostEqual(row[4], expected_row[4])
+
+        self.assertEqual(query_summary(conn, min_num_peaks=20, min_base_peak_intensity=50),
+                         [r[0] for r in imported if r[1] >= 20 and r[3] >= 50])
+        self.assertRaises(ValueError, query_summary, conn, min_peaks=5)
+        shutil.rmtree(dirpath)
+
+
+class TestSynonyms(unittest.TestCase):
+
+    def test_synonym_rows(self):
+        self.assertEqual(synonym_rows('IK1', 'Mellein', 'Ochracin <#> mellein <#>  '),
+                         [('IK1', 'Mellein', 'mellein', 1), ('IK1', 'Ochracin', 'ochracin', 0)])
+
+    def test_search_compounds(self):
+        dirpath = tempfile.mkdtemp()
+        db_pth = os.path.join(dirpath, 'library.db')
+        create_db(db_pth)
+        LibraryData(msp_pth=os.path.join(os.path.dirname(__file__), 'msp_files', 'massbank', 'AC000001.txt'),
+                    db_pth=db_pth, schema='massbank', source='test').close()
+
+        conn = sqlite3.connect(db_pth)
+        self.assertEqual(conn.execute('SELECT synonym, is_name FROM metab_compound_synonym').fetchall(),
+                         [('Mellein', 1), ('Ochracin', 0), ('8-hydroxy-3-methyl-3,4-dihydroisochromen-1-one', 0)])
+
+        conn.executemany('INSERT INTO metab_compound (inchikey_id, name, other_names) VALUES (?, ?, ?)',
+                         [('IK1', 'Glucose 6-phosphate', 'D-Glucose 6-phosphate <#> Robison ester'),
+                          ('IK2', 'Glucose', 'Dextrose <#> D-Glucose')])
+        self.assertEqual(backfill_synonyms(conn, page_size=2), 9)
+
+        self.assertEqual([h['inchikey_id'] for h in search_compounds(conn, 'GLUC phos')], ['IK1'])
+        self.assertEqual(sorted(h['inchikey_id'] for h in search_compounds(conn, 'glucose')), ['IK1', 'IK2'])
+        self.assertEqual(search_compounds(conn, 'robison'),
+                         [{'inchikey_id': 'IK1', 'name': 'Glucose 6-phosphate', 'synonym': 'Robison ester'}])
+        self.assertEqual([h['synonym'] for h in search_compounds(conn, 'd-glucose', mode='prefix')],
+                         ['D-Glucose', 'D-Glucose 6-phosphate'])
+        self.assertEqual(search_compounds(conn, 'ochr', mode='prefix')[0]['name'], 'Mellein')
+        self.assertEqual(search_compounds(conn, 'glucose', limit=1, mode='prefix')[0]['inchikey_id'], 'IK2')
+        self.assertEqual(search_compounds(conn, '-'), [])
+        shutil.rmtree(dirpath)
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def test_snapshot(self):
+        conn = sqlite3.connect(os.path.join(os.path.dirname(__file__), 'original_results', 'test_msp_mona.db'))
+        dirpath = tempfile.mkdtemp()
+        pth = os.path.join(dirpath, 'library.snapshot')
+        self.assertEqual(create_snapshot(conn, pth, intensity_power=0.5), 38)
+
+        snapshot = Snapshot(pth)
+        library = snapshot.library()
+        self.assertFalse(library.mz.flags.owndata)
+        meta_id, name, accession, precursor_mz = conn.execute('SELECT id, name, accession, precursor_mz FROM '
+                                                              'library_spectra_meta ORDER BY id DESC').fetchone()
+        spectrum = snapshot.spectrum(meta_id)
+        self.assertEqual((spectrum['name'], spectrum['accession']), (name, accession))
+        self.assertEqual(spectrum['polarity'], 1)
+        peaks = conn.execute('SELECT mz, i FROM library_spectra WHERE library_spectra_meta_id = ? ORDER BY mz',
+                             (meta_id,)).fetchall()
+        self.assertEqual(spectrum['peaks'].tolist(), [list(p) for p in peaks])
+        self.assertIsNone(snapshot.spectrum(-1))
+
+        expected = SpectralLibrary.from_db(conn, intensity_power=0.5)
+        for kwargs in ({}, {'precursor_mz': precursor_mz, 'polarity': 'positive'}, {'method': 'entropy'}):
+            self.assertEqual(library.search(peaks, **kwargs), expected.search(peaks, **kwargs))
+
+        queries = list(read_msp_spectra(os.path.join(os.path.dirname(__file__), 'msp_files', 'mona',
+                                                     'MoNA-export-MetaboBASE-small.msp')))
+        self.assertEqual([hits for _, hits in search_batch(library, queries, workers=2, chunk_size=4)],
+                         [hits for _, hits in search_batch(expected, queries)])
+        shutil.rmtree(dirpath)
+
+
+class TestSpectrumStore(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(os.path.join(os.path.dirname(__file__), 'original_results', 'test_msp_dir.db'))
+
+    def test_get_spectra(self):
+        store = SpectrumStore(self.conn, batch_size=2)
+        meta_ids = [r[0] for r in self.conn.execute('SELECT id FROM library_spectra_meta ORDER BY id DESC')]
+        spectra = store.get_spectra(meta_ids + [-1], annotations=True)
+        self.assertEqual(list(spectra.keys()), meta_ids + [-1])
+        for meta_id in meta_ids:
+            peaks = self.conn.execute('SELECT mz, i FROM library_spectra WHERE library_spectra_meta_id = ? '
+                                      'ORDER BY mz', (meta_id,)).fetchall()
+            self.assertEqual(spectra[meta_id]['mz'].tolist(), [p[0] for p in peaks])
+            self.assertEqual(spectra[meta_id]['intensity'].tolist(), [p[1] for p in peaks])
+        self.assertEqual(len(spectra[-1]['mz']), 0)
+        self.assertEqual(sum(len(s['annotations']['mz']) for s in spectra.values()), 15)
+        self.assertEqual(store.stats()['misses'], 12)
+
+        self.assertNotIn('annotations', store.get_spectrum(meta_ids[0]))
+        self.assertEqual(store.get_spectra(meta_ids[:2], annotations=True)[meta_ids[1]]['mz'].tolist(),
+                         spectra[meta_ids[1]]['mz'].tolist())
+        stats = store.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions'], stats['entries']), (5, 12, 0, 12))
+        store.invalidate([meta_ids[0]])
+        self.assertEqual(store.stats()['entries'], 10)
+
+    def test_eviction(self):
+        store = SpectrumStore(self.conn, cache_bytes=2500)
+        meta_ids = [r[0] for r in self.conn.execute('SELECT id FROM library_spectra_meta ORDER BY id')]
+        store.get_spectra(meta_ids)
+        stats = store.stats()
+        self.assertLessEqual(stats['bytes'], 2500)
+        self.assertEqual(stats['entries'] + stats['evictions'], len(meta_ids))
+        # the most recently fetched spectrum is still cached
+        store.get_spectrum(meta_ids[-1])
+        self.assertEqual(store.stats()['hits'], 1)
+        store.clear()
+        self.assertEqual((store.stats()['entries'], store.stats()['bytes']), (0, 0))
+
+
+class TestPeakIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(os.path.join(os.path.dirname(__file__), 'original_results', 'test_msp_mona.db'))
+        self.rows = self.conn.execute('SELECT library_spectra_meta_id, mz, i, '
+                                      '(SELECT max(i) FROM library_spectra b '
+                                      ' WHERE b.library_spectra_meta_id = a.library_spectra_meta_id) '
+                                      'FROM library_spectra a').fetchall()
+
+    def _brute_force(self, mz, tol, min_intensity=0):
+        return sorted(set(r[0] for r in self.rows if abs(r[1] - mz) <= tol and r[2] / r[3] * 100 >= min_intensity))
+
+    def test_fragment_index(self):
+        index = FragmentIndex.from_db(self.conn, bin_width=0.05)
+        self.assertEqual(len(index), self.conn.execute('SELECT count(*) FROM library_spectra').fetchone()[0])
+
+        mzs = [r[0] for r in self.conn.execute('SELECT mz FROM library_spectra ORDER BY id LIMIT 40')]
+        for mz in mzs:
+            self.assertEqual(list(index.query(mz, tol=0.01)), self._brute_force(mz, 0.01))
+            self.assertEqual(list(index.query(mz, tol=0.2, min_intensity=20)), self._brute_force(mz, 0.2, 20))
+
+        both = set(self._brute_force(mzs[0], 0.01)) & set(self._brute_force(mzs[1], 0.01))
+        either = set(self._brute_force(mzs[0], 0.01)) | set(self._brute_force(mzs[30], 0.01))
+        self.assertEqual(list(index.query_fragments(mzs[:2], tol=0.01, mode='and')), sorted(both))
+        self.assertEqual(list(index.query_fragments([mzs[0], mzs[30]], tol=0.01, mode='or')), sorted(either))
+
+        dirpath = tempfile.mkdtemp()
+        pth = os.path.join(dirpath, 'library.db.fragments')
+        index.save(pth)
+        loaded = FragmentIndex.load(pth)
+        self.assertEqual(loaded.bin_width, 0.05)
+        self.assertEqual(list(loaded.query(mzs[0], tol=0.01)), list(index.query(mzs[0], tol=0.01)))
+        shutil.rmtree(dirpath)
+
+    def test_import_fragment_index(self):
+        dirpath = tempfile.mkdtemp()
+        db_pth = os.path.join(dirpath, 'library.db')
+        pth = os.path.join(dirpath, 'library.db.fragments')
+        create_db(db_pth)
+        mona_dir = os.path.join(os.path.dirname(__file__), 'msp_files', 'mona')
+        loss_pth = os.path.join(dirpath, 'library.db.losses')
+        kwargs = {'db_pth': db_pth, 'chunk': 3, 'compound_lookup': False, 'fragment_index_pth': pth,
+                  'neutral_loss_index_pth': loss_pth}
+        with Importer(**kwargs) as importer:
+            importer.import_path(os.path.join(mona_dir, 'MoNA-export-MetaboBASE-small.msp'), source='metabobase')
+        # the existing sidecars are updated by the next import
+        with Importer(**kwargs) as importer:
+            importer.import_path(os.path.join(mona_dir, 'MoNA-export-Pathogen_Box-small.msp'), source='pathogen')
+
+        for index_cls, index_pth in ((FragmentIndex, pth), (NeutralLossIndex, loss_pth)):
+            built = index_cls.from_db(sqlite3.connect(db_pth))
+            incremental = index_cls.load(index_pth)
+            self.assertGreater(len(built), 0)
+            for attr in ('values', 'meta_ids', 'intensity', 'bin_offsets'):
+                self.assertEqual(getattr(built, attr).tolist(), getattr(incremental, attr).tolist())
+
+        with self.assertRaises(ValueError):
+            NeutralLossIndex.load(pth)
+        shutil.rmtree(dirpath)
+
+    def test_neutral_loss_index(self):
+        rows = self.conn.execute('SELECT s.library_spectra_meta_id, m.precursor_mz - s.mz FROM library_spectra s '
+                                 'JOIN library_spectra_meta m ON m.id = s.library_spectra_meta_id '
+                                 'WHERE m.precursor_mz IS NOT NULL AND m.precursor_mz > s.mz').fetchall()
+        index = NeutralLossIndex.from_db(self.conn)
+        self.assertEqual(len(index), len(rows))
+
+        losses = [r[1] for r in rows[::10]]
+        for loss in losses:
+            self.assertEqual(list(index.query(loss, tol=0.005)),
+                             sorted(set(r[0] for r in rows if abs(r[1] - loss) <= 0.005)))
+
+        either = set(r[0] for r in rows if abs(r[1] - losses[0]) <= 0.005 or abs(r[1] - losses[1]) <= 0.005)
+        self.assertEqual(list(index.query_losses(losses[:2], tol=0.005, mode='or')), sorted(either))
+
+
+class TestResume(unittest.TestCase):
+
+    def _import(self, msp_pth, db_pth, resume=False):
+        return LibraryData(msp_pth=msp_pth, db_pth=db_pth, db_type='sqlite', schema='mona', source='test', chunk=3,
+                           compound_lookup=False, structure_lookup=False, resume=resume)
+
+    def test_resume(self):
+        dirpath = tempfile.mkdtemp()
+        orig_pth = os.path.join(os.path.dirname(__file__), 'msp_files', 'mona', 'MoNA-export-MetaboBASE-small.msp')
+        msp_pth = os.path.join(dirpath, 'library.msp')
+
+        # a malformed peak line in the 11th record
+        with open(orig_pth) as f:
+            lines = f.readlines()
+        peak_idx = [i for i, l in enumerate(lines) if l.startswith('Num Peaks')][10] + 1
+        with open(msp_pth, 'w') as f:
+            f.writelines(lines[:peak_idx] + ['not a peak\n'] + lines[peak_idx + 1:])
+
+        db_pth = os.path.join(dirpath, 'resume.db')
+        create_db(db_pth)
+        with self.assertRaises(ValueError):
+            self._import(msp_pth, db_pth)
+
+        conn = sqlite3.connect(db_pth)
+        progress = conn.execute('SELECT record_ordinal, next_meta_id, status FROM library_import_progress').fetchall()
+        self.assertEqual(progress, [(8, 9, 'running')])
+
+        shutil.copy(orig_pth, msp_pth)
+        self._import(msp_pth, db_pth, resume=True)
+
+        clean_pth = os.path.join(dirpath, 'clean.db')
+        create_db(clean_pth)
+        self._import(orig_pth, clean_pth)
+        d_resumed = db_dict(conn.cursor())
+        d_clean = db_dict(sqlite3.connect(clean_pth).cursor())
+
+        self.assertEqual(d_resumed['library_spectra'], d_clean['library_spectra'])
+        self.assertEqual([r[:-1] for r in d_resumed['library_spectra_meta']],
+                         [r[:-1] for r in d_clean['library_spectra_meta']])
+        self.assertEqual(len(d_resumed['library_spectra_source']), 1)
+        self.assertEqual(conn.execute('SELECT status FROM library_import_progress').fetchall(), [('complete',)])
+
+
+    def test_resume_after_summary(self):
+        dirpath = tempfile.mkdtemp()
+        msp_pth = os.path.join(os.path.dirname(__file__), 'msp_files', 'mona', 'MoNA-export-MetaboBASE-small.msp')
+
+        class CrashingImport(LibraryData):
+            # the import stops after the summaries of the third chunk (records 9 to 12) have been committed
+            def _insert(self, rows, table, cn, db_type, ignore_conflicts=False):
+                super(CrashingImport, self)._insert(rows, table, cn, db_type, ignore_conflicts)
+                if table == 'library_spectra_summary' and rows[0][0] > 8:
+                    raise RuntimeError('crash')
+
+        db_pth = os.path.join(dirpath, 'resume.db')
+        create_db(db_pth)
+        with self.assertRaises(RuntimeError):
+            CrashingImport(msp_pth=msp_pth, db_pth=db_pth, schema='mona', source='test', chunk=3,
+                           compound_lookup=False, structure_lookup=False)
+
+        conn = sqlite3.connect(db_pth)
+        self.assertEqual(conn.execute('SELECT next_meta_id FROM library_import_progress').fetchall(), [(9,)])
+        self.assertEqual(conn.execute('SELECT max(library_spectra_meta_id) FROM library_spectra_summary').fetchall(),
+                         [(12,)])
+
+        self._import(msp_pth, db_pth, resume=True)
+
+        clean_pth = os.path.join(dirpath, 'clean.db')
+        create_db(clean_pth)
+        self._import(msp_pth, clean_pth)
+        clean_conn = sqlite3.connect(clean_pth)
+        for table in ('library_spectra_summary', 'library_spectra'):
+            self.assertEqual(conn.execute('SELECT * FROM {} ORDER BY 1'.format(table)).fetchall(),
+                             clean_conn.execute('SELECT * FROM {} ORDER BY 1'.format(table)).fetchall())
+        self.assertEqual(conn.execute('SELECT status FROM library_import_progress').fetchall(), [('complete',)])
+
+
+    def test_resume_first_chunk(self):
+        dirpath = tempfile.mkdtemp()
+        msp_pth = os.path.join(os.path.dirname(__file__), 'msp_files', 'mona', 'MoNA-export-MetaboBASE-small.msp')
+
+        class CrashingImport(LibraryData):
+            # the import stops after the meta and spectra rows of the first chunk have been committed
+            def _insert(self, rows, table, cn, db_type, ignore_conflicts=False):
+                super(CrashingImport, self)._insert(rows, table, cn, db_type, ignore_conflicts)
+                if table == 'library_spectra':
+                    raise RuntimeError('crash')
+
+        db_pth = os.path.join(dirpath, 'resume.db')
+        create_db(db_pth)
+        with self.assertRaises(RuntimeError):
+            CrashingImport(msp_pth=msp_pth, db_pth=db_pth, schema='mona', source='test', chunk=3,
+                           compound_lookup=False, structure_lookup=False)
+
+        conn = sqlite3.connect(db_pth)
+        progress = conn.execute('SELECT record_ordinal, next_meta_id, next_spectra_id, status '
+                                'FROM library_import_progress').fetchall()
+        self.assertEqual(progress, [(0, 1, 1, 'running')])
+        self.assertEqual(conn.execute('SELECT count(*) FROM library_spectra_meta').fetchall(), [(4,)])
+
+        self._import(msp_pth, db_pth, resume=True)
+
+        clean_pth = os.path.join(dirpath, 'clean.db')
+        create_db(clean_pth)
+        self._import(msp_pth, clean_pth)
+        clean_conn = sqlite3.connect(clean_pth)
+        for qry in ('SELECT * FROM library_spectra ORDER BY id', 'SELECT id, accession FROM library_spectra_meta',
+                    'SELECT id, name FROM library_spectra_source'):
+            self.assertEqual(conn.execute(qry).fetchall(), clean_conn.execute(qry).fetchall())
+        self.assertEqual(conn.execute('SELECT status FROM library_import_progress').fetchall(), [('complete',)])
+
+
+class TestIncremental(unittest.TestCase):
+
+    def _records(self):
+        pth = os.path.join(os.path.dirname(__file__), 'msp_files', 'mona', 'MoNA-export-MetaboBASE-small.msp')
+        with open(pth) as f:
+            return [r.strip() + '\n\n' for r in f.read().split('\n\n') if r.strip()]
+
+    def _import(self, records, msp_pth, db_pth, incremental=True):
+        with open(msp_pth, 'w') as f:
+            f.writelines(records)
+        return LibraryData(msp_pth=msp_pth, db_pth=db_pth, db_type='sqlite', schema='mona', source='metabobase',
+                           chunk=3, compound_lookup=False, structure_lookup=False, incremental=incremental)
+
+    def _spectra(self, db_pth):
+        # (accession, peaks) of each spectrum (the ids differ between an incremental and a full import)
+        conn = sqlite3.connect(db_pth)
+        spectra = [(s['accession'], s['peaks']) for page in iter_spectra(conn) for s in page]
+        return sorted(spectra)
+
+    def test_incremental(self):
+        dirpath = tempfile.mkdtemp()
+        msp_pth = os.path.join(dirpath, 'release.msp')
+        records = self._records()
+        release1 = records[:10]
+        # first record removed, fifth record changed and two new records
+        release2 = records[1:12]
+        release2[3] = release2[3].replace('100.000000', '99.000000')
+
+        db_pth = os.path.join(dirpath, 'incremental.db')
+        create_db(db_pth)
+        libdata = self._import(release1, msp_pth, db_pth)
+        self.assertEqual(libdata.delta_stats['new'], 10)
+
+        libdata = self._import(release2, msp_pth, db_pth)
+        self.assertEqual(libdata.delta_stats, {'new': 2, 'changed': 1, 'unchanged': 8, 'retired': 1})
+
+        # nothing to do for the same release
+        libdata = self._import(release2, msp_pth, db_pth)
+        self.assertEqual(libdata.delta_stats, {'new': 0, 'changed': 0, 'unchanged': 11, 'retired': 0})
+
+        full_pth = os.path.join(dirpath, 'full.db')
+        create_db(full_pth)
+        self._import(release2, msp_pth, full_pth, incremental=False)
+        self.assertEqual(self._spectra(db_pth), self._spectra(full_pth))
+
+        conn = sqlite3.connect(db_pth)
+        self.assertEqual(conn.execute('SELECT count(*) FROM library_spectra_source').fetchall(), [(1,)])
+        self.assertEqual(conn.execute('SELECT count(*) FROM library_spectra_hash').fetchall(), [(11,)])
+
+
+class TestMonaJson(unittest.TestCase):
+
+    json_pth = os.path.join(os.path.dirname(__file__), 'json_files', 'MoNA-export-MetaboBASE-small.json')
+    msp_pth = os.path.join(os.path.dirname(__file__), 'msp_files', 'mona', 'MoNA-export-MetaboBASE-small.msp')
+
+    def _import(self, pth, db_pth, resume=False):
+        return LibraryData(msp_pth=pth, db_pth=db_pth, db_type='sqlite', schema='mona', source='test', chunk=3,
+                           compound_lookup=False, structure_lookup=False, resume=resume)
+
+    def test_iter_json_records(self):
+        # a small buffer so most records are split between blocks
+        with io.open(self.json_pth, 'rb') as f:
+            records = list(iter_json_records(f, buffer_size=100, offsets=True))
+        self.assertEqual(len(records), 15)
+        self.assertEqual(records[0][0]['id'], 'MetaboBASE0001')
+
+        offset = sum(nbytes for _, nbytes in records[:5])
+        with io.open(self.json_pth, 'rb') as f:
+            f.seek(offset)
+            self.assertEqual([r['id'] for r, _ in iter_json_records(f)], [r['id'] for r, _ in records[5:]])
+
+        meta_info, compound_info, other_names, inchi = record_info(records[0][0])
+        self.assertEqual(meta_info['ms_level'], '2')
+        self.assertEqual(meta_info['polarity'], 'negative')
+        self.assertEqual(meta_info['mass_error'], '-0.023797739999963596')
+        self.assertEqual(compound_info['inchikey_id'], 'LPEPZZAVFJPLNZ-SFHVURJKSA-N')
+        self.assertEqual(compound_info['exact_mass'], '340.13107374')
+        self.assertTrue(inchi.startswith('InChI=1S/C20H20O5'))
+
+        self.assertEqual(parse_spectrum_string('109.0679:4.2 119.0517:100').tolist(), [[109.0679, 4.2], [119.0517, 100]])
+        with self.assertRaises(ValueError):
+            parse_spectrum_string('109.0679:4.2 119.0517')
+
+    def test_json_import(self):
+        dirpath = tempfile.mkdtemp()
+        for pth, db_pth in ((self.json_pth, 'json.db'), (self.msp_pth, 'msp.db')):
+            create_db(os.path.join(dirpath, db_pth))
+            self._import(pth, os.path.join(dirpath, db_pth))
+
+        d_json = db_dict(sqlite3.connect(os.path.join(dirpath, 'json.db')).cursor())
+        d_msp = db_dict(sqlite3.connect(os.path.join(dirpath, 'msp.db')).cursor())
+        self.assertEqual(d_json['library_spectra'], d_msp['library_spectra'])
+        # the same meta data (the negative mass errors are not matched by the MSP regexes) apart from the random
+        # inchikeys (without the compound lookup)
+        mass_error = d_json['library_spectra_meta'][0].index(-0.023797739999963596)
+        self.assertEqual([r[:mass_error] + r[mass_error + 1:-1] for r in d_json['library_spectra_meta']],
+                         [r[:mass_error] + r[mass_error + 1:-1] for r in d_msp['library_spectra_meta']])
+
+        # from a stream
+        db_pth = os.path.join(dirpath, 'stream.db')
+        create_db(db_pth)
+        with Importer(db_pth=db_pth, compound_lookup=False, structure_lookup=False) as importer:
+            with io.open(self.json_pth, 'rb') as f:
+                self.assertEqual(importer.import_stream(f, source='test', file_format='json'), 15)
+
+    def test_json_resume(self):
+        dirpath = tempfile.mkdtemp()
+        json_pth = os.path.join(dirpath, 'library.json')
+
+        # a malformed spectrum in the 11th record (one record per line after the opening bracket), only the 11th
+        # record is changed so the byte offsets of the records before it are the same as in the original file
+        with open(self.json_pth) as f:
+            lines = f.readlines()
+        lines[11] = lines[11].replace('"spectrum": "', '"spectrum": "500.1 ', 1)
+        with open(json_pth, 'w') as f:
+            f.writelines(lines)
+
+        db_pth = os.path.join(dirpath, 'resume.db')
+        create_db(db_pth)
+        with self.assertRaises(ValueError):
+            self._import(json_pth, db_pth)
+
+        conn = sqlite3.connect(db_pth)
+        progress = conn.execute('SELECT record_ordinal, next_meta_id, status FROM library_import_progress').fetchall()
+        self.assertEqual(progress, [(8, 9, 'running')])
+
+        shutil.copy(self.json_pth, json_pth)
+        self._import(json_pth, db_pth, resume=True)
+
+        clean_pth = os.path.join(dirpath, 'clean.db')
+        create_db(clean_pth)
+        self._import(self.json_pth, clean_pth)
+        clean_conn = sqlite3.connect(clean_pth)
+
+        for table in ('library_spectra_meta', 'library_spectra', 'library_spectra_summary'):
+            qry = 'SELECT count(*), min({0}), max({0}) FROM {1}'.format(
+                'id' if table != 'library_spectra_summary' else 'library_spectra_meta_id', table)
+            self.assertEqual(conn.execute(qry).fetchall(), clean_conn.execute(qry).fetchall())
+        self.assertEqual(conn.execute('SELECT count(DISTINCT accession) FROM library_spectra_meta').fetchall(), [(15,)])
+
+        d_resumed = db_dict(conn.cursor())
+        d_clean = db_dict(clean_conn.cursor())
+        self.assertEqual(d_resumed['library_spectra'], d_clean['library_spectra'])
+        self.assertEqual([r[:-1] for r in d_resumed['library_spectra_meta']],
+                         [r[:-1] for r in d_clean['library_spectra_meta']])
+        self.assertEqual(len(d_resumed['library_spectra_source']), 1)
+        self.assertEqual(conn.execute('SELECT status FROM library_import_progress').fetchall(), [('complete',)])
+
+
+class TestSplash(unittest.TestCase):
+
+    def test_splash(self):
+        self.assertEqual(splash([133.0648, 151.0754, 155.9743, 161.0597, 179.0703],
+                                [21905.33203125, 9239.8974609375, 10980.8896484375, 96508.4375, 72563.875]),
+                         'splash10-03fr-0900000000-035ec76d23650a15673b')
+        self.assertIsNone(splash([], []))
+
+    def test_splash_massbank(self):
+        # the SPLASHs in the MassBank records
+        conn = sqlite3.connect(os.path.join(os.path.dirname(__file__), 'original_results', 'test_msp_dir.db'))
+        peaks = group_peaks(conn.execute('SELECT * FROM library_spectra').fetchall())
+        for meta_id, splash_id in conn.execute('SELECT id, splash FROM library_spectra_meta'):
+            self.assertEqual(splash(*peaks[meta_id]), splash_id)
+
+    def test_compute_splash(self):
+        dirpath = tempfile.mkdtemp()
+        msp_pth = os.path.join(os.path.dirname(__file__), 'msp_files', 'mona', 'MoNA-export-MetaboBASE-small.msp')
+        computed_pth = os.path.join(dirpath, 'computed.db')
+        backfill_pth = os.path.join(dirpath, 'backfill.db')
+
+        for db_pth, compute_splash in ((computed_pth, True), (backfill_pth, False)):
+            create_db(db_pth)
+            LibraryData(msp_pth=msp_pth, db_pth=db_pth, schema='mona', source='metabobase', chunk=5,
+                        compound_lookup=False, structure_lookup=False, compute_splash=compute_splash,
+                        splash_processes=2)
+
+        os.system('msp2db splash -o {} --page_size 4'.format(backfill_pth))
+
+        computed = sqlite3.connect(computed_pth).execute('SELECT id, splash FROM library_spectra_meta').fetchall()
+        backfilled = sqlite3.connect(backfill_pth).execute('SELECT id, splash FROM library_spectra_meta').fetchall()
+        self.assertEqual(len(computed), 15)
+        self.assertTrue(all(s.startswith('splash10-') for _, s in computed))
+        self.assertEqual(computed, backfilled)
+
+        conn = sqlite3.connect(backfill_pth)
+        self.assertEqual(backfill_splash(conn), 0)
+        self.assertEqual(backfill_splash(conn, overwrite=True, processes=2), 15)
+
+
+class TestAddSplashIds(unittest.TestCase):
+
+    def test_add_splash_ids(self):
+        dirpath = tempfile.mkdtemp()
+        db_pth = os.path.join(dirpath, 'splash.db')
+        shutil.copy(os.path.join(os.path.dirname(__file__), 'original_results', 'test_msp_dir.db'), db_pth)
+        conn = sqlite3.connect(db_pth)
+        original = conn.execute('SELECT accession, splash FROM library_spectra_meta').fetchall()
+        conn.execute('UPDATE library_spectra_meta SET splash = NULL')
+        conn.commit()
+
+        mapping_pth = os.path.join(dirpath, 'mapping.csv')
+        with open(mapping_pth, 'w') as f:
+            f.writelines('{}, {}\n'.format(accession, splash_id) for accession, splash_id in original)
+            f.write('XX000001,splash10-0000-0000000000-00000000000000000000\n')
+
+        counts = add_splash_ids(mapping_pth, conn, chunk_size=2)
+        self.assertEqual(counts, {'matched': len(original), 'unmatched': 1})
+        self.assertEqual(conn.execute('SELECT accession, splash FROM library_spectra_meta').fetchall(), original)
+
+
+class TestBuild(unittest.TestCase):
+
+    def setUp(self):
+        mona_dir = os.path.join(os.path.dirname(__file__), 'msp_files', 'mona')
+        self.sources = [{'msp_pth': os.path.join(mona_dir, 'MoNA-export-MetaboBASE-small.msp'), 'source': 'metabobase',
+                         'schema': 'mona', 'compound_lookup': False, 'structure_lookup': False, 'chunk': 3},
+                        {'msp_pth': os.path.join(mona_dir, 'MoNA-export-Pathogen_Box-small.msp'),
+                         'source': 'pathogen_box', 'schema': 'mona', 'compound_lookup': False,
+                         'structure_lookup': False},
+                        {'msp_pth': os.path.join(os.path.dirname(__file__), 'msp_files', 'massbank'),
+                         'source': 'massbank', 'schema': 'massbank', 'compound_lookup': False,
+                         'structure_lookup': False}]
+
+    def test_split_msp(self):
+        dirpath = tempfile.mkdtemp()
+        pths = split_msp(self.sources[0]['msp_pth'], 4, dirpath)
+        self.assertEqual(len(pths), 4)
+        content = ''.join(open(pth).read() for pth in pths)
+        self.assertEqual(content, open(self.sources[0]['msp_pth']).read())
+        self.assertTrue(all(open(pth).read().startswith('Name:') for pth in pths))
+
+    def test_build_sqlite(self):
+        dirpath = tempfile.mkdtemp()
+        serial_pth = os.path.join(dirpath, 'serial.db')
+        create_db(serial_pth)
+        for kwargs in self.sources:
+            LibraryData(db_pth=serial_pth, **kwargs)
+
+        build_pth = os.path.join(dirpath, 'build.db')
+        report = build_sqlite(build_pth, self.sources, processes=2, shards=3)
+        self.assertEqual([(r['source'], r['shard']) for r in report],
+                         [('metabobase', 0), ('metabobase', 1), ('metabobase', 2), ('pathogen_box', 0),
+                          ('pathogen_box', 1), ('pathogen_box', 2), ('massbank', 0)])
+        self.assertEqual(sum(r['spectra'] for r in report), 29)
+
+        # the same ids as importing the sources one after another (the compounds are UNKNOWN_<uuid>)
+        d_serial = db_dict(sqlite3.connect(serial_pth).cursor())
+        d_build = db_dict(sqlite3.connect(build_pth).cursor())
+        self.assertEqual(d_build['library_spectra'], d_serial['library_spectra'])
+        self.assertEqual(d_build['library_spectra_annotations'], d_serial['library_spectra_annotations'])
+        self.assertEqual([r[:-1] for r in d_build['library_spectra_meta']],
+                         [r[:-1] for r in d_serial['library_spectra_meta']])
+        self.assertEqual([r[:2] for r in d_build['library_spectra_source']],
+                         [r[:2] for r in d_serial['library_spectra_source']])
+
+
+    def test_build_manifest(self):
+        dirpath = tempfile.mkdtemp()
+        manifest = {'database': {'out_pth': 'library.db', 'db_type': 'sqlite'},
+                    'workers': 2,
+                    'defaults': {'schema': 'mona', 'compound_lookup': False, 'structure_lookup': False},
+                    'sources': self.sources}
+        manifest_pth = os.path.join(dirpath, 'manifest.json')
+        with open(manifest_pth, 'w') as f:
+            json.dump(manifest, f)
+
+        os.system('msp2db build {} --report report.csv'.format(manifest_pth))
+
+        with open(os.path.join(dirpath, 'report.csv')) as f:
+            report = list(csv.DictReader(f))
+        self.assertEqual([(r['source'], r['spectra']) for r in report],
+                         [('metabobase', '15'), ('pathogen_box', '9'), ('massbank', '5')])
+        self.assertEqual(int(report[-1]['size']), os.path.getsize(os.path.join(dirpath, 'library.db')))
+
+        conn = sqlite3.connect(os.path.join(dirpath, 'library.db'))
+        self.assertEqual(conn.execute('SELECT count(*) FROM library_spectra_meta').fetchall(), [(29,)])
+
+
+class TestStreaming(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(os.path.join(os.path.dirname(__file__), 'original_results', 'test_msp_dir.db'))
+
+    def test_iter_table(self):
+        d_orig = db_dict(self.conn.cursor())
+        pages = list(iter_table(self.conn, 'library_spectra', page_size=7))
+        self.assertTrue(all(len(page) <= 7 for page in pages))
+        self.assertEqual([row for page in pages for row in page], d_orig['library_spectra'])
+
+    def test_iter_table_numpy(self):
+        n = len(db_dict(self.conn.cursor())['library_spectra'])
+        pages = list(iter_table(self.conn, 'library_spectra', page_size=50, output='numpy'))
+        self.assertEqual(sum(len(page) for page in pages), n)
+        self.assertEqual(pages[0]['mz'].dtype.kind, 'f')
+
+    @unittest.skipUnless(PANDAS_AVAILABLE, 'pandas is not installed')
+    def test_iter_table_pandas(self):
+        n = len(db_dict(self.conn.cursor())['library_spectra'])
+        pages = list(iter_table(self.conn, 'library_spectra', page_size=50, output='pandas'))
+        self.assertEqual(sum(len(page) for page in pages), n)
+        self.assertEqual(list(pages[0].columns), ['id', 'mz', 'i', 'other', 'library_spectra_meta_id'])
+
+    def test_iter_spectra(self):
+        d_orig = db_dict(self.conn.cursor())
+        pages = list(iter_spectra(self.conn, page_size=2))
+        spectra = [spectrum for page in pages for spectrum in page]
+        self.assertTrue(all(len(page) <= 2 for page in pages))
+        self.assertEqual([s['id'] for s in spectra], [r[0] for r in d_orig['library_spectra_meta']])
+        self.assertEqual(sum(len(s['peaks']) for s in spectra), len(d_orig['library_spectra']))
+        self.assertEqual(spectra[0]['peaks'][0], tuple(d_orig['library_spectra'][0][1:3]))
+
+
+class TestExport(unittest.TestCase):
+
+    meta_sql = 'SELECT name, collision_energy, ms_level, accession, resolution, polarity, fragmentation_type, ' \
+               'precursor_mz, precursor_type, instrument_type, instrument, copyright, retention_time, splash ' \
+               'FROM library_spectra_meta ORDER BY id'
+
+    def test_export_msp(self):
+        conn = sqlite3.connect(os.path.join(os.path.dirname(__file__), 'original_results', 'test_msp_dir.db'))
+        dirpath = tempfile.mkdtemp()
+        for style in ('mona', 'massbank'):
+            msp_pth = os.path.join(dirpath, 'export_{}.msp'.format(style))
+            self.assertEqual(export_msp(conn, msp_pth, style=style, page_size=2), 5)
+
+            # the exported records are imported with the same details and peaks
+            db_pth = os.path.join(dirpath, 'export_{}.db'.format(style))
+            create_db(db_pth)
+            LibraryData(msp_pth=msp_pth, db_pth=db_pth, schema=style, source='test', compound_lookup=False).close()
+            conn2 = sqlite3.connect(db_pth)
+            self.assertEqual(conn2.execute(self.meta_sql).fetchall(), conn.execute(self.meta_sql).fetchall())
+            self.assertEqual(conn2.execute('SELECT mz, i FROM library_spectra').fetchall(),
+                             conn.execute('SELECT mz, i FROM library_spectra').fetchall())
+        shutil.rmtree(dirpath)
+
+    def test_export_filters(self):
+        conn = sqlite3.connect(os.path.join(os.path.dirname(__file__), 'original_results', 'test_msp_dir.db'))
+        self.assertEqual([r['id'] for r in iter_records(conn, polarity='negative', ms_level=2)], [3, 4])
+        self.assertEqual([r['id'] for r in iter_records(conn, min_precursor_mz=200, page_size=1)],
+                         [r[0] for r in conn.execute('SELECT id FROM library_spectra_meta WHERE precursor_mz >= 200')])
+        self.assertEqual([r['id'] for r in iter_records(conn, where="m.polarity = 'POSITIVE'", id=[1, 2, 3])], [1])
+        self.assertRaises(ValueError, export_where, peaks=5)
+        self.assertRaises(ValueError, export_where, polarity='sideways')
+
+        dirpath = tempfile.mkdtemp()
+        msp_pth = os.path.join(dirpath, 'positive.msp.gz')
+        main(['export', msp_pth, '-o', os.path.join(os.path.dirname(__file__), 'original_results',
+                                                     'test_msp_dir.db'), '--polarity', 'positive'])
+        with gzip.open(msp_pth, 'rt') as f:
+            self.assertEqual([line for line in f if line.startswith('DB#')], ['DB#: AC000001\n', 'DB#: UO000002\n'])
+        shutil.rmtree(dirpath)
+
+    @unittest.skipUnless(PYARROW_AVAILABLE, 'pyarrow is not installed')
+    def test_export_arrow(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        import pyarrow.dataset as ds
+        conn = sqlite3.connect(os.path.join(os.path.dirname(__file__), 'original_results', 'test_msp_dir.db'))
+        peaks = conn.execute('SELECT library_spectra_meta_id, mz, i FROM library_spectra '
+                             'ORDER BY library_spectra_meta_id, id').fetchall()
+        dirpath = tempfile.mkdtemp()
+
+        pth = os.path.join(dirpath, 'parquet')
+        self.assertEqual(export_arrow(conn, pth, row_group_size=20),
+                         {'library_spectra_meta': 5, 'library_spectra': 5, 'metab_compound': 5})
+        meta = pq.read_table(os.path.join(pth, 'library_spectra_meta.parquet'))
+        self.assertEqual(meta.column('accession').to_pylist(),
+                         [r[0] for r in conn.execute('SELECT accession FROM library_spectra_meta ORDER BY id')])
+        self.assertTrue(pa.types.is_dictionary(meta.schema.field('instrument_type').type))
+        spectra = pq.read_table(os.path.join(pth, 'library_spectra.parquet'))
+        self.assertEqual(spectra.column('library_spectra_meta_id').to_pylist(), [1, 2, 3, 4, 5])
+        self.assertEqual([mz for mzs in spectra.column('mz').to_pylist() for mz in mzs], [p[1] for p in peaks])
+
+        pth = os.path.join(dirpath, 'arrow')
+        counts = export_arrow(conn, pth, file_format='arrow', peaks='long', partition_by='polarity',
+                              row_group_size=20, ms_level=2)
+        self.assertEqual(counts, {'library_spectra_meta': 3, 'library_spectra': 43, 'metab_compound': 3})
+        self.assertEqual(sorted(os.listdir(os.path.join(pth, 'library_spectra'))),
+                         ['polarity=NEGATIVE', 'polarity=POSITIVE'])
+        spectra = ds.dataset(os.path.join(pth, 'library_spectra'), format='arrow', partitioning='hive').to_table()
+        rows = zip(*[spectra.column(col).to_pylist() for col in ('library_spectra_meta_id', 'mz', 'i')])
+        self.assertEqual(sorted(rows), [p for p in peaks if p[0] in (1, 3, 4)])
+        self.assertRaises(ValueError, export_arrow, conn, pth, peaks='wide')
+        shutil.rmtree(dirpath)
+
+
+@unittest.skipUnless(os.environ.get('MSP2DB_TEST_MYSQL'), 'set MSP2DB_TEST_MYSQL=user:password@database to test '
+                                                           'against a local MySQL/MariaDB server')
+class TestMySQL(unittest.TestCase):
+
+    def setUp(self):
+        user_password, self.db_name = os.environ['MSP2DB_TEST_MYSQL'].split('@')
+        self.user, self.password = user_password.split(':')
+
+    def test_mysql_bulk(self):
+        msp_pth = os.path.join(os.path.dirname(__file__), "msp_files", "massbank")
+        conn = sqlite3.connect(os.path.join(os.path.dirname(__file__), 'original_results', 'test_msp_dir.db'))
+        d_orig = db_dict(conn.cursor())
+
+        for bulk in [None, 'multirow', 'load_data']:
+            conn = get_connection('mysql', None, self.user, self.password, self.db_name)
+            create_db(db_type='mysql', conn=conn)
+            libdata = LibraryData(msp_pth=msp_pth, db_type='mysql', user=self.user, password=self.password,
+                                  mysql_db_name=self.db_name, schema='massbank', source='test', chunk=200,
+                                  compound_lookup=False, mysql_bulk=bulk)
+            d_new = libdata.get_db_dict()
+            self.assertEqual(len(d_new['library_spectra']), len(d_orig['library_spectra']))
+            self.assertEqual([r[1:4] for r in d_new['library_spectra']],
+                             [r[1:4] for r in d_orig['library_spectra']])
+            self.assertIn('library_spectra', libdata.peak_rows_per_second)
+
+
+@unittest.skipUnless(os.environ.get('MSP2DB_TEST_POSTGRES'), 'set MSP2DB_TEST_POSTGRES to a connection string to test '
+                                                              'against a local PostgreSQL server')
+class TestPostgres(unittest.TestCase):
+
+    def test_postgres(self):
+        dsn = os.environ['MSP2DB_TEST_POSTGRES']
+        msp_pth = os.path.join(os.path.dirname(__file__), "msp_files", "massbank")
+
+        db_pth = os.path.join(tempfile.mkdtemp(), 'sqlite_compare.db')
+        create_db(file_pth=db_pth)
+        d_sqlite = LibraryData(msp_pth=msp_pth, db_pth=db_pth, db_type='sqlite', schema='massbank',
+                               source='test', chunk=2).get_db_dict()
+
+        create_db(db_type='postgres', conn=get_connection('postgres', dsn))
+        libdata = LibraryData(msp_pth=msp_pth, db_pth=dsn, db_type='postgres', schema='massbank', source='test',
+                              chunk=2)
+        d_pg = libdata.get_db_dict()
+
+        for table in ['library_spectra', 'library_spectra_meta', 'library_spectra_annotations']:
+            self.assertEqual(sorted(d_pg[table]), sorted(d_sqlite[table]))
+        self.assertEqual(sorted(r[0] for r in d_pg['metab_compound']), sorted(r[0] for r in d_sqlite['metab_compound']))
+
+        # compounds already in the database are skipped and the ids continue from the identity sequences
+        libdata = LibraryData(msp_pth=msp_pth, db_pth=dsn, db_type='postgres', schema='massbank', source='test2',
+                              chunk=2)
+        d_pg2 = libdata.get_db_dict()
+        self.assertEqual(len(d_pg2['metab_compound']), len(d_pg['metab_compound']))
+        self.assertEqual(len(d_pg2['library_spectra']), 2 * len(d_pg['library_spectra']))
+        libdata.c.execute("INSERT INTO library_spectra_source (name) VALUES ('native') RETURNING id")
+        self.assertEqual(libdata.c.fetchone()[0], 3)
+
+
+try:
+    import django
+    DJANGO_AVAILABLE = True
+except ImportError:
+    DJANGO_AVAILABLE = False
+
+
+class CeleryTask(object):
+    # records the progress updates a celery task would receive
+    def __init__(self):
+        self.states = []
+
+    def update_state(self, state, meta):
+        self.states.append((state, meta))
+
+
+@unittest.skipUnless(DJANGO_AVAILABLE, 'Django is not installed')
+class TestDjango(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.django_settings')
+        django.setup()
+
+    def test_django_sqlite(self):
+        from django.db import connection
+        create_db(db_type='sqlite', conn=connection)
+
+        task = CeleryTask()
+        msp_pth = os.path.join(os.path.dirname(__file__), 'msp_files', 'mona', 'MoNA-export-MassBank-small.msp')
+        fixtures = fixtures_from_db(sqlite3.connect(os.path.join(os.path.dirname(__file__), 'original_results',
+                                                                 'test_msp_mona.db')))
+        with PubChemStandIn(fixtures):
+            libdata = LibraryData(msp_pth=msp_pth, db_type='django', schema='mona', source='massbank', chunk=2,
+                                  celery_obj=task)
+            d_new = libdata.get_db_dict()
+
+            db_pth = os.path.join(tempfile.mkdtemp(), 'compare.db')
+            create_db(file_pth=db_pth)
+            d_sqlite = LibraryData(msp_pth=msp_pth, db_pth=db_pth, db_type='sqlite', schema='mona',
+                                   source='massbank', chunk=2).get_db_dict()
+
+        self.assertEqual(d_new['library_spectra'], d_sqlite['library_spectra'])
+        self.assertEqual(d_new['library_spectra_meta'], d_sqlite['library_spectra_meta'])
+        self.assertEqual(remove_date_from_metab_compound_d(d_new)['metab_compound'],
+                         remove_date_from_metab_compound_d(d_sqlite)['metab_compound'])
+        self.assertTrue(task.states)
+        self.assertTrue(all(meta['total'] for state, meta in task.states))
+
+    def test_django_atomic_chunk(self):
+        from django.db import connection
+        from msp2db.db import chunk_transaction
+        create_db(db_type='sqlite', conn=connection)
+
+        rows = [(1, 'a', 'x'), (2, 'b', 'x')]
+        insert_query_m(rows, 'library_spectra_source', connection, 'id, name, parsing_software', db_type='django')
+        try:
+            with chunk_transaction(connection, 'django'):
+                insert_query_m([(3, 'c', 'x')], 'library_spectra_source', connection, 'id, name, parsing_software',
+                               db_type='django')
+                insert_query_m(rows, 'library_spectra_source', connection, 'id, name, parsing_software',
+                               db_type='django')
+        except Exception:
+            pass
+
+        cursor = connection.cursor()
+        cursor.execute('SELECT id FROM library_spectra_source')
+        self.assertEqual([r[0] for r in cursor.fetchall()], [1, 2])
+
+        insert_query_m(rows + [(3, 'c', 'x')], 'library_spectra_source', connection, 'id, name, parsing_software',
+                       db_type='django', ignore_conflicts=True)
+        cursor.execute('SELECT id FROM library_spectra_source')
+        self.assertEqual([r[0] for r in cursor.fetchall()], [1, 2, 3])
+
+
 class TestCLI(unittest.TestCase):
 
     def compare_db_d(self, d1, d2):
@@ -339,6 +1530,17 @@ class TestCLI(unittest.TestCase):
         self.assertEquals(d1['library_spectra_meta'], d2[u'library_spectra_meta'])
         self.assertEquals(d1['library_spectra'], d2[u'library_spectra'])
 
+    def compare_db_stream(self, conn1, conn2, page_size=1000):
+        # compare the databases page by page (so the whole database is never held in memory)
+        for table in ['library_spectra_annotation', 'metab_compound', 'library_spectra_meta', 'library_spectra']:
+            for page1, page2 in zip_longest(iter_table(conn1, table, page_size), iter_table(conn2, table, page_size)):
+                self.assertIsNotNone(page1)
+                self.assertIsNotNone(page2)
+                if table == 'metab_compound':
+                    page1 = remove_date_from_metab_compound_d({table: page1})[table]
+                    page2 = remove_date_from_metab_compound_d({table: page2})[table]
+                self.assertEquals(page1, page2)
+
     def test_cli(self,):
 
         dirpath = tempfile.mkdtemp()
@@ -355,14 +1557,9 @@ class TestCLI(unittest.TestCase):
 
         # get original database info
         conn = sqlite3.connect(os.path.join(os.path.dirname(__file__), 'original_results', 'test_sqlite_cli.db'))
-        cursor = conn.cursor()
-        db_original = db_dict(cursor)
-
         conn2 = sqlite3.connect(db_pth)
-        cursor2 = conn2.cursor()
-        db_new = db_dict(cursor2)
 
-        self.compare_db_d(db_new, db_original)
+        self.compare_db_stream(conn2, conn)
 
     def test_cli_compound_lookup_false(self,):
 